@@ -29,12 +29,28 @@ const PDFViewer = ({
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
 
+  // pdfData puede ser la URL de descarga del archivo (archivo_url) o su contenido en base64
+  const esUrl = Boolean(pdfData) && (/^https?:\/\//.test(pdfData) || pdfData.startsWith('/'));
+
   const handleDownload = () => {
     if (!pdfData) {
       alert('No hay datos de archivo disponibles para descargar');
       return;
     }
 
+    if (esUrl) {
+      const link = document.createElement('a');
+      link.href = pdfData;
+      link.download = fileName || 'archivo.pdf';
+      link.target = '_blank';
+      link.rel = 'noopener';
+      link.style.display = 'none';
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
+      return;
+    }
+
     try {
       setLoading(true);
       setError(null);
@@ -150,7 +166,7 @@ const PDFViewer = ({
             bgcolor: 'grey.100'
           }}>
             <iframe
-              src={`data:application/pdf;base64,${pdfData.includes(',') ? pdfData.split(',')[1] : pdfData}`}
+              src={esUrl ? pdfData : `data:application/pdf;base64,${pdfData.includes(',') ? pdfData.split(',')[1] : pdfData}`}
               width="100%"
               height="100%"
               style={{ border: 'none' }}
@@ -3,4 +3,44 @@ const API_CONFIG = {
   API_URL: import.meta.env.VITE_API_URL || 'http://localhost:8000/api'
 };
 
+const tokenSesion = () => {
+  try {
+    return JSON.parse(localStorage.getItem('user'))?.token || null;
+  } catch {
+    return null;
+  }
+};
+
+// Agrega el token de sesión (lo entrega el login) a todas las llamadas a la API, para no
+// tener que pasarlo en cada fetch. Si el backend responde que la sesión expiró o fue
+// revocada, se vuelve al login.
+export const instalarTokenSesion = () => {
+  // Sesión guardada antes de que el login entregara tokens: el backend ya no acepta solo
+  // X-User-Email, así que hay que volver a iniciar sesión
+  if (localStorage.getItem('user') && !tokenSesion()) {
+    localStorage.removeItem('user');
+  }
+  const fetchOriginal = window.fetch.bind(window);
+  window.fetch = async (recurso, opciones = {}) => {
+    const url = typeof recurso === 'string' ? recurso : recurso?.url || '';
+    const token = tokenSesion();
+    if (!token || !url.startsWith(API_CONFIG.API_URL)) {
+      return fetchOriginal(recurso, opciones);
+    }
+    const headers = new Headers(opciones.headers || (recurso instanceof Request ? recurso.headers : undefined));
+    if (!headers.has('Authorization')) {
+      headers.set('Authorization', `Bearer ${token}`);
+    }
+    const respuesta = await fetchOriginal(recurso, { ...opciones, headers });
+    if (respuesta.status === 401 && !url.includes('/login/')) {
+      const datos = await respuesta.clone().json().catch(() => ({}));
+      if (datos.error && datos.error.toLowerCase().includes('sesión')) {
+        localStorage.removeItem('user');
+        window.location.href = '/login';
+      }
+    }
+    return respuesta;
+  };
+};
+
 export default API_CONFIG;
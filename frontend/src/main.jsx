@@ -4,6 +4,9 @@ import App from './App';
 import { UserProvider } from './components/UserContext';
 import { LocalizationProvider } from '@mui/x-date-pickers/LocalizationProvider';
 import { AdapterDateFns } from '@mui/x-date-pickers/AdapterDateFns';
+import { instalarTokenSesion } from './config/api';
+
+instalarTokenSesion();
 
 ReactDOM.createRoot(document.getElementById('root')).render(
   <LocalizationProvider dateAdapter={AdapterDateFns}>
@@ -18,12 +18,14 @@ import { useUser } from '../../../../components/UserContext';
 import { useUnidades } from '../../../../components/hooks';
 import PhotoCameraIcon from '@mui/icons-material/PhotoCamera';
 import DeleteIcon from '@mui/icons-material/Delete';
+import { subirArchivo } from '../adjuntos';
 
 const ControlOdometroForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading = false }) => {
   const [form, setForm] = useState({});
   const [errors, setErrors] = useState({});
   const [fotos, setFotos] = useState([]);
   const [fotoFiles, setFotoFiles] = useState([]);
+  const [subiendo, setSubiendo] = useState(false);
   const { user } = useUser();
   const { unidades, normalizeUnidadForDB } = useUnidades();
   const isEncargado = user?.Cargo?.toLowerCase() === 'encargado';
@@ -128,15 +130,19 @@ const ControlOdometroForm = ({ onSubmit, initialData, isEditing, isReadOnly, sub
     if (validFiles.length > 0) {
       setErrors(prev => ({ ...prev, fotos: null }));
       
-      validFiles.forEach(file => {
-        const reader = new FileReader();
-        reader.onload = (e) => {
-          const newFoto = e.target.result;
-          setFotos(prev => [...prev, newFoto]);
+      // Cada foto se sube por partes a GridFS; en el formulario queda solo su URL
+      setSubiendo(true);
+      Promise.all(validFiles.map(async (file) => {
+        try {
+          const url = await subirArchivo(file, user?.Email);
+          setFotos(prev => [...prev, url]);
           setFotoFiles(prev => [...prev, file]);
-        };
-        reader.readAsDataURL(file);
-      });
+        } catch (error) {
+          console.error('Error al subir la foto:', error);
+          setErrors(prev => ({ ...prev, fotos: `No se pudo subir ${file.name}` }));
+        }
+      })).finally(() => setSubiendo(false));
+      event.target.value = '';
     }
   };
 
@@ -239,19 +245,19 @@ const ControlOdometroForm = ({ onSubmit, initialData, isEditing, isReadOnly, sub
             multiple
             type="file"
             onChange={handleFileChange}
-            disabled={isReadOnly}
+            disabled={isReadOnly || subiendo}
           />
           <label htmlFor="foto-upload">
             <IconButton
               color="primary"
               aria-label="subir fotos"
               component="span"
-              disabled={isReadOnly}
+              disabled={isReadOnly || subiendo}
             >
-              <PhotoCameraIcon />
+              {subiendo ? <CircularProgress size={24} /> : <PhotoCameraIcon />}
             </IconButton>
             <Typography variant="body2" component="span" sx={{ ml: 1 }}>
-              Subir fotos (JPG/JPEG)
+              {subiendo ? 'Subiendo fotos...' : 'Subir fotos (JPG/JPEG)'}
             </Typography>
           </label>
         </Box>
@@ -309,7 +315,7 @@ const ControlOdometroForm = ({ onSubmit, initialData, isEditing, isReadOnly, sub
           variant="contained"
           color="success"
           onClick={handleSubmit}
-          disabled={isReadOnly || submitLoading}
+          disabled={isReadOnly || submitLoading || subiendo}
           startIcon={submitLoading ? <CircularProgress size={16} color="inherit" /> : null}
         >
           {submitLoading ? (isEditing ? 'Actualizando...' : 'Guardando...') : (isEditing ? 'Actualizar' : 'Guardar')}
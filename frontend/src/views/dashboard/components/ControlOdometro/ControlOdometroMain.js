@@ -10,6 +10,7 @@ import {
 } from '@mui/material';
 import ControlOdometroForm from './ControlOdometroForm';
 import ControlOdometroTable from './ControlOdometroTable';
+import { obtenerFotos } from '../adjuntos';
 import { useIsReadOnly, useUser } from 'src/components/UserContext.jsx';
 import { useCanCreate, useCanEdit, useCanDelete, useCanView, useIsPermissionDenied } from 'src/components/hooks';
 import BlockIcon from '@mui/icons-material/Block';
@@ -146,7 +147,7 @@ const ControlOdometroMain = ({ maquinariaId, maquinariaPlaca }) => {
     }
   };
 
-  const handleOpenEditForm = (control) => {
+  const handleOpenEditForm = async (control) => {
     // Solo el encargado puede editar
     if (!isEncargado) {
       setSnackbar({
@@ -156,8 +157,14 @@ const ControlOdometroMain = ({ maquinariaId, maquinariaPlaca }) => {
       });
       return;
     }
-    setEditingControl(control);
-    setShowForm(true);
+    try {
+      // El formulario reenvía las fotos al guardar: se cargan desde el detalle del registro
+      const fotos = await obtenerFotos(control, user?.Email);
+      setEditingControl({ ...control, fotos });
+      setShowForm(true);
+    } catch (error) {
+      setSnackbar({ open: true, message: 'Error al cargar las fotos del registro', severity: 'error' });
+    }
   };
 
   const handleResetForm = () => {
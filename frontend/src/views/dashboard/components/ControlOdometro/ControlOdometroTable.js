@@ -27,6 +27,7 @@ import VisibilityIcon from '@mui/icons-material/Visibility';
 import ZoomInIcon from '@mui/icons-material/ZoomIn';
 import DownloadIcon from '@mui/icons-material/Download';
 import { useState } from 'react';
+import { cantidadFotos, obtenerFotos } from '../adjuntos';
 
 const ControlOdometroTable = ({
   controlesOdometro,
@@ -39,18 +40,27 @@ const ControlOdometroTable = ({
   deleteLoading
 }) => {
   const [selectedFotos, setSelectedFotos] = useState([]);
+  const [selectedMiniaturas, setSelectedMiniaturas] = useState([]);
   const [fotosDialogOpen, setFotosDialogOpen] = useState(false);
   const [selectedFotoIndex, setSelectedFotoIndex] = useState(null);
   const [maximizeDialogOpen, setMaximizeDialogOpen] = useState(false);
 
-  const handleViewFotos = (fotos) => {
-    setSelectedFotos(fotos || []);
-    setFotosDialogOpen(true);
+  const handleViewFotos = async (control) => {
+    try {
+      setSelectedFotos(await obtenerFotos(control));
+      // La grilla usa las miniaturas; la foto completa se carga solo al maximizar o descargar
+      setSelectedMiniaturas(control.miniaturas || []);
+      setFotosDialogOpen(true);
+    } catch (error) {
+      console.error('Error obteniendo fotos:', error);
+      alert('Error al obtener las fotos');
+    }
   };
 
   const handleCloseFotosDialog = () => {
     setFotosDialogOpen(false);
     setSelectedFotos([]);
+    setSelectedMiniaturas([]);
   };
 
   const handleMaximizeFoto = (foto, index) => {
@@ -118,12 +128,12 @@ const ControlOdometroTable = ({
                 <TableCell>{control.odometro_final ? control.odometro_final.toLocaleString() : '-'}</TableCell>
                 <TableCell>{control.odometro_mes ? control.odometro_mes.toLocaleString() : '-'}</TableCell>
                 <TableCell>
-                  {control.fotos && control.fotos.length > 0 ? (
+                  {cantidadFotos(control) > 0 ? (
                     <Chip
-                      label={`${control.fotos.length} foto${control.fotos.length > 1 ? 's' : ''}`}
+                      label={`${cantidadFotos(control)} foto${cantidadFotos(control) > 1 ? 's' : ''}`}
                       color="primary"
                       size="small"
-                      onClick={() => handleViewFotos(control.fotos)}
+                      onClick={() => handleViewFotos(control)}
                       sx={{ cursor: 'pointer' }}
                     />
                   ) : (
@@ -134,10 +144,10 @@ const ControlOdometroTable = ({
                 </TableCell>
                 <TableCell>
                   <Box sx={{ display: 'flex', gap: 1 }}>
-                    {control.fotos && control.fotos.length > 0 && (
+                    {cantidadFotos(control) > 0 && (
                       <IconButton
                         size="small"
-                        onClick={() => handleViewFotos(control.fotos)}
+                        onClick={() => handleViewFotos(control)}
                         title="Ver fotos"
                       >
                         <VisibilityIcon />
@@ -194,7 +204,7 @@ const ControlOdometroTable = ({
                    <CardMedia
                      component="img"
                      height="200"
-                     image={foto}
+                     image={selectedMiniaturas[index] || foto}
                      alt={`Foto ${index + 1}`}
                      sx={{ objectFit: 'cover' }}
                    />
@@ -17,6 +17,7 @@ import BlockIcon from '@mui/icons-material/Block';
 import PictureAsPdfIcon from '@mui/icons-material/PictureAsPdf';
 import { useUser } from '../../../../components/UserContext';
 import PDFViewer from '../../../../components/PDFViewer';
+import { obtenerPdf, tieneArchivo } from '../adjuntos';
 
 const ITVTable = ({ itvs, onEdit, onDelete, loading, isReadOnly, canEdit = false, canDelete = false, deleteLoading = {} }) => {
   const { user } = useUser();
@@ -28,11 +29,17 @@ const ITVTable = ({ itvs, onEdit, onDelete, loading, isReadOnly, canEdit = false
   const [selectedPdfData, setSelectedPdfData] = useState(null);
   const [selectedFileName, setSelectedFileName] = useState('');
   
-  const handleViewPDF = (itv) => {
-    if (itv.archivo_pdf) {
-      setSelectedPdfData(itv.archivo_pdf);
-      setSelectedFileName(itv.nombre_archivo || 'itv.pdf');
-      setPdfViewerOpen(true);
+  const handleViewPDF = async (itv) => {
+    try {
+      const pdf = await obtenerPdf('itv', itv);
+      if (pdf) {
+        setSelectedPdfData(pdf);
+        setSelectedFileName(itv.nombre_archivo || 'itv.pdf');
+        setPdfViewerOpen(true);
+      }
+    } catch (error) {
+      console.error('Error obteniendo PDF:', error);
+      alert('Error al obtener el archivo PDF');
     }
   };
   
@@ -132,7 +139,7 @@ const ITVTable = ({ itvs, onEdit, onDelete, loading, isReadOnly, canEdit = false
           }}>
             <TableCell>{itv.gestion}</TableCell>
             <TableCell>
-              {itv.archivo_pdf ? (
+              {tieneArchivo(itv) ? (
                 <Tooltip title="Ver PDF">
                   <IconButton 
                     size="small" 
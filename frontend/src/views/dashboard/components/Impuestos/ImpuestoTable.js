@@ -8,6 +8,7 @@ import EditIcon from '@mui/icons-material/Edit';
 import PictureAsPdfIcon from '@mui/icons-material/PictureAsPdf';
 import BlockIcon from '@mui/icons-material/Block';
 import PDFViewer from '../../../../components/PDFViewer';
+import { obtenerPdf, tieneArchivo } from '../adjuntos';
 
 const ImpuestoTable = ({ 
   impuestos, 
@@ -25,11 +26,17 @@ const ImpuestoTable = ({
   const [selectedPdfData, setSelectedPdfData] = useState(null);
   const [selectedFileName, setSelectedFileName] = useState('');
   
-  const handleViewPDF = (impuesto) => {
-    if (impuesto.archivo_pdf) {
-      setSelectedPdfData(impuesto.archivo_pdf);
-      setSelectedFileName(impuesto.nombre_archivo || 'impuesto.pdf');
-      setPdfViewerOpen(true);
+  const handleViewPDF = async (impuesto) => {
+    try {
+      const pdf = await obtenerPdf('impuestos', impuesto);
+      if (pdf) {
+        setSelectedPdfData(pdf);
+        setSelectedFileName(impuesto.nombre_archivo || 'impuesto.pdf');
+        setPdfViewerOpen(true);
+      }
+    } catch (error) {
+      console.error('Error obteniendo PDF:', error);
+      alert('Error al obtener el archivo PDF');
     }
   };
   
@@ -109,7 +116,7 @@ const ImpuestoTable = ({
             }}>
               <TableCell>{impuesto.gestion}</TableCell>
               <TableCell>
-                {impuesto.archivo_pdf ? (
+                {tieneArchivo(impuesto) ? (
                   <Tooltip title="Ver PDF">
                     <IconButton 
                       size="small" 
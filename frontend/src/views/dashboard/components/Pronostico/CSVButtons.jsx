@@ -9,6 +9,7 @@ import {
   Typography,
   Alert,
   CircularProgress,
+  LinearProgress,
   List,
   ListItem,
   ListItemText,
@@ -26,11 +27,17 @@ import {
 import { useUser } from 'src/components/UserContext.jsx';
 import * as XLSX from 'xlsx';
 
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000/api';
+const INTERVALO_CONSULTA_MS = 2000;
+
+const esperar = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 const CSVButtons = ({ onDataUpdated }) => {
   const [uploadDialogOpen, setUploadDialogOpen] = useState(false);
   const [selectedFile, setSelectedFile] = useState(null);
   const [uploading, setUploading] = useState(false);
   const [uploadResults, setUploadResults] = useState(null);
+  const [progreso, setProgreso] = useState(null);
   const { user } = useUser();
   const permisosPronostico = user?.permisos?.['Pronóstico'] || {};
   const isAdmin = user?.Cargo?.toLowerCase() === 'admin';
@@ -55,14 +62,19 @@ const CSVButtons = ({ onDataUpdated }) => {
     formData.append('excel_file', selectedFile);
 
     try {
-      const response = await fetch(`${import.meta.env.VITE_API_URL || 'http://localhost:8000/api'}/pronostico/excel-upload/`, {
+      const response = await fetch(`${API_URL}/pronostico/excel-upload/`, {
         method: 'POST',
         body: formData,
       });
 
-      const result = await response.json();
+      let result = await response.json();
+
+      // Excel grande: el servidor lo procesa en segundo plano y se consulta su avance
+      if (response.status === 202) {
+        result = await esperarTrabajo(result.job_id);
+      }
 
-      if (response.ok) {
+      if (response.ok && !result.error) {
         setUploadResults(result);
         if (onDataUpdated) {
           onDataUpdated();
@@ -79,6 +91,25 @@ const CSVButtons = ({ onDataUpdated }) => {
       });
     } finally {
       setUploading(false);
+      setProgreso(null);
+    }
+  };
+
+  const esperarTrabajo = async (jobId) => {
+    for (;;) {
+      await esperar(INTERVALO_CONSULTA_MS);
+      const response = await fetch(`${API_URL}/pronostico/jobs/${jobId}/`);
+      const trabajo = await response.json();
+      if (!response.ok) {
+        return { error: trabajo.error || 'No se pudo consultar el avance de la carga' };
+      }
+      setProgreso(trabajo.progreso);
+      if (trabajo.estado === 'completado') {
+        return { ...trabajo, resultados: trabajo.errores_filas };
+      }
+      if (trabajo.estado === 'error') {
+        return { error: trabajo.error || 'Error al procesar el archivo Excel' };
+      }
     }
   };
 
@@ -275,6 +306,15 @@ const CSVButtons = ({ onDataUpdated }) => {
              )}
            </Box>
 
+          {uploading && progreso && (
+            <Box mt={2}>
+              <Typography variant="body2" mb={1}>
+                Procesando {progreso.procesadas} de {progreso.total_filas} filas...
+              </Typography>
+              <LinearProgress variant="determinate" value={progreso.porcentaje} />
+            </Box>
+          )}
+
           {uploadResults && (
             <Box mt={2}>
               {uploadResults.error ? (
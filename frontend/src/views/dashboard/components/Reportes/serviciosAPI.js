@@ -43,25 +43,25 @@ export async function fetchMantenimiento(maquinariaId) {
 }
 
 export async function fetchSOAT(maquinariaId) {
-  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/soat/`);
+  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/soat/?include=archivo`);
   if (!res.ok) return [];
   return await res.json();
 }
 
 export async function fetchSeguros(maquinariaId) {
-  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/seguros/`);
+  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/seguros/?include=archivo`);
   if (!res.ok) return [];
   return await res.json();
 }
 
 export async function fetchITV(maquinariaId) {
-  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/itv/`);
+  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/itv/?include=archivo`);
   if (!res.ok) return [];
   return await res.json();
 }
 
 export async function fetchImpuestos(maquinariaId) {
-  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/impuestos/`);
+  const res = await fetch(`${API_BASE}/maquinaria/${maquinariaId}/impuestos/?include=archivo`);
   if (!res.ok) return [];
   return await res.json();
 }
@@ -14,6 +14,7 @@ import AttachFileIcon from '@mui/icons-material/AttachFile';
 import DeleteIcon from '@mui/icons-material/Delete';
 import PictureAsPdfIcon from '@mui/icons-material/PictureAsPdf';
 import { useIsReadOnly, useUser } from '../../../../components/UserContext';
+import { tieneArchivo, subirArchivo } from '../adjuntos';
 
 const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading = false }) => {
   const [form, setForm] = useState({
@@ -24,6 +25,7 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
     ...initialData
   });
   const [errors, setErrors] = useState({});
+  const [subiendo, setSubiendo] = useState(false);
   const { user } = useUser();
   const isEncargado = user?.Cargo?.toLowerCase() === 'encargado';
   const isAdmin = user?.Cargo?.toLowerCase() === 'admin';
@@ -63,24 +65,29 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
         return;
       }
       
-      // Convertir archivo a base64
-      const reader = new FileReader();
-      reader.onload = (event) => {
-        setForm({
-          ...form,
-          archivo_pdf: event.target.result, // base64 string
-          nombre_archivo: file.name,
-          _remove_existing_file: false
-        });
-      };
-      reader.readAsDataURL(file);
+      // Se sube por partes a GridFS; el registro guarda solo la URL del archivo
+      setSubiendo(true);
+      subirArchivo(file, user?.Email)
+        .then((url) => {
+          setForm((prev) => ({
+            ...prev,
+            archivo_pdf: url,
+            nombre_archivo: file.name,
+            _remove_existing_file: false
+          }));
+        })
+        .catch((error) => {
+          console.error('Error al subir el PDF:', error);
+          alert('No se pudo subir el archivo. Intenta nuevamente.');
+        })
+        .finally(() => setSubiendo(false));
     } else if (file) {
       alert('Por favor selecciona un archivo PDF válido');
     }
   };
 
   const clearFile = () => {
-    if (isEditing && initialData?.archivo_pdf) {
+    if (isEditing && tieneArchivo(initialData)) {
       setForm({
         ...form,
         archivo_pdf: null,
@@ -169,9 +176,9 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
                 variant="outlined" 
                 component="span" 
                 startIcon={<AttachFileIcon />}
-                disabled={isReadOnly}
+                disabled={isReadOnly || subiendo}
               >
-                {isEditing ? 'Cambiar PDF' : 'Adjuntar PDF'}
+                {subiendo ? 'Subiendo PDF...' : (isEditing ? 'Cambiar PDF' : 'Adjuntar PDF')}
               </Button>
             </label>
             {(form.nombre_archivo || (isEditing && initialData?.nombre_archivo)) && (
@@ -181,7 +188,7 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
                   {form.nombre_archivo || initialData?.nombre_archivo}
                   {isEditing && !form.nombre_archivo && initialData?.nombre_archivo && ' (actual)'}
                 </Typography>
-                {(form.archivo_pdf || (isEditing && initialData?.archivo_pdf)) && (
+                {(form.archivo_pdf || (isEditing && tieneArchivo(initialData))) && (
                   <IconButton 
                     size="small" 
                     onClick={clearFile} 
@@ -193,7 +200,7 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
                 )}
               </Box>
             )}
-            {isEditing && initialData?.archivo_pdf && !form.nombre_archivo && (
+            {isEditing && tieneArchivo(initialData) && !form.nombre_archivo && (
               <Typography variant="caption" color="text.secondary">
                 (Manteniendo archivo actual)
               </Typography>
@@ -212,7 +219,7 @@ const SOATForm = ({ onSubmit, initialData, isEditing, isReadOnly, submitLoading
           type="submit"
           variant="contained" 
           color="success"
-          disabled={isReadOnly || submitLoading}
+          disabled={isReadOnly || submitLoading || subiendo}
           startIcon={submitLoading ? <CircularProgress size={16} color="inherit" /> : null}
         >
           {submitLoading ? (isEditing ? 'Actualizando...' : 'Guardando...') : (isEditing ? 'Actualizar' : 'Guardar')}
@@ -8,6 +8,7 @@ import EditIcon from '@mui/icons-material/Edit';
 import PictureAsPdfIcon from '@mui/icons-material/PictureAsPdf';
 import BlockIcon from '@mui/icons-material/Block';
 import PDFViewer from '../../../../components/PDFViewer';
+import { obtenerPdf, tieneArchivo } from '../adjuntos';
 const SOATTable = ({ 
   soats, 
   onEdit, 
@@ -24,11 +25,17 @@ const SOATTable = ({
   const [selectedPdfData, setSelectedPdfData] = useState(null);
   const [selectedFileName, setSelectedFileName] = useState('');
   
-  const handleViewPDF = (soat) => {
-    if (soat.archivo_pdf) {
-      setSelectedPdfData(soat.archivo_pdf);
-      setSelectedFileName(soat.nombre_archivo || 'soat.pdf');
-      setPdfViewerOpen(true);
+  const handleViewPDF = async (soat) => {
+    try {
+      const pdf = await obtenerPdf('soat', soat);
+      if (pdf) {
+        setSelectedPdfData(pdf);
+        setSelectedFileName(soat.nombre_archivo || 'soat.pdf');
+        setPdfViewerOpen(true);
+      }
+    } catch (error) {
+      console.error('Error obteniendo PDF:', error);
+      alert('Error al obtener el archivo PDF');
     }
   };
   
@@ -108,7 +115,7 @@ const SOATTable = ({
             }}>
               <TableCell>{soat.gestion}</TableCell>
               <TableCell>
-                {soat.archivo_pdf ? (
+                {tieneArchivo(soat) ? (
                   <Tooltip title="Ver PDF">
                     <IconButton 
                       size="small" 
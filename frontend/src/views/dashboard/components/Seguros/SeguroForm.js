@@ -13,6 +13,7 @@ import {
 import AttachFileIcon from '@mui/icons-material/AttachFile';
 import DeleteIcon from '@mui/icons-material/Delete';
 import { useIsReadOnly, useUser } from '../../../../components/UserContext';
+import { tieneArchivo, subirArchivo } from '../adjuntos';
 
 const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false }) => {
   const [form, setForm] = useState({
@@ -28,6 +29,7 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
     autorizado_por: '',
   });
   const [errors, setErrors] = useState({});
+  const [subiendo, setSubiendo] = useState(false);
   const isReadOnly = useIsReadOnly();
   const { user } = useUser();
   const isEncargado = user?.Cargo?.toLowerCase() === 'encargado';
@@ -83,16 +85,21 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
         return;
       }
       
-      // Convertir archivo a base64
-      const reader = new FileReader();
-      reader.onload = (e) => {
-        setForm({
-          ...form,
-          archivo_pdf: e.target.result, // base64 string
-          nombre_archivo: file.name
-        });
-      };
-      reader.readAsDataURL(file);
+      // Se sube por partes a GridFS; el registro guarda solo la URL del archivo
+      setSubiendo(true);
+      subirArchivo(file, user?.Email)
+        .then((url) => {
+          setForm((prev) => ({
+            ...prev,
+            archivo_pdf: url,
+            nombre_archivo: file.name
+          }));
+        })
+        .catch((error) => {
+          console.error('Error al subir el PDF:', error);
+          alert('No se pudo subir el archivo. Intenta nuevamente.');
+        })
+        .finally(() => setSubiendo(false));
     } else {
       alert('Por favor selecciona un archivo PDF válido');
     }
@@ -108,7 +115,7 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
 
   // Función para limpiar archivo en edición
   const clearFile = () => {
-    if (isEditing && initialData?.archivo_pdf) {
+    if (isEditing && tieneArchivo(initialData)) {
       // En edición, marcar que se quiere eliminar el archivo existente
       setForm({
         ...form,
@@ -198,9 +205,9 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
                   variant="outlined"
                   component="span"
                   startIcon={<AttachFileIcon />}
-                  disabled={isReadOnly}
+                  disabled={isReadOnly || subiendo}
                 >
-                  {isEditing ? 'Cambiar PDF' : 'Adjuntar PDF'}
+                  {subiendo ? 'Subiendo PDF...' : (isEditing ? 'Cambiar PDF' : 'Adjuntar PDF')}
                 </Button>
               </label>
               
@@ -211,7 +218,7 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
                     {form.nombre_archivo || initialData?.nombre_archivo}
                     {isEditing && !form.nombre_archivo && initialData?.nombre_archivo && ' (actual)'}
                   </Typography>
-                  {(form.archivo_pdf || (isEditing && initialData?.archivo_pdf)) && (
+                  {(form.archivo_pdf || (isEditing && tieneArchivo(initialData))) && (
                                          <IconButton
                        size="small"
                        onClick={clearFile}
@@ -225,7 +232,7 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
               )}
               
               {/* Información adicional en edición */}
-              {isEditing && initialData?.archivo_pdf && !form.archivo_pdf && (
+              {isEditing && tieneArchivo(initialData) && !form.archivo_pdf && (
                 <Typography variant="caption" color="text.secondary">
                   (Manteniendo archivo actual)
                 </Typography>
@@ -244,7 +251,7 @@ const SeguroForm = ({ onSubmit, initialData, isEditing, submitLoading = false })
             type="submit"
             variant="contained" 
             color="success"
-            disabled={submitLoading}
+            disabled={submitLoading || subiendo}
             startIcon={submitLoading ? <CircularProgress size={16} color="inherit" /> : null}
           >
             {submitLoading ? (isEditing ? 'Actualizando...' : 'Guardando...') : (isEditing ? 'Actualizar' : 'Guardar')}
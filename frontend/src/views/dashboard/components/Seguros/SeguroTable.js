@@ -18,6 +18,7 @@ import AttachFileIcon from '@mui/icons-material/AttachFile';
 import PictureAsPdfIcon from '@mui/icons-material/PictureAsPdf';
 import { useUser } from '../../../../components/UserContext';
 import PDFViewer from '../../../../components/PDFViewer';
+import { obtenerPdf, tieneArchivo } from '../adjuntos';
 
 const SeguroTable = ({ seguros, onEdit, onDelete, loading, isReadOnly, canEdit = false, canDelete = false, deleteLoading = {} }) => {
   const { user } = useUser();
@@ -29,11 +30,17 @@ const SeguroTable = ({ seguros, onEdit, onDelete, loading, isReadOnly, canEdit =
   const [selectedPdfData, setSelectedPdfData] = useState(null);
   const [selectedFileName, setSelectedFileName] = useState('');
   
-  const handleViewPDF = (seguro) => {
-    if (seguro.archivo_pdf) {
-      setSelectedPdfData(seguro.archivo_pdf);
-      setSelectedFileName(seguro.nombre_archivo || 'seguro.pdf');
-      setPdfViewerOpen(true);
+  const handleViewPDF = async (seguro) => {
+    try {
+      const pdf = await obtenerPdf('seguros', seguro);
+      if (pdf) {
+        setSelectedPdfData(pdf);
+        setSelectedFileName(seguro.nombre_archivo || 'seguro.pdf');
+        setPdfViewerOpen(true);
+      }
+    } catch (error) {
+      console.error('Error obteniendo PDF:', error);
+      alert('Error al obtener el archivo PDF');
     }
   };
   
@@ -144,7 +151,7 @@ const SeguroTable = ({ seguros, onEdit, onDelete, loading, isReadOnly, canEdit =
             <TableCell>{seguro.compania_aseguradora}</TableCell>
             <TableCell>{seguro.importe ? `Bs. ${seguro.importe}` : '-'}</TableCell>
             <TableCell>
-              {seguro.archivo_pdf ? (
+              {tieneArchivo(seguro) ? (
                 <Tooltip title="Ver PDF">
                   <IconButton 
                     size="small" 
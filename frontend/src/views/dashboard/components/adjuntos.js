@@ -0,0 +1,111 @@
+import API_CONFIG from '../../../config/api';
+
+// Los listados y el detalle traen solo los metadatos de los archivos (nombre, tamaño,
+// archivo_url, cantidad_fotos); el contenido se descarga desde archivo_url. Solo los
+// registros anteriores a GridFS traen el base64 en el detalle.
+export async function obtenerDetalleRegistro(seccion, registro, email) {
+  const response = await fetch(
+    `${API_CONFIG.API_URL}/maquinaria/${registro.maquinaria_id}/${seccion}/${registro._id}/`,
+    {
+      headers: {
+        'Content-Type': 'application/json',
+        'X-User-Email': email || ''
+      }
+    }
+  );
+  if (!response.ok) {
+    throw new Error('No se pudo obtener el registro');
+  }
+  return response.json();
+}
+
+export const tieneArchivo = (registro) =>
+  Boolean(registro.archivo_pdf || registro.archivo_url || registro.nombre_archivo);
+
+// Devuelve la URL de descarga o el base64 del PDF de un registro
+export async function obtenerPdf(seccion, registro, email) {
+  if (registro.archivo_url || registro.archivo_pdf) {
+    return registro.archivo_url || registro.archivo_pdf;
+  }
+  // Registro guardado antes de GridFS: el PDF sigue dentro del documento
+  const detalle = await obtenerDetalleRegistro(seccion, registro, email);
+  return detalle.archivo_url || detalle.archivo_pdf || null;
+}
+
+export const cantidadFotos = (registro) => registro.cantidad_fotos ?? (registro.fotos || []).length;
+
+// URLs de las fotos de un control de odómetro (el listado solo trae cantidad_fotos)
+export async function obtenerFotos(registro, email) {
+  if (Array.isArray(registro.fotos)) {
+    return registro.fotos;
+  }
+  const detalle = await obtenerDetalleRegistro('control-odometro', registro, email);
+  return detalle.fotos || [];
+}
+
+// Partes de 8 chunks de GridFS (255 KB c/u); el servidor indica el tamaño en `tamaño_parte`
+const CHUNKS_POR_PARTE = 8;
+const REINTENTOS = 5;
+
+const esperar = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+async function estadoSubida(url, email) {
+  const response = await fetch(url, { headers: { 'X-User-Email': email || '' } });
+  if (!response.ok) {
+    throw new Error('No se pudo consultar la subida');
+  }
+  return response.json();
+}
+
+// Sube un archivo por partes y devuelve su archivo_url. Si una parte falla (mala
+// conexión) se consulta cuánto llegó al servidor y se retoma desde ahí.
+export async function subirArchivo(file, email, onProgress) {
+  const inicio = await fetch(`${API_CONFIG.API_URL}/adjuntos/subidas/`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'X-User-Email': email || ''
+    },
+    body: JSON.stringify({ nombre: file.name, tamaño: file.size, tipo: file.type })
+  });
+  let subida = await inicio.json();
+  if (!inicio.ok) {
+    throw new Error(subida.error || 'No se pudo iniciar la subida');
+  }
+
+  const url = `${API_CONFIG.API_URL}/adjuntos/subidas/${subida.subida_id}/`;
+  const tamañoParte = subida.tamaño_parte * CHUNKS_POR_PARTE;
+  let fallos = 0;
+  while (!subida.completa) {
+    const desde = subida.recibido;
+    const hasta = Math.min(desde + tamañoParte, file.size);
+    try {
+      const response = await fetch(url, {
+        method: 'PUT',
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          'Content-Range': `bytes ${desde}-${hasta - 1}/${file.size}`,
+          'X-User-Email': email || ''
+        },
+        body: file.slice(desde, hasta)
+      });
+      const data = await response.json();
+      if (!response.ok && response.status !== 409) {
+        throw new Error(data.error || 'Error al subir el archivo');
+      }
+      subida = data;
+      fallos = 0;
+      if (onProgress) {
+        onProgress(Math.round((subida.recibido / file.size) * 100));
+      }
+    } catch (error) {
+      fallos += 1;
+      if (fallos > REINTENTOS) {
+        throw error;
+      }
+      await esperar(1000 * fallos);
+      subida = await estadoSubida(url, email);
+    }
+  }
+  return subida.archivo_url;
+}
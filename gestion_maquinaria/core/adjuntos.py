@@ -0,0 +1,755 @@
+"""
+Almacenamiento de adjuntos en GridFS.
+
+Los PDF de seguro/ITV/SOAT/impuesto y las fotos de control de odómetro se
+guardan en el bucket `adjuntos`; el registro solo conserva una referencia
+(`archivo_id` + metadatos) en lugar del base64 completo.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import mimetypes
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import gridfs
+from bson import Binary, ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.urls import reverse
+from rest_framework.exceptions import ParseError
+
+from .mongo_connection import get_db
+
+logger = logging.getLogger(__name__)
+
+BUCKET_ADJUNTOS = 'adjuntos'
+CAMPOS_ARCHIVO = ('nombre_archivo', 'tipo_archivo', 'tamaño_archivo', 'archivo_sha256')
+
+# Campo con el contenido pesado de cada colección; los listados lo excluyen salvo ?include=archivo
+CAMPO_CONTENIDO = {
+    'seguro': 'archivo_pdf',
+    'itv': 'archivo_pdf',
+    'soat': 'archivo_pdf',
+    'impuesto': 'archivo_pdf',
+    'control_odometro': 'fotos',
+}
+
+# Tamaño de chunk de GridFS; las subidas por partes deben venir en múltiplos de este tamaño
+TAMAÑO_CHUNK = gridfs.DEFAULT_CHUNK_SIZE
+# Veces que se reintenta sumarse a un archivo igual que otra petición guardó a la vez
+INTENTOS_DEDUPLICACION = 3
+TAMAÑO_MAXIMO = getattr(settings, 'ADJUNTO_MAX_BYTES', 20 * 1024 * 1024)
+
+# Campos de formulario multipart cuyos archivos se escriben directo en GridFS
+CAMPOS_SUBIDA = ('archivo_pdf', 'archivo', 'foto', 'fotos')
+
+_FIRMAS = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF8', 'image/gif'),
+)
+
+_DATA_URI = re.compile(r'^data:(?P<mime>[\w.+-]+/[\w.+-]+)?(?:;[\w=-]+)*;base64,', re.IGNORECASE)
+_REFERENCIA = re.compile(r'(?:^|/)adjuntos/(?P<id>[0-9a-fA-F]{24})/?(?:\?.*)?$')
+
+
+class AdjuntoInvalido(ValueError):
+    pass
+
+
+class AdjuntoRechazado(AdjuntoInvalido, ParseError):
+    """
+    Lo lanza GridFSUploadHandler mientras se lee el cuerpo del request. Las vistas que
+    atrapan AdjuntoInvalido responden su propio 400; en las demás DRF lo trata como un
+    ParseError (400) en lugar de un error interno.
+    """
+
+    def __init__(self, mensaje):
+        ParseError.__init__(self, {'error': mensaje})
+        self.args = (mensaje,)
+
+    def __str__(self):
+        return self.args[0]
+
+
+def get_bucket():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return gridfs.GridFSBucket(db, bucket_name=BUCKET_ADJUNTOS)
+
+
+def get_files_collection():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return db[f'{BUCKET_ADJUNTOS}.files']
+
+
+def referencia_de(valor):
+    """Si `valor` es la URL (o el id) de un adjunto ya guardado devuelve su ObjectId, si no None."""
+    if isinstance(valor, ObjectId):
+        return valor
+    if not isinstance(valor, str):
+        return None
+    if ObjectId.is_valid(valor):
+        return ObjectId(valor)
+    coincidencia = _REFERENCIA.search(valor.strip())
+    return ObjectId(coincidencia.group('id')) if coincidencia else None
+
+
+def decodificar_base64(valor):
+    """Devuelve (bytes, mime) de un data URI o base64 plano; mime es None si no viene en el prefijo."""
+    mime = None
+    coincidencia = _DATA_URI.match(valor)
+    if coincidencia:
+        mime = coincidencia.group('mime')
+        valor = valor[coincidencia.end():]
+    try:
+        return base64.b64decode(valor, validate=False), mime
+    except (binascii.Error, ValueError):
+        raise AdjuntoInvalido("El archivo no es un base64 válido")
+
+
+def detectar_mime(cabecera, declarado=None):
+    """Tipo real del archivo según sus primeros bytes; si no se reconoce, el declarado."""
+    for firma, mime in _FIRMAS:
+        if cabecera.startswith(firma):
+            return mime
+    if cabecera[:4] == b'RIFF' and cabecera[8:12] == b'WEBP':
+        return 'image/webp'
+    return declarado or 'application/octet-stream'
+
+
+def _referencia(archivo, nombre=None):
+    """Referencia que guarda el registro a partir del documento de files de GridFS."""
+    metadata = archivo.get('metadata') or {}
+    return {
+        'archivo_id': archivo['_id'],
+        'nombre_archivo': nombre or archivo.get('filename'),
+        'tipo_archivo': metadata.get('contentType'),
+        'tamaño_archivo': archivo.get('length'),
+        'archivo_sha256': metadata.get('sha256'),
+    }
+
+
+def _sumar_referencia(filtro):
+    """
+    Suma un registro a los que usan el archivo y devuelve su documento de files (None si no
+    hay uno utilizable). Los archivos anteriores al conteo no tienen `referencias`: valen 1.
+    Uno que ya llegó a 0 está por borrarse y no se reutiliza.
+    """
+    return get_files_collection().find_one_and_update(
+        {**filtro, 'metadata.pendiente': {'$ne': True}, 'metadata.variante_de': {'$exists': False},
+         'metadata.referencias': {'$not': {'$lte': 0}}},
+        [{'$set': {'metadata.referencias': {'$add': [{'$ifNull': ['$metadata.referencias', 1]}, 1]}}}],
+        # Primero el que ya lleva la cuenta (el del índice único sha256_unico)
+        sort=[('metadata.referencias', -1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _por_contenido(sha256, crear):
+    """
+    Suma una referencia al archivo con ese contenido o, si no hay, usa el que devuelve
+    `crear()`. El índice único parcial `sha256_unico` (crear_indices) impide que dos
+    peticiones que guardan lo mismo a la vez dejen dos archivos: la que pierde recibe
+    DuplicateKeyError (`crear` deshace lo suyo) y vuelve a intentar sumarse a la otra.
+    """
+    for _ in range(INTENTOS_DEDUPLICACION):
+        existente = _sumar_referencia({'metadata.sha256': sha256})
+        if existente:
+            return existente
+        try:
+            return crear()
+        except (DuplicateKeyError, gridfs.errors.FileExists):
+            # Si el que está en el índice llegó a 0 referencias, se termina de borrar
+            for muerto in get_files_collection().find(
+                    {'metadata.sha256': sha256, 'metadata.referencias': {'$lte': 0}}, {'_id': 1}):
+                _borrar_archivo(muerto['_id'], {'metadata.referencias': {'$lte': 0}})
+    raise DuplicateKeyError(f"No se pudo guardar el archivo {sha256}: conflicto con otra subida")
+
+
+def _borrar_archivo(archivo_id, condicion=None):
+    """Borra el archivo (documento de files y chunks) y sus variantes si sigue cumpliendo `condicion`."""
+    files = get_files_collection()
+    if not files.delete_one({'_id': archivo_id, **(condicion or {})}).deleted_count:
+        return False
+    chunks = get_db()[f'{BUCKET_ADJUNTOS}.chunks']
+    chunks.delete_many({'files_id': archivo_id})
+    # Versión recomprimida y miniaturas de las fotos (ver imagenes.py)
+    for variante in files.find({'metadata.variante_de': archivo_id}, {'_id': 1}):
+        files.delete_one({'_id': variante['_id']})
+        chunks.delete_many({'files_id': variante['_id']})
+    return True
+
+
+def guardar_adjunto(contenido, nombre=None, mime=None):
+    """
+    Guarda bytes en GridFS y devuelve la referencia que se almacena en el registro.
+    Si ya hay un archivo con el mismo SHA-256 se reutiliza (sumando una referencia).
+    """
+    sha256 = hashlib.sha256(contenido).hexdigest()
+    if not mime and nombre:
+        mime, _ = mimetypes.guess_type(nombre)
+    mime = detectar_mime(contenido[:16], mime)
+    nombre = nombre or f'adjunto{mimetypes.guess_extension(mime) or ""}'
+
+    def subir():
+        archivo_id = ObjectId()
+        metadata = {'contentType': mime, 'sha256': sha256, 'referencias': 1}
+        try:
+            get_bucket().upload_from_stream_with_id(archivo_id, nombre, contenido, metadata=metadata)
+        except (DuplicateKeyError, gridfs.errors.FileExists):
+            # Los chunks ya se escribieron; el documento de files es el que chocó
+            get_db()[f'{BUCKET_ADJUNTOS}.chunks'].delete_many({'files_id': archivo_id})
+            raise
+        return {'_id': archivo_id, 'filename': nombre, 'length': len(contenido), 'metadata': metadata}
+
+    return _referencia(_por_contenido(sha256, subir), nombre)
+
+
+def guardar_base64(valor, nombre=None, mime=None):
+    contenido, mime_uri = decodificar_base64(valor)
+    return guardar_adjunto(contenido, nombre, mime or mime_uri)
+
+
+def liberar_adjunto(archivo_id):
+    """Un registro deja de usar el archivo; se borra de GridFS cuando ya no lo usa ninguno."""
+    if not archivo_id:
+        return
+    archivo_id = ObjectId(archivo_id)
+    try:
+        archivo = get_files_collection().find_one_and_update(
+            {'_id': archivo_id}, {'$inc': {'metadata.referencias': -1}}, return_document=ReturnDocument.AFTER
+        )
+        if archivo and archivo['metadata']['referencias'] <= 0:
+            _borrar_archivo(archivo_id, {'metadata.referencias': {'$lte': 0}})
+    except Exception as e:
+        logger.warning(f"No se pudo liberar el adjunto {archivo_id}: {e}")
+
+
+def abrir_adjunto(archivo_id):
+    """GridOut del adjunto (lanza gridfs.errors.NoFile si no existe)."""
+    return get_bucket().open_download_stream(ObjectId(archivo_id))
+
+
+def leer_base64(archivo_id, mime=None):
+    """Contenido del adjunto como data URI (formato que espera el frontend para los PDF)."""
+    archivo = abrir_adjunto(archivo_id)
+    mime = mime or (archivo.metadata or {}).get('contentType') or 'application/octet-stream'
+    return f"data:{mime};base64,{base64.b64encode(archivo.read()).decode('ascii')}"
+
+
+def url_adjunto(archivo_id, request=None):
+    ruta = reverse('adjunto-descarga', kwargs={'archivo_id': str(archivo_id)})
+    return request.build_absolute_uri(ruta) if request is not None else ruta
+
+
+def url_miniatura(archivo_id, request=None):
+    return f"{url_adjunto(archivo_id, request)}?variante=miniatura"
+
+
+# --- Integración con los registros de las secciones ---
+
+def referencia_gridfs(archivo_id):
+    """
+    Referencia a un archivo ya subido a GridFS (por el upload handler, por partes o el de
+    otro registro) y suma el registro a los que lo usan. Si era una subida pendiente con el
+    mismo contenido que un archivo existente, se usa el existente y la subida se descarta.
+    """
+    files = get_files_collection()
+    archivo = files.find_one({'_id': archivo_id}, {'metadata': 1})
+    if not archivo:
+        raise AdjuntoInvalido(f"El adjunto {archivo_id} no existe")
+    metadata = archivo.get('metadata') or {}
+    adoptado = None
+    if metadata.get('pendiente'):
+        def adoptar():
+            # Con `referencias` entra al índice único: choca si otro ya tiene el mismo contenido
+            return files.find_one_and_update(
+                {'_id': archivo_id, 'metadata.pendiente': True},
+                {'$unset': {'metadata.pendiente': ''}, '$set': {'metadata.referencias': 1}},
+                return_document=ReturnDocument.AFTER,
+            )
+        adoptado = _por_contenido(metadata['sha256'], adoptar) if metadata.get('sha256') else adoptar()
+        if adoptado and adoptado['_id'] != archivo_id:
+            _borrar_archivo(archivo_id, {'metadata.pendiente': True})
+    if not adoptado:
+        adoptado = _sumar_referencia({'_id': archivo_id})
+    if not adoptado:
+        raise AdjuntoInvalido(f"El adjunto {archivo_id} no existe")
+    return _referencia(adoptado)
+
+
+def guardar_adjuntos_registro(datos, existente=None):
+    """
+    Reemplaza en `datos` (lo que se va a insertar o $set-ear) los archivos en base64 por
+    referencias a GridFS. Un `archivo_pdf` o una foto que ya es una referencia (URL de
+    descarga) se conserva; los adjuntos que el registro deja de usar se liberan.
+    """
+    existente = existente or {}
+
+    if 'archivo_pdf' in datos:
+        valor = datos.pop('archivo_pdf')
+        anterior_id = existente.get('archivo_id')
+        ref = None
+        archivo_id = referencia_de(valor) if valor else None
+        if archivo_id is not None:
+            # Archivo ya subido (upload handler o subida por partes) u otro registro del mismo archivo
+            if str(archivo_id) != str(anterior_id):
+                ref = referencia_gridfs(archivo_id)
+        elif valor:
+            contenido, mime = decodificar_base64(valor)
+            sha256 = hashlib.sha256(contenido).hexdigest()
+            # El frontend reenvía el mismo PDF al editar: no se vuelve a guardar
+            if not (anterior_id and existente.get('archivo_sha256') == sha256):
+                ref = guardar_adjunto(contenido, datos.get('nombre_archivo') or existente.get('nombre_archivo'),
+                                      mime or datos.get('tipo_archivo') or existente.get('tipo_archivo'))
+        if ref:
+            datos.update(ref)
+            if anterior_id:
+                liberar_adjunto(anterior_id)
+            if existente.get('archivo_pdf'):
+                # Registro anterior a GridFS: se vacía el base64 embebido
+                datos['archivo_pdf'] = None
+
+    if 'fotos' in datos and isinstance(datos['fotos'], list):
+        # Referencias que el registro ya tenía (cada una cuenta en `referencias` del archivo)
+        anteriores = {}
+        for foto in existente.get('fotos') or []:
+            if isinstance(foto, dict) and foto.get('archivo_id'):
+                anteriores.setdefault(str(foto['archivo_id']), []).append(foto)
+        fotos = []
+        nuevas = []
+        for i, foto in enumerate(datos['fotos']):
+            if not foto:
+                continue
+            archivo_id = referencia_de(foto.get('archivo_id') if isinstance(foto, dict) else foto)
+            if archivo_id is None:
+                nuevas.append(guardar_base64(foto, nombre=f'foto_odometro_{i + 1}.jpg'))
+                fotos.append(nuevas[-1])
+            elif anteriores.get(str(archivo_id)):
+                fotos.append(anteriores[str(archivo_id)].pop())
+            else:
+                nuevas.append(referencia_gridfs(archivo_id))
+                fotos.append(nuevas[-1])
+        for sobrantes in anteriores.values():
+            for foto in sobrantes:
+                liberar_adjunto(foto['archivo_id'])
+        datos['fotos'] = fotos
+        datos['cantidad_fotos'] = len(fotos)
+        if nuevas:
+            from .imagenes import encolar_imagenes
+            try:
+                encolar_imagenes([f['archivo_id'] for f in nuevas if (f.get('tipo_archivo') or '').startswith('image/')])
+            except Exception as e:
+                # Sin miniaturas la descarga sirve el original: no se frena el guardado
+                logger.warning(f"No se pudieron encolar las fotos para miniaturas: {e}")
+
+    return datos
+
+
+def liberar_adjuntos_registro(registro):
+    """Libera todos los adjuntos de un registro que se elimina permanentemente."""
+    if not registro:
+        return
+    if registro.get('archivo_id'):
+        liberar_adjunto(registro['archivo_id'])
+    for foto in registro.get('fotos') or []:
+        if isinstance(foto, dict):
+            liberar_adjunto(foto.get('archivo_id'))
+
+
+def hidratar_adjuntos(doc, request=None, incluir_contenido=False):
+    """
+    Prepara un registro ya serializado para la respuesta: agrega `archivo_url` y
+    convierte cada foto en su URL de descarga. Con `incluir_contenido` (?include=archivo)
+    también vuelve a leer el PDF de GridFS y lo incluye en base64 en `archivo_pdf`.
+    """
+    if not doc:
+        return doc
+    if doc.get('archivo_id'):
+        doc['archivo_url'] = url_adjunto(doc['archivo_id'], request)
+        if incluir_contenido:
+            try:
+                doc['archivo_pdf'] = leer_base64(doc['archivo_id'], doc.get('tipo_archivo'))
+            except Exception as e:
+                logger.warning(f"No se pudo leer el adjunto {doc['archivo_id']}: {e}")
+                doc['archivo_pdf'] = None
+    if isinstance(doc.get('fotos'), list):
+        doc['cantidad_fotos'] = len(doc['fotos'])
+        doc['miniaturas'] = [
+            url_miniatura(foto['archivo_id'], request)
+            for foto in doc['fotos'] if isinstance(foto, dict) and foto.get('archivo_id')
+        ]
+        doc['fotos'] = [
+            url_adjunto(foto['archivo_id'], request) if isinstance(foto, dict) and foto.get('archivo_id') else foto
+            for foto in doc['fotos']
+        ]
+    return doc
+
+
+def estadisticas_almacenamiento():
+    """
+    Espacio que ocupan los adjuntos en GridFS y lo que se ahorra por guardar una sola vez
+    los archivos repetidos (cada referencia extra es una copia que no se almacena).
+    """
+    resultado = list(get_files_collection().aggregate([
+        {'$match': {'metadata.pendiente': {'$ne': True}, 'metadata.variante_de': {'$exists': False}}},
+        {'$project': {
+            'length': 1,
+            'referencias': {'$max': [{'$ifNull': ['$metadata.referencias', 1]}, 0]},
+        }},
+        {'$group': {
+            '_id': None,
+            'archivos': {'$sum': 1},
+            'referencias': {'$sum': '$referencias'},
+            'bytes_almacenados': {'$sum': '$length'},
+            'bytes_referenciados': {'$sum': {'$multiply': ['$length', '$referencias']}},
+            'archivos_compartidos': {'$sum': {'$cond': [{'$gt': ['$referencias', 1]}, 1, 0]}},
+        }},
+    ]))
+    totales = resultado[0] if resultado else {
+        'archivos': 0, 'referencias': 0, 'bytes_almacenados': 0, 'bytes_referenciados': 0, 'archivos_compartidos': 0
+    }
+    totales.pop('_id', None)
+    totales['bytes_ahorrados'] = totales['bytes_referenciados'] - totales['bytes_almacenados']
+    totales['pendientes'] = get_files_collection().count_documents({'metadata.pendiente': True})
+    variantes = list(get_files_collection().aggregate([
+        {'$match': {'metadata.variante_de': {'$exists': True}}},
+        {'$group': {'_id': None, 'bytes': {'$sum': '$length'}}},
+    ]))
+    totales['bytes_variantes'] = variantes[0]['bytes'] if variantes else 0
+    return totales
+
+
+def proyeccion_sin_contenido(nombre_coleccion):
+    """Proyección de listado que deja afuera el campo pesado de la colección (None si no tiene)."""
+    campo = CAMPO_CONTENIDO.get(nombre_coleccion)
+    return {campo: 0} if campo else None
+
+
+def completar_fotos_listado(collection, docs):
+    """
+    Los listados no traen las fotos: se completan en una sola consulta la cantidad y los
+    ids de GridFS (con los que hidratar_adjuntos arma las URL de fotos y miniaturas). Los
+    registros con fotos todavía en base64 solo reciben `cantidad_fotos`.
+    """
+    if not docs:
+        return docs
+    resumen = {
+        r['_id']: r
+        for r in collection.aggregate([
+            {'$match': {'_id': {'$in': [doc['_id'] for doc in docs]}}},
+            # Solo el archivo_id de cada foto (null para las que siguen en base64)
+            {'$project': {
+                'cantidad_fotos': {'$cond': [{'$isArray': '$fotos'}, {'$size': '$fotos'}, 0]},
+                'ids': {'$map': {
+                    'input': {'$cond': [{'$isArray': '$fotos'}, '$fotos', []]},
+                    'in': '$$this.archivo_id',
+                }},
+            }},
+        ])
+    }
+    for doc in docs:
+        datos = resumen.get(doc['_id']) or {}
+        ids = datos.get('ids') or []
+        doc['cantidad_fotos'] = datos.get('cantidad_fotos', 0)
+        if len(ids) == doc['cantidad_fotos'] and all(ids):
+            doc['fotos'] = [{'archivo_id': archivo_id} for archivo_id in ids]
+    return docs
+
+
+# --- Subida en streaming (multipart) ---
+
+class ArchivoGridFS(UploadedFile):
+    """Archivo de request.FILES que ya quedó guardado en GridFS; `referencia` es lo que va al registro."""
+
+    def __init__(self, referencia, charset=None, content_type_extra=None):
+        super().__init__(
+            file=None,
+            name=referencia['nombre_archivo'],
+            content_type=referencia['tipo_archivo'],
+            size=referencia['tamaño_archivo'],
+            charset=charset,
+            content_type_extra=content_type_extra,
+        )
+        self.referencia = referencia
+
+    def open(self, mode=None):
+        self.file = abrir_adjunto(self.referencia['archivo_id'])
+        return self
+
+    def read(self, *args):
+        if self.file is None:
+            self.open()
+        return self.file.read(*args)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class GridFSUploadHandler(FileUploadHandler):
+    """
+    Escribe los archivos de los campos de adjuntos en GridFS a medida que llegan,
+    calculando tamaño, SHA-256 y el tipo real del contenido: la memoria usada no
+    depende del tamaño del archivo. Los demás campos (p. ej. el Excel de pronóstico)
+    siguen con los handlers por defecto. No está en FILE_UPLOAD_HANDLERS: lo instala
+    SubidaGridFSMixin en las vistas de secciones, después de autenticar.
+    """
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.grid_in = None
+        if field_name not in CAMPOS_SUBIDA:
+            return
+        if content_length and content_length > TAMAÑO_MAXIMO:
+            raise AdjuntoRechazado("El archivo supera el tamaño máximo permitido")
+        try:
+            self.grid_in = get_bucket().open_upload_stream(
+                file_name, chunk_size_bytes=TAMAÑO_CHUNK, metadata={'pendiente': True}
+            )
+        except Exception as e:
+            logger.warning(f"GridFS no disponible para la subida de {file_name}, se usa el handler por defecto: {e}")
+            return
+        self.sha256 = hashlib.sha256()
+        self.cabecera = b''
+        self.recibido = 0
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.grid_in is None:
+            return raw_data
+        self.recibido += len(raw_data)
+        if self.recibido > TAMAÑO_MAXIMO:
+            self.grid_in.abort()
+            self.grid_in = None
+            raise AdjuntoRechazado("El archivo supera el tamaño máximo permitido")
+        if len(self.cabecera) < 16:
+            self.cabecera += raw_data[:16 - len(self.cabecera)]
+        self.sha256.update(raw_data)
+        self.grid_in.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.grid_in is None:
+            return None
+        grid_in, self.grid_in = self.grid_in, None
+        mime = detectar_mime(self.cabecera, self.content_type)
+        sha256 = self.sha256.hexdigest()
+        # Antes de close() para que se escriba junto con el documento de files
+        grid_in.metadata = {'contentType': mime, 'sha256': sha256, 'pendiente': True}
+        grid_in.close()
+        return ArchivoGridFS({
+            'archivo_id': grid_in._id,
+            'nombre_archivo': self.file_name,
+            'tipo_archivo': mime,
+            'tamaño_archivo': file_size,
+            'archivo_sha256': sha256,
+        }, self.charset, self.content_type_extra)
+
+    def upload_interrupted(self):
+        if getattr(self, 'grid_in', None) is not None:
+            self.grid_in.abort()
+            self.grid_in = None
+
+
+class SubidaGridFSMixin:
+    """
+    Para las vistas (APIView) que reciben adjuntos en multipart: instala GridFSUploadHandler
+    una vez autenticado el request, así solo un usuario existente escribe en GridFS mientras
+    se lee el cuerpo. Sin usuario los archivos quedan en los handlers por defecto de Django.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in ('POST', 'PUT', 'PATCH') and getattr(request.user, 'is_authenticated', False):
+            request.upload_handlers.insert(0, GridFSUploadHandler(request._request))
+
+
+# --- Subidas por partes (reanudables) ---
+
+COLECCION_SUBIDAS = 'subidas_adjuntos'
+HORAS_VIGENCIA_SUBIDA = 24
+
+
+def get_subidas_collection():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return db[COLECCION_SUBIDAS]
+
+
+def iniciar_subida(nombre, tamaño, tipo=None):
+    """Registra una subida por partes; el archivo_id de GridFS se reserva desde el inicio."""
+    if not nombre:
+        raise AdjuntoInvalido("Falta el nombre del archivo")
+    if tamaño <= 0 or tamaño > TAMAÑO_MAXIMO:
+        raise AdjuntoInvalido(f"El tamaño debe estar entre 1 y {TAMAÑO_MAXIMO} bytes")
+    ahora = datetime.now()
+    subida = {
+        '_id': ObjectId(),
+        'archivo_id': ObjectId(),
+        'nombre': nombre,
+        'tipo': tipo,
+        'tamaño': tamaño,
+        'recibido': 0,
+        'completa': False,
+        'creado_en': ahora,
+        'expira_en': ahora + timedelta(hours=HORAS_VIGENCIA_SUBIDA),
+    }
+    get_subidas_collection().insert_one(subida)
+    return subida
+
+
+def obtener_subida(subida_id):
+    subida = get_subidas_collection().find_one({'_id': ObjectId(subida_id)})
+    if subida and subida['expira_en'] < datetime.now() and not subida['completa']:
+        return None
+    return subida
+
+
+def _leer_exacto(stream, cantidad):
+    """Lee hasta `cantidad` bytes (menos solo si la conexión se corta o termina el cuerpo)."""
+    partes = []
+    restante = cantidad
+    while restante > 0:
+        datos = stream.read(restante)
+        if not datos:
+            break
+        partes.append(datos)
+        restante -= len(datos)
+    return b''.join(partes)
+
+
+def recibir_parte(subida, inicio, stream, longitud):
+    """
+    Escribe una parte de la subida como chunks de GridFS, de a uno por vez.
+    `inicio` debe caer en un borde de chunk y no pasar de lo ya recibido (reenviar una
+    parte es válido). Si la conexión se corta a mitad, se conserva lo escrito en chunks
+    completos y el cliente retoma desde `recibido`.
+    """
+    if subida['completa']:
+        return subida
+    if inicio % TAMAÑO_CHUNK or inicio > subida['recibido']:
+        raise AdjuntoInvalido(f"La parte debe empezar en un múltiplo de {TAMAÑO_CHUNK} bytes y no después de {subida['recibido']}")
+    if inicio + longitud > subida['tamaño']:
+        raise AdjuntoInvalido("La parte excede el tamaño declarado del archivo")
+
+    chunks = get_db()[f'{BUCKET_ADJUNTOS}.chunks']
+    posicion = inicio
+    while posicion < inicio + longitud:
+        esperado = min(TAMAÑO_CHUNK, subida['tamaño'] - posicion, inicio + longitud - posicion)
+        datos = _leer_exacto(stream, esperado)
+        if len(datos) < esperado or (len(datos) < TAMAÑO_CHUNK and posicion + len(datos) < subida['tamaño']):
+            # Chunk incompleto: no se guarda
+            break
+        chunks.update_one(
+            {'files_id': subida['archivo_id'], 'n': posicion // TAMAÑO_CHUNK},
+            {'$set': {'data': Binary(datos)}},
+            upsert=True,
+        )
+        posicion += len(datos)
+
+    subida = get_subidas_collection().find_one_and_update(
+        {'_id': subida['_id']}, {'$max': {'recibido': posicion}}, return_document=ReturnDocument.AFTER
+    )
+    if subida['recibido'] >= subida['tamaño']:
+        subida = completar_subida(subida)
+    return subida
+
+
+def completar_subida(subida):
+    """Crea el documento de files de GridFS cuando llegaron todos los chunks (lectura de a un chunk)."""
+    chunks = get_db()[f'{BUCKET_ADJUNTOS}.chunks']
+    sha256 = hashlib.sha256()
+    cabecera = b''
+    total = 0
+    for n, chunk in enumerate(chunks.find({'files_id': subida['archivo_id']}, sort=[('n', 1)], batch_size=4)):
+        if chunk['n'] != n:
+            raise AdjuntoInvalido(f"Falta la parte {n} del archivo")
+        if not cabecera:
+            cabecera = bytes(chunk['data'][:16])
+        sha256.update(chunk['data'])
+        total += len(chunk['data'])
+    if total != subida['tamaño']:
+        raise AdjuntoInvalido("El archivo recibido no coincide con el tamaño declarado")
+
+    documento = {
+        '_id': subida['archivo_id'],
+        'length': total,
+        'chunkSize': TAMAÑO_CHUNK,
+        'uploadDate': datetime.utcnow(),
+        'filename': subida['nombre'],
+        'metadata': {
+            'contentType': detectar_mime(cabecera, subida.get('tipo')),
+            'sha256': sha256.hexdigest(),
+            'pendiente': True,
+        },
+    }
+    try:
+        get_files_collection().insert_one(documento)
+    except DuplicateKeyError:
+        # Otra petición (una parte reenviada) ya la completó
+        pass
+    return get_subidas_collection().find_one_and_update(
+        {'_id': subida['_id']}, {'$set': {'completa': True}}, return_document=ReturnDocument.AFTER
+    )
+
+
+def limpiar_pendientes(horas=HORAS_VIGENCIA_SUBIDA):
+    """
+    Borra los archivos subidos que nunca se asociaron a un registro y los chunks de
+    subidas por partes abandonadas. Devuelve (archivos, subidas) eliminados.
+    """
+    limite = datetime.utcnow() - timedelta(hours=horas)
+    archivos = 0
+    for archivo in get_files_collection().find({'metadata.pendiente': True, 'uploadDate': {'$lt': limite}}, {'_id': 1}):
+        if _borrar_archivo(archivo['_id'], {'metadata.pendiente': True}):
+            archivos += 1
+    subidas = 0
+    chunks = get_db()[f'{BUCKET_ADJUNTOS}.chunks']
+    for subida in get_subidas_collection().find({'expira_en': {'$lt': datetime.now()}}):
+        if not subida['completa']:
+            chunks.delete_many({'files_id': subida['archivo_id']})
+            subidas += 1
+        get_subidas_collection().delete_one({'_id': subida['_id']})
+    return archivos, subidas
+
+
+# Limpieza periódica: un hilo por proceso (también se puede correr `manage.py limpiar_adjuntos`)
+_limpieza = None
+_limpieza_lock = threading.Lock()
+
+
+def _ciclo_limpieza():
+    while True:
+        time.sleep(getattr(settings, 'ADJUNTOS_LIMPIEZA_HORAS', 1) * 3600)
+        try:
+            archivos, subidas = limpiar_pendientes()
+            if archivos or subidas:
+                logger.info(f"Limpieza de adjuntos: {archivos} archivos pendientes y {subidas} subidas vencidas")
+        except Exception as e:
+            # Sin base de datos se reintenta en el próximo ciclo
+            logger.warning(f"Limpieza de adjuntos: {e}")
+
+
+def programar_limpieza():
+    """Arranca (una vez por proceso) el hilo que borra los archivos que nunca se asociaron a un registro."""
+    global _limpieza
+    if not getattr(settings, 'ADJUNTOS_LIMPIEZA_EN_PROCESO', True):
+        return
+    with _limpieza_lock:
+        if _limpieza is None or not _limpieza.is_alive():
+            _limpieza = threading.Thread(target=_ciclo_limpieza, name='limpieza-adjuntos', daemon=True)
+            _limpieza.start()
@@ -0,0 +1,199 @@
+"""
+Registro de actividad (colección `seguimiento`) con escritura en lotes.
+
+`registrar_actividad` ya no hace un insert_one por evento dentro del request: el evento se
+deja en un buffer en memoria y un hilo del proceso lo guarda con insert_many cada
+AUDITORIA_LOTE eventos o cada AUDITORIA_INTERVALO_MS milisegundos, lo que ocurra primero.
+Antes de encolarlo, del detalle se quitan los datos pesados (imágenes y adjuntos en base64,
+bytes, textos muy largos): quedan su tamaño y un sha256 para poder compararlos.
+
+Si MongoDB no está disponible los eventos vuelven al buffer y se reintentan en el siguiente
+ciclo (se guardan como mucho AUDITORIA_BUFFER_MAX; si se llena se descartan los más
+antiguos). Al terminar el proceso se vacía el buffer.
+
+La lectura de `seguimiento` es eventualmente consistente: un evento aparece hasta
+AUDITORIA_INTERVALO_MS después de registrarse (más si MongoDB no está disponible). Las
+vistas no fuerzan el vaciado; para modificar un evento que puede seguir en el buffer está
+`actualizar_pendiente`.
+"""
+import atexit
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import deque
+
+from bson import Binary, ObjectId
+from django.conf import settings
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .models import Seguimiento
+from .mongo_connection import get_collection
+
+logger = logging.getLogger(__name__)
+
+_DATA_URI = re.compile(r'^data:[\w.+-]+/[\w.+-]+;base64,')
+_BASE64 = re.compile(r'^[A-Za-z0-9+/]+={0,2}$')
+_CLAVE_DUPLICADA = 11000
+
+
+def _resumen_binario(tipo, datos):
+    return {'omitido': tipo, 'bytes': len(datos), 'sha256': hashlib.sha256(datos).hexdigest()}
+
+
+def limpiar_detalle(valor, texto_max=None):
+    """
+    Copia del detalle sin datos pesados: base64 y bytes se reemplazan por su tamaño y sha256,
+    y los textos de más de AUDITORIA_TEXTO_MAX caracteres se recortan.
+    """
+    if texto_max is None:
+        texto_max = getattr(settings, 'AUDITORIA_TEXTO_MAX', 2048)
+    if isinstance(valor, dict):
+        return {k: limpiar_detalle(v, texto_max) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        return [limpiar_detalle(v, texto_max) for v in valor]
+    if isinstance(valor, (bytes, bytearray, Binary)):
+        return _resumen_binario('binario', bytes(valor))
+    if isinstance(valor, str) and len(valor) > texto_max:
+        if _DATA_URI.match(valor):
+            return _resumen_binario('base64', valor.encode('utf-8'))
+        if _BASE64.match(valor[:texto_max]) and _BASE64.match(valor):
+            return _resumen_binario('base64', valor.encode('utf-8'))
+        return valor[:texto_max] + f'… [{len(valor) - texto_max} caracteres omitidos]'
+    return valor
+
+
+class EscritorAuditoria:
+    """Buffer de eventos de `seguimiento` y el hilo que los guarda en lotes."""
+
+    def __init__(self):
+        self._pendientes = deque()
+        self._cond = threading.Condition()
+        self._vaciando = threading.Lock()
+        self._hilo = None
+        self._pid = None
+        self.guardados = 0
+        self.descartados = 0
+        self.lotes_fallidos = 0
+
+    def _lote(self):
+        return getattr(settings, 'AUDITORIA_LOTE', 100)
+
+    def _encolar(self, docs, al_frente=False):
+        maximo = getattr(settings, 'AUDITORIA_BUFFER_MAX', 10000)
+        with self._cond:
+            if al_frente:
+                self._pendientes.extendleft(reversed(docs))
+            else:
+                self._pendientes.extend(docs)
+            sobrantes = len(self._pendientes) - maximo
+            for _ in range(max(0, sobrantes)):
+                self._pendientes.popleft()
+            if sobrantes > 0:
+                self.descartados += sobrantes
+                logger.warning(f"Buffer de auditoría lleno: se descartaron {sobrantes} eventos antiguos")
+            if len(self._pendientes) >= self._lote():
+                self._cond.notify()
+
+    def registrar(self, doc):
+        if not getattr(settings, 'AUDITORIA_ASINCRONA', True):
+            get_collection(Seguimiento).insert_one(doc)
+            return
+        # El _id se asigna aquí para que reintentar un lote no duplique eventos
+        doc.setdefault('_id', ObjectId())
+        self._encolar([doc])
+        self._asegurar_hilo()
+
+    def actualizar_pendiente(self, condicion, cambios):
+        """
+        Aplica `cambios` al evento más reciente del buffer que cumple `condicion(doc)`. Devuelve
+        False si no está (ya se guardó, o se registró en otro proceso y llega con su lote).
+        """
+        with self._cond:
+            for doc in reversed(self._pendientes):
+                if condicion(doc):
+                    doc.update(cambios)
+                    return True
+        return False
+
+    def _asegurar_hilo(self):
+        """Arranca el hilo una vez por proceso (también en el hijo tras un fork)."""
+        if self._pid == os.getpid() and self._hilo.is_alive():
+            return
+        with self._cond:
+            if self._pid != os.getpid() or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._ciclo, name='auditoria', daemon=True)
+                self._hilo.start()
+                self._pid = os.getpid()
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                if len(self._pendientes) < self._lote():
+                    self._cond.wait(getattr(settings, 'AUDITORIA_INTERVALO_MS', 1000) / 1000)
+            try:
+                self.vaciar()
+            except Exception as e:
+                logger.error(f"Escritor de auditoría: {e}")
+
+    def vaciar(self):
+        """Guarda todo lo pendiente. Devuelve cuántos eventos se guardaron."""
+        guardados = 0
+        with self._vaciando:
+            while True:
+                with self._cond:
+                    lote = [self._pendientes.popleft()
+                            for _ in range(min(self._lote(), len(self._pendientes)))]
+                if not lote:
+                    return guardados
+                if not self._insertar(lote):
+                    self.lotes_fallidos += 1
+                    self._encolar(lote, al_frente=True)
+                    return guardados
+                guardados += len(lote)
+                self.guardados += len(lote)
+
+    def _insertar(self, lote):
+        try:
+            collection = get_collection(Seguimiento)
+            if collection is None:
+                raise ConnectionError("MongoDB no disponible")
+            collection.insert_many(lote, ordered=False)
+        except BulkWriteError as e:
+            # En un reintento, los eventos que ya se habían guardado dan clave duplicada
+            if all(err.get('code') == _CLAVE_DUPLICADA for err in e.details.get('writeErrors', [])):
+                return True
+            logger.warning(f"No se pudo guardar un lote de auditoría: {e}")
+            return False
+        except (PyMongoError, ConnectionError) as e:
+            logger.warning(f"No se pudo guardar un lote de auditoría ({len(lote)} eventos): {e}")
+            return False
+        return True
+
+    def reiniciar_despues_de_fork(self):
+        # Otro hilo pudo tener tomados los locks al momento del fork. Lo pendiente que se
+        # heredó puede guardarse dos veces: el _id repetido hace que el segundo no se inserte
+        self._cond = threading.Condition()
+        self._vaciando = threading.Lock()
+
+    def estadisticas(self):
+        return {
+            'pendientes': len(self._pendientes),
+            'guardados': self.guardados,
+            'descartados': self.descartados,
+            'lotes_fallidos': self.lotes_fallidos,
+        }
+
+
+escritor = EscritorAuditoria()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=escritor.reiniciar_despues_de_fork)
+
+
+@atexit.register
+def _vaciar_al_salir():
+    if escritor._pendientes:
+        logger.info(f"Guardando {len(escritor._pendientes)} eventos de auditoría pendientes")
+        escritor.vaciar()
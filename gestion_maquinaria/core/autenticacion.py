@@ -0,0 +1,57 @@
+"""
+Usuario autenticado de cada request.
+
+El frontend identifica al usuario con el header X-User-Email (fijado por el token de sesión,
+ver core/sesiones.py). `EmailHeaderAuthentication` lo resuelve una sola vez por request (DRF
+guarda el resultado en `request.user`): del token si lo hay y si no con la caché de usuarios
+de core/cache.py, que se vacía con `usuario_modificado()`.
+"""
+from pymongo.errors import PyMongoError
+from rest_framework.authentication import BaseAuthentication
+
+from .cache import obtener_usuario_por_email
+
+
+class UsuarioAutenticado(dict):
+    """Documento del usuario (sin Password) que queda en request.user; sirve para check_user_permissions."""
+    is_authenticated = True
+    is_anonymous = False
+
+    @property
+    def email(self):
+        return self.get('Email')
+
+
+class EmailHeaderAuthentication(BaseAuthentication):
+    """Autentica por X-User-Email. Sin header, o si el usuario no existe, el request queda anónimo."""
+
+    def authenticate(self, request):
+        # Con token de sesión válido el usuario ya viene resuelto (core/sesiones.py)
+        usuario = getattr(request, 'usuario_sesion', None)
+        if usuario is not None:
+            return (usuario, None)
+        email = request.headers.get('X-User-Email')
+        if not email:
+            return None
+        try:
+            usuario = obtener_usuario_por_email(email)
+        except (PyMongoError, ConnectionError):
+            # Sin base de datos la vista responde 503 por su cuenta
+            return None
+        if usuario is None:
+            return None
+        return (UsuarioAutenticado(usuario), None)
+
+
+def usuario_de_request(request, email=None):
+    """
+    Usuario que hace el request (o el de `email`, si se indica otro): reutiliza el que ya
+    resolvió la autenticación y si no lo busca en la caché. None si no existe.
+    """
+    email = email or request.headers.get('X-User-Email')
+    if not email:
+        return None
+    usuario = getattr(request, 'user', None)
+    if isinstance(usuario, UsuarioAutenticado) and usuario.email == email:
+        return usuario
+    return obtener_usuario_por_email(email)
@@ -0,0 +1,326 @@
+"""
+Cachés en memoria del proceso (TTL + tamaño acotado con expulsión LRU).
+
+Cada worker de gunicorn tiene su propia copia; el TTL acota cuánto tiempo
+puede quedar desactualizado un worker que no recibió la escritura.
+"""
+import copy
+import hashlib
+import json
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from bson import ObjectId
+from django.conf import settings
+
+from .mongo_connection import get_collection
+
+logger = logging.getLogger(__name__)
+
+_SIN_VALOR = object()
+_caches = []
+
+
+class TTLCache:
+    """Caché clave/valor con expiración por TTL, límite de entradas LRU y contadores."""
+
+    def __init__(self, maxsize=1024, ttl=300, nombre='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.nombre = nombre
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entrada = self._datos.get(key, _SIN_VALOR)
+            if entrada is _SIN_VALOR:
+                self.misses += 1
+                return default
+            valor, expira = entrada
+            if expira < time.monotonic():
+                del self._datos[key]
+                self.misses += 1
+                return default
+            self._datos.move_to_end(key)
+            self.hits += 1
+            return valor
+
+    def set(self, key, value):
+        with self._lock:
+            self._datos[key] = (value, time.monotonic() + self.ttl)
+            self._datos.move_to_end(key)
+            while len(self._datos) > self.maxsize:
+                self._datos.popitem(last=False)
+
+    def pop(self, key):
+        """Elimina la entrada y devuelve su valor (sin contar como hit/miss)."""
+        with self._lock:
+            entrada = self._datos.pop(key, None)
+            return entrada[0] if entrada else None
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'nombre': self.nombre,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'entradas': len(self._datos),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+            }
+
+
+# --- Caché de maquinarias: _id <-> placa <-> campos de resumen ---
+
+CAMPOS_RESUMEN_MAQUINARIA = ('placa', 'codigo', 'tipo', 'detalle', 'marca', 'modelo', 'unidad')
+_PROYECCION_RESUMEN = {campo: 1 for campo in CAMPOS_RESUMEN_MAQUINARIA}
+
+maquinaria_cache = TTLCache(
+    maxsize=getattr(settings, 'MAQUINARIA_CACHE_SIZE', 2048),
+    ttl=getattr(settings, 'MAQUINARIA_CACHE_TTL', 300),
+    nombre='maquinaria',
+)
+
+
+def _guardar_resumen(doc):
+    resumen = {campo: doc[campo] for campo in CAMPOS_RESUMEN_MAQUINARIA if campo in doc}
+    resumen['_id'] = doc['_id']
+    maquinaria_cache.set(('id', str(doc['_id'])), resumen)
+    if resumen.get('placa'):
+        maquinaria_cache.set(('placa', resumen['placa']), resumen)
+    return resumen
+
+
+def obtener_maquinarias(maquinaria_ids):
+    """
+    Devuelve {id_str: resumen} para los ids válidos que existen.
+    Los que no están en caché se buscan juntos con una sola consulta $in.
+    Propaga las excepciones de MongoDB para que el llamador decida qué mostrar.
+    """
+    resultado = {}
+    faltantes = {}
+    for maquinaria_id in maquinaria_ids:
+        if maquinaria_id is None or not ObjectId.is_valid(str(maquinaria_id)):
+            continue
+        clave = str(ObjectId(str(maquinaria_id)))
+        resumen = maquinaria_cache.get(('id', clave))
+        if resumen is not None:
+            resultado[clave] = dict(resumen)
+        else:
+            faltantes[clave] = ObjectId(clave)
+    if faltantes:
+        cursor = get_collection('maquinaria').find(
+            {"_id": {"$in": list(faltantes.values())}}, _PROYECCION_RESUMEN
+        )
+        for doc in cursor:
+            resultado[str(doc['_id'])] = dict(_guardar_resumen(doc))
+    return resultado
+
+
+def obtener_maquinaria(maquinaria_id):
+    """Resumen de una maquinaria por su _id (None si no existe o el id es inválido)."""
+    if maquinaria_id is None or not ObjectId.is_valid(str(maquinaria_id)):
+        return None
+    return obtener_maquinarias([maquinaria_id]).get(str(ObjectId(str(maquinaria_id))))
+
+
+def obtener_maquinaria_por_placa(placa):
+    """Resumen de una maquinaria por su placa (None si no existe)."""
+    if not placa:
+        return None
+    resumen = maquinaria_cache.get(('placa', placa))
+    if resumen is not None:
+        return dict(resumen)
+    doc = get_collection('maquinaria').find_one({'placa': placa}, _PROYECCION_RESUMEN)
+    if not doc:
+        return None
+    return dict(_guardar_resumen(doc))
+
+
+def obtener_maquinarias_por_placas(placas):
+    """
+    Devuelve {placa: resumen} de las placas que existen; las que no están en caché
+    se buscan juntas con una sola consulta $in.
+    """
+    resultado = {}
+    faltantes = set()
+    for placa in placas:
+        if not placa:
+            continue
+        resumen = maquinaria_cache.get(('placa', placa))
+        if resumen is not None:
+            resultado[placa] = dict(resumen)
+        else:
+            faltantes.add(placa)
+    if faltantes:
+        for doc in get_collection('maquinaria').find({'placa': {'$in': list(faltantes)}}, _PROYECCION_RESUMEN):
+            resultado[doc['placa']] = dict(_guardar_resumen(doc))
+    return resultado
+
+
+def invalidar_maquinaria(maquinaria_id=None, *placas):
+    """Elimina de la caché una maquinaria por _id y por cualquiera de sus placas (anterior o nueva)."""
+    placas = {p for p in placas if p}
+    if maquinaria_id is not None:
+        resumen = maquinaria_cache.pop(('id', str(maquinaria_id)))
+        if resumen and resumen.get('placa'):
+            placas.add(resumen['placa'])
+    for placa in placas:
+        maquinaria_cache.pop(('placa', placa))
+
+
+# --- Caché de usuarios por email (usuario autenticado de cada request) ---
+
+usuarios_cache = TTLCache(
+    maxsize=getattr(settings, 'USUARIOS_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'USUARIOS_CACHE_TTL', 30),
+    nombre='usuarios',
+)
+
+
+def obtener_usuario_por_email(email):
+    """
+    Documento del usuario con ese email, sin la contraseña (None si no existe).
+    Devuelve una copia: quien la recibe puede modificarla sin tocar la caché.
+    """
+    if not email:
+        return None
+    usuario = usuarios_cache.get(email)
+    if usuario is None:
+        collection = get_collection('usuarios')
+        if collection is None:
+            raise ConnectionError("MongoDB no disponible")
+        usuario = collection.find_one({'Email': email}, {'Password': 0})
+        if usuario is None:
+            return None
+        usuarios_cache.set(email, usuario)
+    return copy.deepcopy(usuario)
+
+
+def invalidar_usuarios():
+    """Vacía la caché de usuarios (tras crear, editar o borrar cualquier usuario)."""
+    usuarios_cache.clear()
+
+
+# --- Listas de opciones de los formularios (con ETag) ---
+
+class OpcionesCache:
+    """
+    Listas de valores distintos para los desplegables de los formularios. Se arman con un
+    $group por colección (la primera vez y cuando vence el TTL), se actualizan en memoria al
+    guardar un documento y se sirven ya ordenadas junto con su ETag.
+
+    `fuentes` es {coleccion: {opcion: campo}}; en lugar del campo puede ir una expresión de
+    agregación que lo normalice en el servidor (esas opciones no se actualizan con
+    `registrar`, se invalidan).
+    """
+
+    def __init__(self, fuentes, ttl=600, nombre='opciones'):
+        self.fuentes = fuentes
+        self.ttl = ttl
+        self.nombre = nombre
+        self._lock = threading.Lock()
+        self._valores = None
+        self._respuesta = None
+        self._etag = None
+        self._expira = 0.0
+        self.hits = 0
+        self.misses = 0
+        _caches.append(self)
+
+    def _vacias(self):
+        return {opcion: set() for campos in self.fuentes.values() for opcion in campos}
+
+    @staticmethod
+    def _normalizar(valor):
+        if valor is None:
+            return None
+        valor = str(valor)
+        return valor if valor.strip() else None
+
+    def _construir(self):
+        valores = self._vacias()
+        for coleccion, campos in self.fuentes.items():
+            collection = get_collection(coleccion)
+            if collection is None:
+                raise ConnectionError("MongoDB no disponible")
+            pipeline = [{'$group': {'_id': None, **{
+                opcion: {'$addToSet': f'${campo}' if isinstance(campo, str) else campo}
+                for opcion, campo in campos.items()
+            }}}]
+            for grupo in collection.aggregate(pipeline):
+                for opcion in campos:
+                    valores[opcion].update(v for v in map(self._normalizar, grupo.get(opcion, [])) if v)
+        return valores
+
+    def _publicar(self):
+        """Ordena las listas y recalcula el ETag (con el lock tomado)."""
+        self._respuesta = {opcion: sorted(lista) for opcion, lista in self._valores.items()}
+        firma = json.dumps(self._respuesta, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        self._etag = '"' + hashlib.sha1(firma).hexdigest() + '"'
+
+    def obtener(self):
+        """(opciones, etag). Lanza ConnectionError si hay que armarlas y MongoDB no responde."""
+        with self._lock:
+            if self._respuesta is not None and self._expira >= time.monotonic():
+                self.hits += 1
+                return self._respuesta, self._etag
+            self.misses += 1
+        valores = self._construir()
+        with self._lock:
+            self._valores = valores
+            self._expira = time.monotonic() + self.ttl
+            self._publicar()
+            return self._respuesta, self._etag
+
+    def registrar(self, coleccion, doc):
+        """Agrega a las listas los valores de un documento recién guardado en `coleccion`."""
+        campos = self.fuentes.get(coleccion)
+        if not campos or not doc:
+            return
+        with self._lock:
+            if self._valores is None:
+                return
+            cambio = False
+            for opcion, campo in campos.items():
+                if not isinstance(campo, str):
+                    continue
+                valor = self._normalizar(doc.get(campo))
+                if valor and valor not in self._valores[opcion]:
+                    self._valores[opcion].add(valor)
+                    cambio = True
+            if cambio:
+                self._publicar()
+
+    def invalidar(self):
+        with self._lock:
+            self._expira = 0.0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'nombre': self.nombre,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'entradas': sum(len(v) for v in (self._valores or {}).values()),
+                'ttl': self.ttl,
+            }
+
+
+def estadisticas_caches():
+    """Contadores de todas las cachés creadas en este proceso."""
+    return [cache.stats() for cache in _caches]
@@ -0,0 +1,131 @@
+"""
+Colas de trabajos guardadas en MongoDB y el worker que las procesa dentro del proceso.
+
+La usan los correos (correos.py), las fotos (imagenes.py) y las cargas de pronósticos
+(trabajos_pronostico.py); cada módulo solo aporta qué hacer con cada documento.
+
+Un documento de la cola tiene `estado` ('pendiente' mientras espera), `intentos` y
+`disponible_en`. `ColaMongo.tomar` lo reserva con find_one_and_update: pasa al estado de
+trabajo y queda bloqueado MINUTOS_BLOQUEO minutos; si el worker se cae a mitad de camino,
+otro lo retoma cuando vence el bloqueo. Si el procesamiento falla se reintenta con espera
+creciente (2 ** intentos minutos) hasta `max_intentos`, y después queda en estado 'error'.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from .mongo_connection import get_db
+
+logger = logging.getLogger(__name__)
+
+MINUTOS_BLOQUEO = 5
+SEGUNDOS_ESPERA_WORKER = 60
+
+
+class ColaMongo:
+    """Reserva, reintentos y borrado de los documentos de una colección usada como cola."""
+
+    def __init__(self, coleccion, estado_en_curso='procesando', max_intentos=3,
+                 minutos_bloqueo=MINUTOS_BLOQUEO, proyeccion=None):
+        self.coleccion = coleccion
+        self.estado_en_curso = estado_en_curso
+        self.max_intentos = max_intentos
+        self.minutos_bloqueo = minutos_bloqueo
+        self.proyeccion = proyeccion
+
+    def collection(self):
+        db = get_db()
+        if db is None:
+            raise ConnectionError("MongoDB no disponible")
+        return db[self.coleccion]
+
+    def tomar(self):
+        """Reserva el próximo documento pendiente (o uno cuyo worker dejó vencer el bloqueo)."""
+        ahora = datetime.now()
+        return self.collection().find_one_and_update(
+            {'$or': [
+                {'estado': 'pendiente', 'disponible_en': {'$lte': ahora}},
+                {'estado': self.estado_en_curso, 'bloqueado_hasta': {'$lt': ahora}},
+            ]},
+            {'$set': {'estado': self.estado_en_curso,
+                      'bloqueado_hasta': ahora + timedelta(minutes=self.minutos_bloqueo)},
+             '$inc': {'intentos': 1}},
+            sort=[('disponible_en', 1)],
+            projection=self.proyeccion,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def fallo(self, doc, error, definitivo=False):
+        """Vuelve a dejar el documento pendiente con espera creciente, o en 'error' si ya no se reintenta."""
+        if definitivo or doc['intentos'] >= self.max_intentos:
+            cambios = {'estado': 'error', 'error': str(error), 'terminado_en': datetime.now()}
+        else:
+            cambios = {'estado': 'pendiente',
+                       'disponible_en': datetime.now() + timedelta(minutes=2 ** doc['intentos'])}
+        self.collection().update_one({'_id': doc['_id']}, {'$set': cambios})
+
+    def procesar_pendientes(self, procesar, limite=None, borrar=True, sin_reintento=(), describir=None):
+        """
+        Toma documentos hasta vaciar la cola (o llegar a `limite`) y llama `procesar(doc)`.
+        Si devuelve algo verdadero cuenta como hecho (y con `borrar` se quita de la cola); una
+        excepción de `sin_reintento` lo deja en 'error' sin reintentar. Devuelve (hechos, errores).
+        """
+        hechos = errores = 0
+        while limite is None or hechos + errores < limite:
+            doc = self.tomar()
+            if not doc:
+                break
+            try:
+                if procesar(doc):
+                    if borrar:
+                        self.collection().delete_one({'_id': doc['_id']})
+                    hechos += 1
+            except Exception as e:
+                definitivo = isinstance(e, sin_reintento)
+                if not definitivo:
+                    logger.warning(f"Error al procesar {describir(doc) if describir else doc['_id']}: {e}")
+                self.fallo(doc, e, definitivo)
+                errores += 1
+        return hechos, errores
+
+
+class WorkerEnProceso:
+    """
+    Hilo del proceso web que llama `funcion` al despertarlo y, además, cada
+    SEGUNDOS_ESPERA_WORKER (reintentos y documentos que encolaron otros procesos).
+    `ajuste` es el setting que permite apagarlo cuando la cola la procesa un comando aparte.
+    """
+
+    def __init__(self, funcion, nombre, ajuste, segundos_espera=SEGUNDOS_ESPERA_WORKER):
+        self.funcion = funcion
+        self.nombre = nombre
+        self.ajuste = ajuste
+        self.segundos_espera = segundos_espera
+        self._despertar = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def _ciclo(self):
+        while True:
+            self._despertar.clear()
+            try:
+                self.funcion()
+            except (PyMongoError, ConnectionError) as e:
+                logger.warning(f"{self.nombre}: MongoDB no disponible: {e}")
+            except Exception as e:
+                logger.error(f"{self.nombre}: {e}")
+            self._despertar.wait(self.segundos_espera)
+
+    def despertar(self):
+        """Arranca (una vez por proceso) el hilo, o lo despierta si ya corre."""
+        if not getattr(settings, self.ajuste, True):
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._ciclo, name=self.nombre, daemon=True)
+                self._hilo.start()
+        self._despertar.set()
@@ -0,0 +1,119 @@
+"""
+Hash y verificación de contraseñas con bcrypt.
+
+bcrypt es lento a propósito (~0,25 s con costo 12), así que no se calcula en el hilo del
+request sin límite: todas las operaciones pasan por un pool de BCRYPT_HILOS hilos (bcrypt
+libera el GIL mientras calcula) y como mucho BCRYPT_COLA_MAX pueden estar en curso o
+esperando. Si una ráfaga de logins llena la cola, las siguientes esperan hasta
+BCRYPT_ESPERA_SEGUNDOS y luego reciben `ContrasenasSaturadas` (la vista responde 503) en
+lugar de ocupar todos los workers.
+
+El costo sale de BCRYPT_ROUNDS. Los hashes con otro costo se siguen verificando y
+`rehash_si_corresponde` los rehace en segundo plano después de un login correcto.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from django.conf import settings
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_pid = None
+_cola = None
+_pool_lock = threading.Lock()
+
+
+class ContrasenasSaturadas(Exception):
+    """Hay demasiadas operaciones de bcrypt en curso; conviene reintentar en unos segundos."""
+
+
+def costo():
+    return getattr(settings, 'BCRYPT_ROUNDS', 12)
+
+
+def _obtener_pool():
+    """Pool y semáforo del proceso (se vuelven a crear después de un fork: los hilos no se heredan)."""
+    global _pool, _pool_pid, _cola
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=getattr(settings, 'BCRYPT_HILOS', 2),
+                                           thread_name_prefix='bcrypt')
+                _cola = threading.BoundedSemaphore(getattr(settings, 'BCRYPT_COLA_MAX', 16))
+                _pool_pid = os.getpid()
+    return _pool, _cola
+
+
+def _enviar(funcion, *args):
+    """Ejecuta `funcion` en el pool; lanza ContrasenasSaturadas si no hay lugar en la cola."""
+    pool, cola = _obtener_pool()
+    if not cola.acquire(timeout=getattr(settings, 'BCRYPT_ESPERA_SEGUNDOS', 5)):
+        logger.warning("Cola de bcrypt llena, se rechaza la operación")
+        raise ContrasenasSaturadas()
+    try:
+        futuro = pool.submit(funcion, *args)
+    except BaseException:
+        cola.release()
+        raise
+    futuro.add_done_callback(lambda _: cola.release())
+    return futuro
+
+
+def _hashear(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=costo())).decode('utf-8')
+
+
+def _verificar(password, hash_guardado):
+    return bcrypt.checkpw(password.encode('utf-8'), hash_guardado.encode('utf-8'))
+
+
+def hashear(password):
+    """Hash bcrypt (str) de la contraseña con el costo configurado."""
+    return _enviar(_hashear, password).result()
+
+
+def verificar(password, hash_guardado):
+    """True si la contraseña corresponde al hash. Lanza ValueError si el hash no es de bcrypt."""
+    return _enviar(_verificar, password, hash_guardado or '').result()
+
+
+def costo_del_hash(hash_guardado):
+    # Formato: $2b$<costo>$<salt y hash>
+    try:
+        return int(hash_guardado.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def necesita_rehash(hash_guardado):
+    return costo_del_hash(hash_guardado) != costo()
+
+
+def rehash_si_corresponde(collection, user, password):
+    """
+    Tras un login correcto, si el hash del usuario tiene otro costo lo rehace en segundo plano.
+    Solo reemplaza el hash si sigue siendo el mismo (no pisa un cambio de contraseña simultáneo).
+    """
+    hash_anterior = user.get('Password')
+    if not necesita_rehash(hash_anterior):
+        return
+
+    def rehacer():
+        try:
+            collection.update_one(
+                {'_id': user['_id'], 'Password': hash_anterior},
+                {'$set': {'Password': _hashear(password)}},
+            )
+        except PyMongoError as e:
+            logger.warning(f"No se pudo actualizar el hash de {user.get('Email')}: {e}")
+
+    try:
+        _enviar(rehacer)
+    except ContrasenasSaturadas:
+        # Se reintenta en el próximo login
+        pass
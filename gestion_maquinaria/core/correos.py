@@ -0,0 +1,93 @@
+"""
+Cola de correos salientes.
+
+Las vistas no envían por SMTP dentro del request: `encolar_correo` guarda el mensaje en
+`cola_correos` (en tandas de hasta MAX_DESTINATARIOS destinatarios) y un worker (hilo del
+proceso o el comando `enviar_correos`) los envía todos por una sola conexión SMTP.
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from .colas import SEGUNDOS_ESPERA_WORKER, ColaMongo, WorkerEnProceso
+
+COLECCION_CORREOS = 'cola_correos'
+MAX_DESTINATARIOS = 50
+MAX_INTENTOS = 5
+
+cola = ColaMongo(COLECCION_CORREOS, estado_en_curso='enviando', max_intentos=MAX_INTENTOS)
+
+
+def get_cola_collection():
+    return cola.collection()
+
+
+def encolar_correo(asunto, html, destinatarios, texto='', remitente=None):
+    """Encola un correo HTML para los destinatarios (sin repetidos). Devuelve cuántos mensajes creó."""
+    destinatarios = list(dict.fromkeys(d for d in destinatarios if d))
+    if not destinatarios:
+        return 0
+    ahora = datetime.now()
+    mensajes = [{
+        'asunto': asunto,
+        'texto': texto,
+        'html': html,
+        'remitente': remitente or settings.DEFAULT_FROM_EMAIL,
+        'destinatarios': destinatarios[inicio:inicio + MAX_DESTINATARIOS],
+        'estado': 'pendiente',
+        'intentos': 0,
+        'disponible_en': ahora,
+        'creado_en': ahora,
+    } for inicio in range(0, len(destinatarios), MAX_DESTINATARIOS)]
+    get_cola_collection().insert_many(mensajes)
+    despertar_worker()
+    return len(mensajes)
+
+
+def tomar_correo():
+    return cola.tomar()
+
+
+def enviar_pendientes(limite=None):
+    """
+    Envía los correos de la cola por una misma conexión SMTP hasta vaciarla (o llegar a
+    `limite`). Devuelve (enviados, errores).
+    """
+    conexion = None
+
+    def enviar(correo):
+        nonlocal conexion
+        mensaje = EmailMultiAlternatives(correo['asunto'], correo.get('texto', ''),
+                                         correo.get('remitente'), correo['destinatarios'])
+        if correo.get('html'):
+            mensaje.attach_alternative(correo['html'], 'text/html')
+        try:
+            if conexion is None:
+                conexion = get_connection(fail_silently=False)
+                conexion.open()
+            conexion.send_messages([mensaje])
+        except Exception:
+            # La conexión puede haber quedado inválida: el próximo envío abre otra
+            if conexion is not None:
+                try:
+                    conexion.close()
+                except Exception:
+                    pass
+                conexion = None
+            raise
+        return True
+
+    try:
+        return cola.procesar_pendientes(enviar, limite, describir=lambda correo: f"el correo '{correo['asunto']}'")
+    finally:
+        if conexion is not None:
+            conexion.close()
+
+
+# Hilo dentro del proceso web (o el comando `enviar_correos` si CORREOS_WORKER_EN_PROCESO está apagado)
+worker = WorkerEnProceso(enviar_pendientes, 'worker-correos', 'CORREOS_WORKER_EN_PROCESO')
+
+
+def despertar_worker():
+    worker.despertar()
@@ -0,0 +1,201 @@
+"""
+Recompresión y miniaturas de las fotos de control de odómetro.
+
+Al guardar un registro las fotos nuevas se encolan en `cola_imagenes`; un worker fuera
+del request (hilo del proceso o el comando `procesar_imagenes`) guarda en GridFS una
+versión recomprimida de la foto y miniaturas WebP/JPEG como variantes del original.
+La descarga (`?variante=`) elige la variante y cae al original mientras no exista.
+"""
+import hashlib
+import io
+import logging
+from datetime import datetime
+
+import gridfs
+from django.conf import settings
+from pymongo.errors import DuplicateKeyError
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .adjuntos import abrir_adjunto, get_bucket, get_files_collection
+from .colas import SEGUNDOS_ESPERA_WORKER, ColaMongo, WorkerEnProceso
+
+logger = logging.getLogger(__name__)
+
+COLECCION_COLA = 'cola_imagenes'
+LADO_MAXIMO = getattr(settings, 'IMAGEN_LADO_MAXIMO', 1920)
+LADO_MINIATURA = getattr(settings, 'IMAGEN_LADO_MINIATURA', 320)
+CALIDAD = 82
+CALIDAD_MINIATURA = 70
+MAX_INTENTOS = 3
+
+
+class ImagenInvalida(ValueError):
+    pass
+
+
+cola = ColaMongo(COLECCION_COLA, max_intentos=MAX_INTENTOS)
+
+
+def get_cola_collection():
+    return cola.collection()
+
+
+# --- Procesamiento ---
+
+def _guardar_jpeg(imagen, calidad):
+    salida = io.BytesIO()
+    imagen.save(salida, 'JPEG', quality=calidad, optimize=True, progressive=True)
+    return salida.getvalue()
+
+
+def _guardar_webp(imagen, calidad):
+    salida = io.BytesIO()
+    imagen.save(salida, 'WEBP', quality=calidad, method=4)
+    return salida.getvalue()
+
+
+def generar_variantes(contenido):
+    """
+    Devuelve {variante: (bytes, mime)} a partir de la foto original: `completa` (solo si
+    recomprimida ocupa menos que el original), `miniatura_webp` y `miniatura_jpeg`.
+    """
+    try:
+        with Image.open(io.BytesIO(contenido)) as original:
+            imagen = ImageOps.exif_transpose(original)
+            if imagen.mode != 'RGB':
+                imagen = imagen.convert('RGB')
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ImagenInvalida(f"No es una imagen válida: {e}")
+
+    variantes = {}
+    completa = imagen.copy()
+    completa.thumbnail((LADO_MAXIMO, LADO_MAXIMO), Image.LANCZOS)
+    recomprimida = _guardar_jpeg(completa, CALIDAD)
+    if len(recomprimida) < len(contenido):
+        variantes['completa'] = (recomprimida, 'image/jpeg')
+
+    miniatura = imagen.copy()
+    miniatura.thumbnail((LADO_MINIATURA, LADO_MINIATURA), Image.LANCZOS)
+    variantes['miniatura_webp'] = (_guardar_webp(miniatura, CALIDAD_MINIATURA), 'image/webp')
+    variantes['miniatura_jpeg'] = (_guardar_jpeg(miniatura, CALIDAD_MINIATURA), 'image/jpeg')
+    return variantes
+
+
+def procesar_imagen(archivo_id):
+    """Genera y guarda las variantes de una foto de GridFS. False si la foto ya no existe."""
+    try:
+        archivo = abrir_adjunto(archivo_id)
+    except gridfs.errors.NoFile:
+        return False
+    metadata = archivo.metadata or {}
+    if metadata.get('variantes') or metadata.get('variante_de'):
+        archivo.close()
+        return True
+    contenido = archivo.read()
+    nombre = archivo.filename or str(archivo_id)
+    archivo.close()
+
+    bucket = get_bucket()
+    ids = {}
+    for variante, (datos, mime) in generar_variantes(contenido).items():
+        ids[variante] = bucket.upload_from_stream(
+            f'{variante}_{nombre}', datos,
+            metadata={
+                'contentType': mime,
+                'sha256': hashlib.sha256(datos).hexdigest(),
+                'variante_de': archivo_id,
+                'variante': variante,
+            },
+        )
+    actualizado = get_files_collection().update_one(
+        {'_id': archivo_id, 'metadata.variantes': {'$exists': False}},
+        {'$set': {'metadata.variantes': ids}},
+    )
+    if not actualizado.matched_count:
+        # El original se borró (o ya lo procesó otro worker) mientras se generaban
+        for variante_id in ids.values():
+            bucket.delete(variante_id)
+    return True
+
+
+def elegir_variante(archivo_id, variante=None, accept=''):
+    """
+    Id del archivo a descargar: `miniatura` (WebP si el navegador lo acepta, si no JPEG),
+    `original`, o por defecto la versión recomprimida. Sin variantes, el original.
+    """
+    if variante == 'original':
+        return archivo_id
+    archivo = get_files_collection().find_one({'_id': archivo_id}, {'metadata.variantes': 1})
+    variantes = ((archivo or {}).get('metadata') or {}).get('variantes') or {}
+    if variante == 'miniatura':
+        preferidas = ['miniatura_webp', 'miniatura_jpeg'] if 'image/webp' in accept else ['miniatura_jpeg']
+    else:
+        preferidas = []
+    for nombre in preferidas + ['completa']:
+        if variantes.get(nombre):
+            return variantes[nombre]
+    return archivo_id
+
+
+# --- Cola ---
+
+def encolar_imagenes(archivo_ids):
+    """Agrega fotos a la cola (una sola vez por archivo) y despierta al worker del proceso."""
+    cola = get_cola_collection()
+    ahora = datetime.now()
+    encoladas = 0
+    for archivo_id in archivo_ids:
+        try:
+            resultado = cola.update_one(
+                {'archivo_id': archivo_id},
+                {'$setOnInsert': {
+                    'archivo_id': archivo_id,
+                    'estado': 'pendiente',
+                    'intentos': 0,
+                    'disponible_en': ahora,
+                    'creado_en': ahora,
+                }},
+                upsert=True,
+            )
+            encoladas += 1 if resultado.upserted_id else 0
+        except DuplicateKeyError:
+            pass
+    if encoladas:
+        despertar_worker()
+    return encoladas
+
+
+def tomar_trabajo():
+    return cola.tomar()
+
+
+def procesar_cola(limite=None):
+    """Procesa trabajos hasta vaciar la cola (o llegar a `limite`). Devuelve (procesadas, errores)."""
+    def procesar(trabajo):
+        procesar_imagen(trabajo['archivo_id'])
+        return True
+
+    # Una foto que no se puede abrir no mejora reintentando
+    return cola.procesar_pendientes(procesar, limite, sin_reintento=(ImagenInvalida,),
+                                    describir=lambda trabajo: f"la imagen {trabajo['archivo_id']}")
+
+
+def encolar_sin_procesar():
+    """Encola las fotos ya guardadas en GridFS que todavía no tienen variantes."""
+    ids = [
+        archivo['_id'] for archivo in get_files_collection().find({
+            'metadata.contentType': {'$regex': '^image/'},
+            'metadata.variantes': {'$exists': False},
+            'metadata.variante_de': {'$exists': False},
+            'metadata.pendiente': {'$ne': True},
+        }, {'_id': 1})
+    ]
+    return encolar_imagenes(ids)
+
+
+# Hilo dentro del proceso web (o el comando `procesar_imagenes` si IMAGENES_WORKER_EN_PROCESO está apagado)
+worker = WorkerEnProceso(procesar_cola, 'worker-imagenes', 'IMAGENES_WORKER_EN_PROCESO')
+
+
+def despertar_worker():
+    worker.despertar()
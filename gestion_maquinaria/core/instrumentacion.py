@@ -0,0 +1,152 @@
+"""
+Instrumentación de las consultas a MongoDB.
+
+`ComandosListener` (CommandListener de pymongo, registrado en el cliente de
+core/mongo_connection.py) mide cada comando que se envía al servidor. Durante un request,
+`InstrumentacionMongoMiddleware` junta esas mediciones y al final agrega el header
+`Server-Timing` (visible en las herramientas de desarrollo del navegador) y deja una línea
+de log en JSON con la cantidad de comandos, el tiempo total, el comando más lento y las
+colecciones consultadas: muchos comandos en un solo request delatan consultas N+1.
+
+Con MONGO_CONSULTA_LENTA_MS > 0 también se registran los comandos que tardan más que ese
+umbral, dentro o fuera de un request (workers, comandos de manage.py).
+"""
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Mediciones del request en curso (None fuera de un request)
+_consultas_request = ContextVar('consultas_mongo', default=None)
+
+
+class ConsultasRequest:
+    """Comandos de MongoDB enviados durante un request."""
+
+    def __init__(self):
+        self.cantidad = 0
+        self.fallidos = 0
+        self.total_ms = 0.0
+        self.mas_lento = None
+        self.por_coleccion = {}
+
+    def registrar(self, comando, coleccion, duracion_ms, fallo=False):
+        self.cantidad += 1
+        self.fallidos += fallo
+        self.total_ms += duracion_ms
+        if coleccion:
+            self.por_coleccion[coleccion] = self.por_coleccion.get(coleccion, 0) + 1
+        if self.mas_lento is None or duracion_ms > self.mas_lento['ms']:
+            self.mas_lento = {'comando': comando, 'coleccion': coleccion, 'ms': round(duracion_ms, 2)}
+
+    def resumen(self):
+        return {
+            'comandos': self.cantidad,
+            'fallidos': self.fallidos,
+            'total_ms': round(self.total_ms, 2),
+            'mas_lento': self.mas_lento,
+            'colecciones': self.por_coleccion,
+        }
+
+
+def _coleccion(comando, nombre_comando):
+    """Colección a la que apunta un comando (find, insert, aggregate, getMore, ...)."""
+    if nombre_comando == 'getMore':
+        valor = comando.get('collection')
+    else:
+        valor = comando.get(nombre_comando)
+    return valor if isinstance(valor, str) else None
+
+
+class ComandosListener(monitoring.CommandListener):
+    """
+    Los eventos de pymongo se publican en el hilo que ejecuta el comando, así que el
+    request en curso se obtiene del contexto y los comandos en vuelo se guardan por hilo.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _en_vuelo(self):
+        if not hasattr(self._local, 'comandos'):
+            self._local.comandos = {}
+        return self._local.comandos
+
+    def started(self, event):
+        self._en_vuelo()[event.request_id] = _coleccion(event.command, event.command_name)
+
+    def succeeded(self, event):
+        self._terminar(event, fallo=False)
+
+    def failed(self, event):
+        self._terminar(event, fallo=True)
+
+    def _terminar(self, event, fallo):
+        coleccion = self._en_vuelo().pop(event.request_id, None)
+        duracion_ms = event.duration_micros / 1000
+        consultas = _consultas_request.get()
+        if consultas is not None:
+            consultas.registrar(event.command_name, coleccion, duracion_ms, fallo)
+        umbral = getattr(settings, 'MONGO_CONSULTA_LENTA_MS', 0)
+        if umbral and duracion_ms >= umbral:
+            logger.warning(json.dumps({
+                'evento': 'consulta_lenta_mongo',
+                'comando': event.command_name,
+                'coleccion': coleccion,
+                'ms': round(duracion_ms, 2),
+                'fallo': fallo,
+                'servidor': '%s:%s' % event.connection_id,
+            }))
+
+
+comandos_listener = ComandosListener()
+
+
+def _valor_header(texto):
+    # Los desc de Server-Timing van entre comillas
+    return str(texto).replace('"', "'").replace('\\', '/')
+
+
+class InstrumentacionMongoMiddleware:
+    """Agrega Server-Timing y un log estructurado con las consultas a MongoDB de cada request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not getattr(settings, 'MONGO_INSTRUMENTACION', True):
+            return self.get_response(request)
+
+        consultas = ConsultasRequest()
+        token = _consultas_request.set(consultas)
+        inicio = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _consultas_request.reset(token)
+        total_request_ms = (time.perf_counter() - inicio) * 1000
+
+        metricas = [f'mongo;dur={consultas.total_ms:.1f};desc="{consultas.cantidad} comandos"']
+        if consultas.mas_lento:
+            lento = consultas.mas_lento
+            metricas.append(f'mongo-lento;dur={lento["ms"]:.1f};'
+                            f'desc="{_valor_header(lento["comando"])} {_valor_header(lento["coleccion"] or "")}"')
+        metricas.append(f'app;dur={total_request_ms:.1f}')
+        response['Server-Timing'] = ', '.join(metricas)
+
+        if consultas.cantidad:
+            logger.info(json.dumps(dict(
+                consultas.resumen(),
+                evento='consultas_mongo_request',
+                metodo=request.method,
+                ruta=request.path,
+                status=response.status_code,
+                request_ms=round(total_request_ms, 2),
+            )))
+        return response
@@ -0,0 +1,184 @@
+from django.core.management.base import BaseCommand
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+from core.mongo_connection import get_collection
+from core.adjuntos import BUCKET_ADJUNTOS, COLECCION_SUBIDAS
+from core.correos import COLECCION_CORREOS
+from core.imagenes import COLECCION_COLA
+from core.recordatorios import COLECCION_ENVIADOS
+from core.sesiones import COLECCION_REVOCADAS
+from core.trabajos_pronostico import COLECCION_LOTES, COLECCION_TRABAJOS
+from core.models import (
+    Maquinaria, HistorialControl, ActaAsignacion, Liberacion, Mantenimiento, Seguro, ITV, SOAT,
+    Impuesto, Usuario, VerificacionRegistro, Depreciacion, Activo, Pronostico, Seguimiento, ControlOdometro
+)
+
+# Las vistas de control y asignación escriben en estas colecciones, no en las de models.py
+COLECCIONES_SECCION_VISTAS = ['historial_control', 'acta_asignacion']
+
+# Las verificaciones caducan a los 15 minutos; el TTL solo limpia las que ya vencieron
+SEGUNDOS_GRACIA_VERIFICACION = 3600
+# Los trabajos de pronóstico terminados se pueden consultar durante una semana
+SEGUNDOS_RETENCION_TRABAJOS = 7 * 24 * 3600
+# Registro de recordatorios enviados: basta con que dure más que la anticipación del aviso
+SEGUNDOS_RETENCION_RECORDATORIOS = 90 * 24 * 3600
+
+
+def indices_por_maquinaria():
+    """Índices de las colecciones que se listan por maquinaria (solo registros activos)."""
+    return [
+        IndexModel([('maquinaria', ASCENDING), ('activo', ASCENDING), ('_id', ASCENDING)], name='maquinaria_activo_id'),
+        IndexModel([('maquinaria', ASCENDING), ('fecha_creacion', DESCENDING), ('_id', DESCENDING)], name='maquinaria_fecha_creacion'),
+    ]
+
+
+def indices_verificacion():
+    return [
+        IndexModel([('Email', ASCENDING)], name='email'),
+        IndexModel([('expira_en', ASCENDING)], name='expira_en_ttl', expireAfterSeconds=SEGUNDOS_GRACIA_VERIFICACION),
+    ]
+
+
+INDICES = {
+    Maquinaria.collection_name: [
+        IndexModel([('placa', ASCENDING)], name='placa_unica', unique=True,
+                   partialFilterExpression={'placa': {'$type': 'string'}}),
+        IndexModel([('activo', ASCENDING)], name='activo'),
+    ],
+    Usuario.collection_name: [
+        IndexModel([('Email', ASCENDING)], name='email_unico', unique=True,
+                   partialFilterExpression={'Email': {'$type': 'string'}}),
+        IndexModel([('Cargo', ASCENDING)], name='cargo'),
+    ],
+    VerificacionRegistro.collection_name: indices_verificacion(),
+    'verificaciones_reset': indices_verificacion(),
+    Seguimiento.collection_name: [
+        IndexModel([('fecha_hora', DESCENDING)], name='fecha_hora'),
+        IndexModel([('usuario_email', ASCENDING), ('accion', ASCENDING), ('fecha_hora', DESCENDING)], name='usuario_accion_fecha'),
+    ],
+    Pronostico.collection_name: [
+        IndexModel([('placa', ASCENDING), ('fecha_asig', ASCENDING)], name='placa_fecha_asig'),
+        IndexModel([('riesgo', ASCENDING)], name='riesgo'),
+        # Rango de fechas de enviar_recordatorios_mantenimiento
+        IndexModel([('fecha_mantenimiento', ASCENDING)], name='fecha_mantenimiento'),
+        IndexModel([('fecha_recordatorio', ASCENDING)], name='fecha_recordatorio'),
+    ],
+    Activo.collection_name: [],
+    # Archivos subidos pero todavía no asociados a un registro (los barre limpiar_adjuntos)
+    f'{BUCKET_ADJUNTOS}.files': [
+        IndexModel([('metadata.pendiente', ASCENDING), ('uploadDate', ASCENDING)], name='pendiente_fecha',
+                   partialFilterExpression={'metadata.pendiente': True}),
+        # Deduplicación: un archivo con el mismo contenido se reutiliza
+        IndexModel([('metadata.sha256', ASCENDING)], name='sha256'),
+        # Un solo archivo con referencias por contenido (subidas pendientes, variantes y archivos
+        # anteriores al conteo no lo tienen). Si falla por duplicados, quedan de antes de la
+        # deduplicación: hay que unificar esos registros antes de crearlo
+        IndexModel([('metadata.sha256', ASCENDING)], name='sha256_unico', unique=True,
+                   partialFilterExpression={'metadata.referencias': {'$exists': True}}),
+        IndexModel([('metadata.variante_de', ASCENDING)], name='variante_de',
+                   partialFilterExpression={'metadata.variante_de': {'$exists': True}}),
+    ],
+    COLECCION_COLA: [
+        IndexModel([('archivo_id', ASCENDING)], name='archivo_unico', unique=True),
+        IndexModel([('estado', ASCENDING), ('disponible_en', ASCENDING)], name='estado_disponible'),
+    ],
+    COLECCION_TRABAJOS: [
+        IndexModel([('estado', ASCENDING), ('disponible_en', ASCENDING)], name='estado_disponible'),
+        IndexModel([('terminado_en', ASCENDING)], name='terminado_en_ttl', expireAfterSeconds=SEGUNDOS_RETENCION_TRABAJOS),
+    ],
+    COLECCION_LOTES: [
+        IndexModel([('trabajo_id', ASCENDING), ('numero', ASCENDING)], name='trabajo_numero', unique=True),
+        # Lotes de trabajos que terminaron en error (los completados se borran al terminar)
+        IndexModel([('creado_en', ASCENDING)], name='creado_en_ttl', expireAfterSeconds=SEGUNDOS_RETENCION_TRABAJOS),
+    ],
+    COLECCION_CORREOS: [
+        IndexModel([('estado', ASCENDING), ('disponible_en', ASCENDING)], name='estado_disponible'),
+    ],
+    COLECCION_ENVIADOS: [
+        IndexModel([('enviado_en', ASCENDING)], name='enviado_en_ttl', expireAfterSeconds=SEGUNDOS_RETENCION_RECORDATORIOS),
+    ],
+    COLECCION_REVOCADAS: [
+        # Cada proceso trae solo las revocaciones nuevas
+        IndexModel([('actualizado_en', ASCENDING)], name='actualizado_en'),
+        IndexModel([('expira_en', ASCENDING)], name='expira_en_ttl', expireAfterSeconds=0),
+    ],
+    COLECCION_SUBIDAS: [
+        IndexModel([('expira_en', ASCENDING)], name='expira_en'),
+    ],
+}
+
+for _coleccion in (HistorialControl, ActaAsignacion, Liberacion, Mantenimiento, Seguro, ITV, SOAT,
+                   Impuesto, ControlOdometro, Depreciacion):
+    INDICES[_coleccion.collection_name] = indices_por_maquinaria()
+for _nombre in COLECCIONES_SECCION_VISTAS:
+    INDICES[_nombre] = indices_por_maquinaria()
+
+INDICES[Seguro.collection_name].append(IndexModel([('fecha_vencimiento', ASCENDING)], name='fecha_vencimiento'))
+INDICES[Mantenimiento.collection_name] += [
+    IndexModel([('estado', ASCENDING)], name='estado'),
+    IndexModel([('fecha', ASCENDING)], name='fecha'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Crea (de forma idempotente) los índices de todas las colecciones de MongoDB y reporta su uso con $indexStats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--solo-estadisticas', action='store_true',
+                            help='No crea índices, solo muestra el uso de los existentes')
+        parser.add_argument('--sin-estadisticas', action='store_true',
+                            help='Crea los índices sin mostrar el reporte de uso')
+
+    def handle(self, *args, **options):
+        if get_collection(Maquinaria.collection_name) is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+
+        errores = 0
+        if not options['solo_estadisticas']:
+            for nombre, indices in INDICES.items():
+                if indices:
+                    errores += self.crear_indices(nombre, indices)
+
+        if not options['sin_estadisticas']:
+            for nombre in INDICES:
+                self.reportar_uso(nombre)
+
+        if errores:
+            self.stdout.write(self.style.WARNING(f'Proceso completado con {errores} índices sin crear.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Proceso completado.'))
+
+    def crear_indices(self, nombre, indices):
+        """Crea cada índice por separado para que un conflicto no impida crear los demás."""
+        collection = get_collection(nombre)
+        errores = 0
+        for indice in indices:
+            nombre_indice = indice.document['name']
+            try:
+                collection.create_indexes([indice])
+                self.stdout.write(self.style.SUCCESS(f'{nombre}.{nombre_indice}: OK'))
+            except PyMongoError as e:
+                # Típicamente duplicados en un índice único o un índice con el mismo nombre y otras opciones
+                errores += 1
+                self.stdout.write(self.style.ERROR(f'{nombre}.{nombre_indice}: {str(e)}'))
+        return errores
+
+    def reportar_uso(self, nombre):
+        try:
+            estadisticas = list(get_collection(nombre).aggregate([{'$indexStats': {}}]))
+        except PyMongoError as e:
+            self.stdout.write(self.style.WARNING(f'{nombre}: no se pudo obtener $indexStats ({str(e)})'))
+            return
+        declarados = {indice.document['name'] for indice in INDICES.get(nombre, [])} | {'_id_'}
+        self.stdout.write(f'\n{nombre}:')
+        for stat in sorted(estadisticas, key=lambda s: s['name']):
+            accesos = stat.get('accesses', {})
+            desde = accesos.get('since')
+            desde = desde.strftime('%Y-%m-%d %H:%M') if desde else '-'
+            nota = '' if stat['name'] in declarados else '  (no declarado)'
+            linea = f"  {stat['name']}: {accesos.get('ops', 0)} usos desde {desde}{nota}"
+            if accesos.get('ops', 0) == 0 and stat['name'] != '_id_':
+                self.stdout.write(self.style.WARNING(linea))
+            else:
+                self.stdout.write(linea)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.mongo_connection import get_db
+from core.correos import SEGUNDOS_ESPERA_WORKER, enviar_pendientes
+
+
+class Command(BaseCommand):
+    help = 'Envía los correos encolados usando una sola conexión SMTP'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--continuo', action='store_true',
+                            help='Sigue revisando la cola (para correr como worker aparte del servidor web)')
+
+    def handle(self, *args, **options):
+        if get_db() is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+        while True:
+            enviados, errores = enviar_pendientes()
+            if enviados or errores or not options['continuo']:
+                estilo = self.style.WARNING if errores else self.style.SUCCESS
+                self.stdout.write(estilo(f'{enviados} correos enviados, {errores} con error'))
+            if not options['continuo']:
+                break
+            time.sleep(SEGUNDOS_ESPERA_WORKER)
@@ -1,61 +1,37 @@
+import time
+
 from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
-from gestion_maquinaria.core.mongo_connection import get_collection
-from datetime import datetime, timedelta
+from pymongo.errors import PyMongoError
+from core.mongo_connection import get_db
+from core.recordatorios import DIAS_ANTICIPACION, enviar_recordatorios
 
-class Command(BaseCommand):
-    help = 'Envía recordatorios de mantenimiento a todos los usuarios una semana antes'
 
-    def handle(self, *args, **kwargs):
-        hoy = datetime.now()
-        en_una_semana = hoy + timedelta(days=7)
-        collection = get_collection('pronostico')
-        usuarios = get_collection('usuarios').find({})
-        emails = [u.get('Email') for u in usuarios if u.get('Email')]
+class Command(BaseCommand):
+    help = 'Envía a los usuarios los recordatorios de mantenimiento de la próxima semana (sin repetir los ya enviados)'
 
-        # Buscar pronósticos con fechas de mantenimiento dentro de 7 días
-        pronosticos = collection.find({
-            'fecha_mantenimiento': {'$exists': True, '$ne': None}
-        })
+    def add_arguments(self, parser):
+        parser.add_argument('--dias', type=int, default=DIAS_ANTICIPACION,
+                            help='Días de anticipación de los recordatorios')
+        parser.add_argument('--continuo', action='store_true',
+                            help='Sigue corriendo y revisa cada --intervalo segundos (en lugar de un cron)')
+        parser.add_argument('--intervalo', type=int, default=3600,
+                            help='Segundos entre revisiones con --continuo')
 
-        enviados = 0
-        for p in pronosticos:
-            placa = p.get('placa', 'Sin placa')
-            fecha_mantenimiento = p.get('fecha_mantenimiento')
-            fecha_recordatorio = p.get('fecha_recordatorio')
-            
-            # Verificar fecha de mantenimiento
-            if fecha_mantenimiento:
-                try:
-                    fecha_dt = datetime.strptime(fecha_mantenimiento, '%Y-%m-%d')
-                    if hoy <= fecha_dt <= en_una_semana:
-                        send_mail(
-                            subject=f'Recordatorio de mantenimiento para {placa}',
-                            message=f'La maquinaria con placa {placa} tiene un mantenimiento programado para el {fecha_mantenimiento}.',
-                            from_email='noreply@tusistema.com',
-                            recipient_list=emails,
-                            fail_silently=False,
-                        )
-                        enviados += 1
-                        self.stdout.write(self.style.SUCCESS(f'Recordatorio enviado para {placa} ({fecha_mantenimiento})'))
-                except Exception:
-                    continue
-            
-            # Verificar fecha de recordatorio
-            if fecha_recordatorio:
-                try:
-                    fecha_dt = datetime.strptime(fecha_recordatorio, '%Y-%m-%d')
-                    if hoy <= fecha_dt <= en_una_semana:
-                        send_mail(
-                            subject=f'Recordatorio de mantenimiento para {placa}',
-                            message=f'La maquinaria con placa {placa} tiene un recordatorio de mantenimiento para el {fecha_recordatorio}.',
-                            from_email='noreply@tusistema.com',
-                            recipient_list=emails,
-                            fail_silently=False,
-                        )
-                        enviados += 1
-                        self.stdout.write(self.style.SUCCESS(f'Recordatorio enviado para {placa} ({fecha_recordatorio})'))
-                except Exception:
-                    continue
-        if enviados == 0:
-            self.stdout.write(self.style.WARNING('No hay recordatorios para enviar hoy.')) 
\ No newline at end of file
+    def handle(self, *args, **options):
+        if get_db() is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+        while True:
+            try:
+                nuevos = enviar_recordatorios(dias=options['dias'])
+                if nuevos:
+                    for recordatorio in nuevos:
+                        self.stdout.write(self.style.SUCCESS(
+                            f"Recordatorio encolado para {recordatorio['placa']} ({recordatorio['fecha']})"))
+                elif not options['continuo']:
+                    self.stdout.write(self.style.WARNING('No hay recordatorios para enviar hoy.'))
+            except (PyMongoError, ConnectionError) as e:
+                self.stdout.write(self.style.ERROR(f'MongoDB no disponible: {e}'))
+            if not options['continuo']:
+                break
+            time.sleep(options['intervalo'])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from core.mongo_connection import get_db
+from core.adjuntos import HORAS_VIGENCIA_SUBIDA, limpiar_pendientes
+
+
+class Command(BaseCommand):
+    help = 'Borra de GridFS los adjuntos subidos que nunca se asociaron a un registro y las subidas por partes abandonadas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=int, default=HORAS_VIGENCIA_SUBIDA,
+                            help=f'Antigüedad mínima de un adjunto pendiente para borrarlo (por defecto {HORAS_VIGENCIA_SUBIDA})')
+
+    def handle(self, *args, **options):
+        if get_db() is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+        archivos, subidas = limpiar_pendientes(options['horas'])
+        self.stdout.write(self.style.SUCCESS(f'{archivos} adjuntos pendientes y {subidas} subidas abandonadas eliminados'))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from pymongo.errors import PyMongoError
+from core.mongo_connection import get_collection
+from core.adjuntos import AdjuntoInvalido, guardar_adjuntos_registro
+
+COLECCIONES_PDF = ['seguro', 'itv', 'soat', 'impuesto']
+COLECCION_FOTOS = 'control_odometro'
+
+
+class Command(BaseCommand):
+    help = 'Mueve los PDF y fotos guardados en base64 dentro de los registros al bucket GridFS "adjuntos"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Solo cuenta los registros a migrar, sin modificar nada')
+        parser.add_argument('--coleccion', action='append', choices=COLECCIONES_PDF + [COLECCION_FOTOS],
+                            help='Colección a migrar (se puede repetir). Por defecto todas')
+
+    def handle(self, *args, **options):
+        if get_collection('seguro') is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+
+        colecciones = options['coleccion'] or COLECCIONES_PDF + [COLECCION_FOTOS]
+        for nombre in colecciones:
+            if nombre == COLECCION_FOTOS:
+                # Registros con al menos una foto que todavía es un string base64
+                filtro = {'fotos': {'$elemMatch': {'$type': 'string'}}}
+            else:
+                filtro = {'archivo_pdf': {'$type': 'string', '$ne': ''}}
+            self.migrar(nombre, filtro, options['dry_run'])
+
+    def migrar(self, nombre, filtro, dry_run):
+        collection = get_collection(nombre)
+        pendientes = collection.count_documents(filtro)
+        if dry_run or not pendientes:
+            self.stdout.write(f'{nombre}: {pendientes} registros por migrar')
+            return
+
+        migrados = errores = 0
+        # Solo se trae el _id: cada documento se lee completo de a uno para no cargar todos los base64 juntos
+        for ref in collection.find(filtro, {'_id': 1}):
+            registro = collection.find_one({'_id': ref['_id']})
+            if not registro:
+                continue
+            try:
+                if nombre == COLECCION_FOTOS:
+                    datos = guardar_adjuntos_registro({'fotos': registro.get('fotos') or []}, registro)
+                else:
+                    datos = guardar_adjuntos_registro({'archivo_pdf': registro['archivo_pdf']}, registro)
+                collection.update_one({'_id': registro['_id']}, {'$set': datos})
+                migrados += 1
+            except (AdjuntoInvalido, PyMongoError) as e:
+                errores += 1
+                self.stdout.write(self.style.ERROR(f'{nombre} {registro["_id"]}: {str(e)}'))
+
+        estilo = self.style.WARNING if errores else self.style.SUCCESS
+        self.stdout.write(estilo(f'{nombre}: {migrados} migrados, {errores} con error'))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.mongo_connection import get_db
+from core.imagenes import SEGUNDOS_ESPERA_WORKER, encolar_sin_procesar, procesar_cola
+
+
+class Command(BaseCommand):
+    help = 'Procesa la cola de fotos: versión recomprimida y miniaturas WebP/JPEG en GridFS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--encolar-existentes', action='store_true',
+                            help='Encola antes las fotos ya guardadas que todavía no tienen miniaturas')
+        parser.add_argument('--continuo', action='store_true',
+                            help='Sigue revisando la cola (para correr como worker aparte del servidor web)')
+
+    def handle(self, *args, **options):
+        if get_db() is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+        if options['encolar_existentes']:
+            self.stdout.write(f'{encolar_sin_procesar()} fotos encoladas')
+        while True:
+            procesadas, errores = procesar_cola()
+            if procesadas or errores or not options['continuo']:
+                estilo = self.style.WARNING if errores else self.style.SUCCESS
+                self.stdout.write(estilo(f'{procesadas} fotos procesadas, {errores} con error'))
+            if not options['continuo']:
+                break
+            time.sleep(SEGUNDOS_ESPERA_WORKER)
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.mongo_connection import get_db
+from core.trabajos_pronostico import SEGUNDOS_ESPERA_WORKER, procesar_trabajos
+
+
+class Command(BaseCommand):
+    help = 'Procesa las cargas de Excel de pronósticos pendientes (y retoma las que quedaron a medias)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--continuo', action='store_true',
+                            help='Sigue revisando los trabajos (para correr como worker aparte del servidor web)')
+
+    def handle(self, *args, **options):
+        if get_db() is None:
+            self.stdout.write(self.style.ERROR('MongoDB no está disponible'))
+            return
+        while True:
+            completados, errores = procesar_trabajos()
+            if completados or errores or not options['continuo']:
+                estilo = self.style.WARNING if errores else self.style.SUCCESS
+                self.stdout.write(estilo(f'{completados} trabajos completados, {errores} con error'))
+            if not options['continuo']:
+                break
+            time.sleep(SEGUNDOS_ESPERA_WORKER)
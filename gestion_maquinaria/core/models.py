@@ -1,6 +1,6 @@
 from django.contrib.auth.models import User
-from pymongo import MongoClient
 from django.conf import settings
+from .mongo_connection import get_collection
 import nbformat
 from nbconvert.preprocessors import ExecutePreprocessor
 import os
@@ -47,9 +47,8 @@ class Activo:
 class Pronostico:
     collection_name = "pronostico"
     def __init__(self):
-        self.client = MongoClient(settings.MONGO_URI)
-        self.db = self.client["gestion_maquinaria"]
-        self.collection = self.db[self.collection_name]
+        # Usa el cliente compartido del proceso (None si MongoDB no está disponible)
+        self.collection = get_collection(self.collection_name)
 
     def insert(self, data):
         return self.collection.insert_one(data).inserted_id
@@ -1,53 +1,332 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 from bson import ObjectId
 from django.conf import settings
+import importlib.util
 import logging
+import os
+import threading
+import time
+
+from .instrumentacion import comandos_listener
 
 logger = logging.getLogger(__name__)
 
 # Global client instance for connection pooling
 _client = None
 _db = None
+_client_lock = threading.Lock()
 
-def get_client():
+
+class CircuitBreaker:
     """
-    Get MongoDB client with lazy initialization and connection pooling.
+    Circuit breaker for the MongoDB connection, fed by the health monitor.
+
+    - closed: requests use the database normally.
+    - open: after `failure_threshold` consecutive failed pings, requests fail fast
+      (get_client() returns None) instead of waiting on server selection timeouts.
+    - half_open: once `reset_timeout` has passed, the monitor sends a single trial ping;
+      success closes the breaker, failure opens it again with a longer wait (up to
+      `max_reset_timeout`).
+
+    `allow_request()` only reads the current state, so views can call it on every request.
     """
-    global _client
-    
-    if _client is None:
-        try:
-            # Connection options optimized for MongoDB Atlas with longer timeouts for file operations
-            connection_options = {
-                'serverSelectionTimeoutMS': 5000,  # 5 seconds timeout
-                'connectTimeoutMS': 10000,  # 10 seconds connection timeout
-                'socketTimeoutMS': 30000,  # 30 seconds socket timeout for large files
-                'maxPoolSize': 10,  # Larger connection pool
-                'retryWrites': True,  # Enable retries for write operations
-                'retryReads': True,  # Enable retries for read operations
-                'heartbeatFrequencyMS': 10000,  # Heartbeat every 10 seconds
-                'maxIdleTimeMS': 30000,  # Close idle connections after 30 seconds
-                'waitQueueTimeoutMS': 5000,  # Wait max 5 seconds for connection from pool
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=2, reset_timeout=10, max_reset_timeout=120):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.last_error = None
+        self.opened_at = None
+        self._wait = reset_timeout
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        return self.state == self.CLOSED
+
+    def start_trial(self):
+        """Returns True if MongoDB should be pinged now (moves open -> half_open when the wait is over)."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() >= self._retry_at:
+                self.state = self.HALF_OPEN
+            return self.state != self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("MongoDB available again, closing circuit breaker")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._wait = self.reset_timeout
+
+    def record_failure(self, error, trip=False):
+        """Counts a failed ping; `trip` opens the breaker right away (e.g. on the first connection)."""
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+            if self.state == self.HALF_OPEN:
+                # The trial failed: wait longer before the next one
+                self._wait = min(self._wait * 2, self.max_reset_timeout)
+            elif self.state == self.CLOSED and (trip or self.failures >= self.failure_threshold):
+                self._wait = self.reset_timeout
+                self.opened_at = time.time()
+                logger.error(f"MongoDB unavailable, opening circuit breaker: {error}")
+            else:
+                return
+            self.state = self.OPEN
+            self._retry_at = time.monotonic() + self._wait
+
+    def reset_after_fork(self):
+        # The lock may have been held by another thread at fork time. The child starts closed:
+        # it has no client yet and its first get_client() pings (and opens again if still down)
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._wait = self.reset_timeout
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'last_error': self.last_error,
+            'opened_at': self.opened_at,
+            'retry_in_seconds': (max(0.0, round(self._retry_at - time.monotonic(), 1))
+                                 if self.state != self.CLOSED else None),
+        }
+
+
+breaker = CircuitBreaker(
+    failure_threshold=getattr(settings, 'MONGO_BREAKER_UMBRAL_FALLOS', 2),
+    reset_timeout=getattr(settings, 'MONGO_BREAKER_ESPERA_SEGUNDOS', 10),
+    max_reset_timeout=getattr(settings, 'MONGO_BREAKER_ESPERA_MAX_SEGUNDOS', 120),
+)
+
+# Health monitor: one background thread per process that pings MongoDB
+_monitor = None
+_monitor_pid = None
+_monitor_lock = threading.Lock()
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Connection pool counters (CMAP events) per server: open connections, connections in
+    use, checkouts, checkout failures, pool clears and time spent waiting for a connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._servers = {}
+
+    def _server(self, address):
+        key = '%s:%s' % address
+        if key not in self._servers:
+            self._servers[key] = {
+                'open': 0, 'in_use': 0, 'created': 0, 'closed': 0, 'checkouts': 0,
+                'checkout_failures': 0, 'clears': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0,
             }
-            
+        return self._servers[key]
+
+    def _add(self, address, **increments):
+        with self._lock:
+            server = self._server(address)
+            for field, value in increments.items():
+                server[field] += value
+
+    def _waited_ms(self):
+        started = getattr(self._local, 'checkout_started', None)
+        self._local.checkout_started = None
+        return (time.perf_counter() - started) * 1000 if started else 0.0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(event.address, clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(event.address, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        self._local.checkout_started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._waited_ms()
+        self._add(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        waited = self._waited_ms()
+        with self._lock:
+            server = self._server(event.address)
+            server['in_use'] += 1
+            server['checkouts'] += 1
+            server['wait_ms_total'] += waited
+            server['wait_ms_max'] = max(server['wait_ms_max'], waited)
+
+    def connection_checked_in(self, event):
+        self._add(event.address, in_use=-1)
+
+    def reset_after_fork(self):
+        # The child starts with its own pool: the parent's counters do not apply
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def stats(self):
+        with self._lock:
+            servers = {key: dict(server) for key, server in self._servers.items()}
+        for server in servers.values():
+            server['wait_ms_avg'] = round(server['wait_ms_total'] / server['checkouts'], 2) if server['checkouts'] else 0.0
+            server['wait_ms_total'] = round(server['wait_ms_total'], 1)
+            server['wait_ms_max'] = round(server['wait_ms_max'], 1)
+        return servers
+
+
+pool_stats = PoolStatsListener()
+
+# Compressor -> module it needs (zlib is always available)
+_COMPRESSOR_MODULES = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': 'zlib'}
+
+
+def _compressors():
+    """Configured wire compressors that can actually be used in this environment."""
+    available = []
+    for name in getattr(settings, 'MONGO_COMPRESORES', []):
+        if importlib.util.find_spec(_COMPRESSOR_MODULES.get(name, name)) is None:
+            logger.warning(f"MongoDB compressor '{name}' is not available (missing module), skipping it")
+        else:
+            available.append(name)
+    return available
+
+
+def connection_options():
+    """MongoClient options from settings (pool size, timeouts, compression, read preference)."""
+    options = {
+        'serverSelectionTimeoutMS': getattr(settings, 'MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        'connectTimeoutMS': getattr(settings, 'MONGO_CONNECT_TIMEOUT_MS', 10000),
+        # Long enough for large GridFS files
+        'socketTimeoutMS': getattr(settings, 'MONGO_SOCKET_TIMEOUT_MS', 30000),
+        'maxPoolSize': getattr(settings, 'MONGO_POOL_MAX', 10),
+        'minPoolSize': getattr(settings, 'MONGO_POOL_MIN', 0),
+        'maxIdleTimeMS': getattr(settings, 'MONGO_MAX_IDLE_MS', 30000),
+        # Max wait for a free connection from the pool
+        'waitQueueTimeoutMS': getattr(settings, 'MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
+        'retryWrites': True,
+        'retryReads': True,
+        'heartbeatFrequencyMS': 10000,
+        'readPreference': getattr(settings, 'MONGO_READ_PREFERENCE', 'primary'),
+        'event_listeners': [pool_stats, comandos_listener],
+    }
+    compressors = _compressors()
+    if compressors:
+        options['compressors'] = compressors
+    return options
+
+
+def _create_client():
+    """
+    Create the MongoClient once per process. The client reconnects by itself after an
+    outage, so it is kept (not rebuilt) when a ping fails.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
             # Check if MONGO_URI is available
             if not settings.MONGO_URI:
                 logger.error("MONGO_URI not configured in environment variables")
                 raise ValueError("MONGO_URI not configured")
-            
-            # Try to connect with very short timeout
-            _client = MongoClient(settings.MONGO_URI, **connection_options)
-            
-            # Test the connection with a very short timeout
-            _client.admin.command('ping', maxTimeMS=1000)
-            logger.info("Successfully connected to MongoDB")
-            
-        except Exception as e:
-            logger.error(f"Failed to connect to MongoDB: {str(e)}")
-            _client = None
-            # Don't raise the exception, return None instead
+
+            _client = MongoClient(settings.MONGO_URI, **connection_options())
+    return _client
+
+
+def _after_fork_in_child():
+    """
+    A MongoClient is not fork-safe: the child (e.g. a gunicorn worker forked with
+    --preload) drops the inherited client, locks and monitor, and creates its own on first use.
+    """
+    global _client, _db, _client_lock, _monitor, _monitor_pid, _monitor_lock
+
+    _client = None
+    _db = None
+    _client_lock = threading.Lock()
+    _monitor = None
+    _monitor_pid = None
+    _monitor_lock = threading.Lock()
+    breaker.reset_after_fork()
+    pool_stats.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _ping(trip=False):
+    """Ping MongoDB and record the result in the circuit breaker."""
+    try:
+        _create_client().admin.command('ping', maxTimeMS=1000)
+    except Exception as e:
+        logger.warning(f"MongoDB health check failed: {str(e)}")
+        breaker.record_failure(e, trip=trip)
+        return False
+    breaker.record_success()
+    return True
+
+
+def _monitor_loop():
+    while True:
+        time.sleep(getattr(settings, 'MONGO_HEALTH_INTERVALO_SEGUNDOS', 5))
+        if breaker.start_trial():
+            _ping()
+
+
+def _start_monitor():
+    """Start the health monitor (again after a fork: threads are not inherited)."""
+    global _monitor, _monitor_pid
+
+    with _monitor_lock:
+        if _monitor is None or _monitor_pid != os.getpid() or not _monitor.is_alive():
+            _monitor = threading.Thread(target=_monitor_loop, name='mongodb-health', daemon=True)
+            _monitor.start()
+            _monitor_pid = os.getpid()
+
+
+def get_client():
+    """
+    Get MongoDB client with lazy initialization and connection pooling.
+    Returns None right away while the circuit breaker is open.
+    """
+    # Before checking the breaker: only the monitor can close it again
+    if _monitor_pid != os.getpid():
+        _start_monitor()
+    if not breaker.allow_request():
+        return None
+
+    if _client is None:
+        # First connection of the process: checked once here, then the monitor takes over
+        if not _ping(trip=True):
             return None
-    
+        logger.info("Successfully connected to MongoDB")
+
     return _client
 
 def get_db():
@@ -55,14 +334,14 @@ def get_db():
     Get MongoDB database with lazy initialization.
     """
     global _db
-    
+
+    client = get_client()
+    if client is None:
+        logger.warning("MongoDB client is not available")
+        return None
     if _db is None:
-        client = get_client()
-        if client is None:
-            logger.warning("MongoDB client is not available")
-            return None
         _db = client[settings.MONGO_DB_NAME]
-    
+
     return _db
 
 def get_collection(collection_name_or_class):
@@ -73,7 +352,7 @@ def get_collection(collection_name_or_class):
     if db is None:
         logger.warning("MongoDB database is not available")
         return None
-    
+
     if hasattr(collection_name_or_class, 'collection_name'):
         return db[collection_name_or_class.collection_name]
     return db[collection_name_or_class]
@@ -86,34 +365,30 @@ def get_collection_from_activos_db(collection_name):
     if client is None:
         logger.warning("MongoDB client is not available")
         return None
-    
+
     activos_db = client["activos"]
     return activos_db[collection_name]
 
 def is_mongodb_available():
     """
     Check if MongoDB is available without raising exceptions.
+    Reads the circuit breaker kept by the health monitor: no round trip per request.
     """
-    try:
-        client = get_client()
-        if client is None:
-            return False
-        
-        # Quick ping test
-        client.admin.command('ping', maxTimeMS=1000)
-        return True
-    except Exception as e:
-        logger.warning(f"MongoDB availability check failed: {str(e)}")
-        return False
+    return get_client() is not None
+
+def mongodb_health():
+    """Circuit breaker and connection pool state of this process (for the stats endpoint)."""
+    return dict(breaker.stats(), monitor_alive=_monitor is not None and _monitor.is_alive(),
+                pool=pool_stats.stats())
 
 def close_connection():
     """
     Close MongoDB connection (useful for testing or cleanup).
     """
     global _client, _db
-    
+
     if _client:
         _client.close()
         _client = None
         _db = None
-        logger.info("MongoDB connection closed")
\ No newline at end of file
+        logger.info("MongoDB connection closed")
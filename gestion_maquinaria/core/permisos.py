@@ -0,0 +1,195 @@
+"""
+Permisos por rol y módulo.
+
+Las reglas de cada cargo se compilan una sola vez en una matriz (módulo, acción) -> bool; la
+de cada técnico se completa con sus `permisos` personales y se guarda en una caché por email
+que se vacía con `usuario_modificado()` (cambios de cargo o de permisos). Así
+`tiene_permiso` responde con una búsqueda en un dict.
+
+`EsAdministrador`, `EsEncargado` y `PermisoModulo` son las mismas reglas como permission
+classes de DRF, para declararlas en la vista en lugar de comprobarlas a mano.
+"""
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException, PermissionDenied
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+
+from .autenticacion import UsuarioAutenticado
+from .cache import TTLCache
+from .mongo_connection import is_mongodb_available
+
+ACCIONES_EDICION = ('crear', 'editar', 'eliminar')
+# El técnico solo puede crear en estos módulos (editar y eliminar, nunca)
+MODULOS_TECNICO_SOLO_CREA = ('Maquinaria', 'HistorialControl', 'ActaAsignacion', 'Mantenimiento', 'Seguro',
+                             'ITV', 'Impuesto', 'SOAT', 'Liberacion')
+# Rol requerido -> cargos que lo cumplen
+CARGOS_POR_ROL = {
+    'admin': frozenset({'admin'}),
+    'encargado': frozenset({'admin', 'encargado'}),
+    'tecnico': frozenset({'admin', 'encargado', 'tecnico'}),
+}
+
+
+class MatrizPermisos:
+    """Acciones permitidas por módulo; `por_defecto` vale para los pares que no están en `reglas`."""
+    __slots__ = ('cargo', 'reglas', 'por_defecto')
+
+    def __init__(self, cargo, reglas, por_defecto):
+        self.cargo = cargo
+        self.reglas = reglas
+        self.por_defecto = por_defecto
+
+    def permite(self, modulo, accion):
+        if not modulo or not accion:
+            # Sin módulo o acción solo cuenta el cargo (cualquier cargo válido pasa)
+            return self.cargo in CARGOS_POR_ROL['tecnico']
+        return self.reglas.get((modulo, accion), self.por_defecto)
+
+
+def _reglas_tecnico():
+    reglas = {(modulo, accion): accion == 'crear'
+              for modulo in MODULOS_TECNICO_SOLO_CREA for accion in ACCIONES_EDICION}
+    # Los técnicos pueden crear depreciaciones sin permiso explícito
+    reglas[('Depreciaciones', 'crear')] = True
+    return reglas
+
+
+# Matrices de cada cargo, compiladas al importar
+MATRICES_CARGO = {
+    # El admin tiene acceso completo, salvo modificar maquinaria
+    'admin': MatrizPermisos('admin', {('Maquinaria', a): False for a in ACCIONES_EDICION}, True),
+    # El encargado tiene acceso completo, salvo la gestión de usuarios
+    'encargado': MatrizPermisos('encargado', {('Usuarios', a): False for a in ACCIONES_EDICION}, True),
+}
+REGLAS_TECNICO = _reglas_tecnico()
+SIN_PERMISOS = MatrizPermisos(None, {}, False)
+
+matrices_cache = TTLCache(
+    maxsize=getattr(settings, 'USUARIOS_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'USUARIOS_CACHE_TTL', 30),
+    nombre='permisos',
+)
+
+
+def normalizar_cargo(user):
+    cargo = str(user.get('Cargo') or '').lower()
+    return 'tecnico' if cargo == 'técnico' else cargo
+
+
+def compilar_matriz(user):
+    """Matriz del usuario: la de su cargo o, si es técnico, sus permisos personales con las reglas del cargo encima."""
+    cargo = normalizar_cargo(user)
+    if cargo in MATRICES_CARGO:
+        return MATRICES_CARGO[cargo]
+    if cargo != 'tecnico':
+        return SIN_PERMISOS
+    reglas = {}
+    for modulo, acciones in (user.get('permisos') or {}).items():
+        if isinstance(acciones, dict):
+            reglas.update({(modulo, accion): bool(valor) for accion, valor in acciones.items()})
+    reglas.update(REGLAS_TECNICO)
+    return MatrizPermisos('tecnico', reglas, False)
+
+
+def matriz_de(user):
+    email = user.get('Email')
+    if not email:
+        return compilar_matriz(user)
+    matriz = matrices_cache.get(email)
+    if matriz is None:
+        matriz = compilar_matriz(user)
+        matrices_cache.set(email, matriz)
+    return matriz
+
+
+def invalidar_permisos():
+    """Descarta las matrices compiladas (tras cambiar el cargo o los permisos de un usuario)."""
+    matrices_cache.clear()
+
+
+def tiene_permiso(user, required_role=None, required_permission=None, module=None):
+    if not user:
+        return False
+    matriz = matriz_de(user)
+    cargos = CARGOS_POR_ROL.get(required_role)
+    if cargos is not None and matriz.cargo not in cargos:
+        return False
+    return matriz.permite(module, required_permission)
+
+
+# --- Permission classes de DRF ---
+
+class NoAutenticado(APIException):
+    status_code = status.HTTP_401_UNAUTHORIZED
+    default_detail = {'error': 'No autenticado'}
+
+
+class BaseDatosNoDisponible(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = {
+        'error': 'Base de datos no disponible temporalmente',
+        'message': 'El servicio de base de datos está experimentando problemas de conectividad. '
+                   'Por favor, intente nuevamente en unos momentos.',
+    }
+
+
+def usuario_requerido(request):
+    """Usuario autenticado del request; 401 sin X-User-Email y 503 si no se pudo buscar."""
+    if not request.headers.get('X-User-Email'):
+        raise NoAutenticado()
+    if isinstance(request.user, UsuarioAutenticado):
+        return request.user
+    if not is_mongodb_available():
+        raise BaseDatosNoDisponible()
+    # El email no corresponde a ningún usuario: lo rechaza la regla de permisos
+    return None
+
+
+class _PermisoBase(BasePermission):
+    mensaje = 'No tienes permisos para realizar esta acción'
+
+    def denegar(self, view):
+        raise PermissionDenied({'error': getattr(view, 'mensaje_permiso', self.mensaje)})
+
+
+class UsuarioRegistrado(_PermisoBase):
+    """Solo exige que el request venga de un usuario existente (cualquier cargo)."""
+
+    def has_permission(self, request, view):
+        if usuario_requerido(request) is None:
+            raise NoAutenticado()
+        return True
+
+
+class RolRequerido(_PermisoBase):
+    """Exige el rol `rol` (ver CARGOS_POR_ROL) en todos los métodos de la vista."""
+    rol = None
+
+    def has_permission(self, request, view):
+        if not tiene_permiso(usuario_requerido(request), required_role=self.rol):
+            self.denegar(view)
+        return True
+
+
+class EsAdministrador(RolRequerido):
+    rol = 'admin'
+
+
+class EsEncargado(RolRequerido):
+    rol = 'encargado'
+
+
+class PermisoModulo(_PermisoBase):
+    """
+    Permiso de `view.modulo_permiso` según el método: POST crear, PUT/PATCH editar y
+    DELETE eliminar. Los métodos de lectura no se restringen.
+    """
+    ACCIONES_POR_METODO = {'POST': 'crear', 'PUT': 'editar', 'PATCH': 'editar', 'DELETE': 'eliminar'}
+
+    def has_permission(self, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        accion = self.ACCIONES_POR_METODO.get(request.method)
+        if not tiene_permiso(usuario_requerido(request), required_permission=accion, module=view.modulo_permiso):
+            self.denegar(view)
+        return True
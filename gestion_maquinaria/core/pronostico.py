@@ -0,0 +1,159 @@
+"""
+Registro del modelo de pronóstico (submódulo pronostico-v1).
+
+El módulo se carga una sola vez por proceso (wsgi.py lo precarga y hace un pronóstico de
+calentamiento) y se vuelve a cargar solo cuando cambia algún archivo del directorio del
+modelo. Las vistas usan `registro_modelo.predecir(datos)` o, para muchas filas,
+`registro_modelo.predict_batch(df)`.
+"""
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import date
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+NOMBRE_MODULO = 'pronostico_model'
+# Archivos cuyo cambio provoca la recarga (código y artefactos entrenados)
+EXTENSIONES_MODELO = ('.py', '.pkl', '.joblib', '.json')
+
+
+class ModeloNoDisponible(RuntimeError):
+    pass
+
+
+class RegistroModelo:
+    def __init__(self, directorio, segundos_revision=30):
+        self.directorio = directorio
+        self.segundos_revision = segundos_revision
+        self._lock = threading.Lock()
+        self._modulo = None
+        self._firma = None
+        self._ultima_revision = 0.0
+        self.cargado_en = None
+
+    def _firma_archivos(self):
+        """(nombre, mtime, tamaño) de los archivos del modelo: si cambia, hay que recargar."""
+        try:
+            nombres = sorted(n for n in os.listdir(self.directorio) if n.endswith(EXTENSIONES_MODELO))
+        except FileNotFoundError:
+            return None
+        firma = []
+        for nombre in nombres:
+            info = os.stat(os.path.join(self.directorio, nombre))
+            firma.append((nombre, info.st_mtime_ns, info.st_size))
+        return tuple(firma)
+
+    def _importar(self):
+        ruta = os.path.join(self.directorio, f'{NOMBRE_MODULO}.py')
+        if not os.path.exists(ruta):
+            raise ModeloNoDisponible(f"No se encontró el modelo de pronóstico en {ruta}")
+        # El modelo importa módulos hermanos: su directorio va al path una sola vez
+        if self.directorio not in sys.path:
+            sys.path.insert(0, self.directorio)
+        spec = importlib.util.spec_from_file_location(NOMBRE_MODULO, ruta)
+        modulo = importlib.util.module_from_spec(spec)
+        # Registrado antes de ejecutarlo, como un import normal (lo necesita joblib/pickle)
+        anterior = sys.modules.get(NOMBRE_MODULO)
+        sys.modules[NOMBRE_MODULO] = modulo
+        try:
+            spec.loader.exec_module(modulo)
+        except Exception:
+            if anterior is not None:
+                sys.modules[NOMBRE_MODULO] = anterior
+            else:
+                sys.modules.pop(NOMBRE_MODULO, None)
+            raise
+        if not callable(getattr(modulo, 'predecir_mantenimiento', None)):
+            raise ModeloNoDisponible("pronostico_model no define predecir_mantenimiento")
+        return modulo
+
+    def _cargar(self, firma):
+        inicio = time.monotonic()
+        modulo = self._importar()
+        self._modulo, self._firma = modulo, firma
+        self.cargado_en = time.time()
+        logger.info(f"Modelo de pronóstico cargado en {time.monotonic() - inicio:.2f}s")
+
+    def modulo(self):
+        """Módulo del modelo, cargándolo la primera vez o si cambiaron sus archivos."""
+        ahora = time.monotonic()
+        if self._modulo is not None and ahora - self._ultima_revision < self.segundos_revision:
+            return self._modulo
+        with self._lock:
+            if self._modulo is None or ahora - self._ultima_revision >= self.segundos_revision:
+                self._ultima_revision = ahora
+                firma = self._firma_archivos()
+                if self._modulo is None or firma != self._firma:
+                    if self._modulo is not None:
+                        logger.info("Cambiaron los archivos del modelo de pronóstico, se recarga")
+                    try:
+                        self._cargar(firma)
+                    except Exception as e:
+                        if self._modulo is None:
+                            if isinstance(e, ModeloNoDisponible):
+                                raise
+                            raise ModeloNoDisponible(f"No se pudo cargar el modelo de pronóstico: {e}")
+                        # Se sigue usando la versión anterior hasta que la nueva cargue bien
+                        logger.error(f"Error al recargar el modelo de pronóstico: {e}")
+                        self._firma = firma
+            return self._modulo
+
+    def predecir(self, datos):
+        return self.modulo().predecir_mantenimiento(datos)
+
+    def predict_batch(self, df):
+        """
+        Pronostica todas las filas de un DataFrame (columnas placa, fecha_asig, horas_op,
+        recorrido) y devuelve una lista de resultados en el mismo orden. Si el modelo
+        expone `predecir_lote(df)` se usa esa llamada vectorizada; si no, se recorre con
+        el módulo ya cargado. Una fila que falla devuelve {'error': ...}.
+        """
+        modulo = self.modulo()
+        if df.empty:
+            return []
+        predecir_lote = getattr(modulo, 'predecir_lote', None)
+        if callable(predecir_lote):
+            try:
+                resultados = predecir_lote(df)
+                if hasattr(resultados, 'to_dict'):
+                    resultados = resultados.to_dict('records')
+                resultados = list(resultados)
+                if len(resultados) == len(df):
+                    return resultados
+                logger.warning("predecir_lote devolvió una cantidad de filas distinta, se pronostica fila por fila")
+            except Exception as e:
+                logger.error(f"Error en predecir_lote, se pronostica fila por fila: {e}")
+
+        resultados = []
+        for fila in df.to_dict('records'):
+            try:
+                resultados.append(modulo.predecir_mantenimiento(fila))
+            except Exception as e:
+                resultados.append({'error': str(e)})
+        return resultados
+
+    def precargar(self):
+        """Carga el modelo y hace un pronóstico de prueba (las primeras llamadas suelen ser lentas)."""
+        try:
+            self.predecir({
+                'placa': 'CALENTAMIENTO',
+                'fecha_asig': date.today().strftime('%Y-%m-%d'),
+                'horas_op': 0.0,
+                'recorrido': 0.0,
+            })
+        except ModeloNoDisponible as e:
+            logger.warning(f"Modelo de pronóstico no disponible al iniciar: {e}")
+        except Exception as e:
+            logger.warning(f"Falló el pronóstico de calentamiento: {e}")
+
+
+registro_modelo = RegistroModelo(
+    getattr(settings, 'PRONOSTICO_MODELO_DIR', os.path.join(settings.BASE_DIR, 'pronostico-v1')),
+    getattr(settings, 'PRONOSTICO_RECARGA_SEGUNDOS', 30),
+)
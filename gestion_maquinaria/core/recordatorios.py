@@ -0,0 +1,132 @@
+"""
+Recordatorios de mantenimiento de los pronósticos.
+
+Busca con un rango de fechas (índices fecha_mantenimiento y fecha_recordatorio) los
+pronósticos que vencen en los próximos días, registra cada recordatorio en
+`recordatorios_enviados` para no repetirlo si el comando vuelve a correr, y encola un
+solo correo por destinatario con todos los recordatorios nuevos (ver core/correos.py).
+"""
+from datetime import datetime, timedelta
+
+from pymongo.errors import BulkWriteError
+
+from .correos import encolar_correo
+from .models import Pronostico, Usuario
+from .mongo_connection import get_collection, get_db
+
+COLECCION_ENVIADOS = 'recordatorios_enviados'
+# Campo de fecha del pronóstico -> descripción en el correo
+TIPOS_RECORDATORIO = {
+    'fecha_mantenimiento': 'Mantenimiento programado',
+    'fecha_recordatorio': 'Recordatorio de mantenimiento',
+}
+DIAS_ANTICIPACION = 7
+REMITENTE = 'noreply@tusistema.com'
+
+
+def get_enviados_collection():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return db[COLECCION_ENVIADOS]
+
+
+def recordatorios_pendientes(hoy, dias=DIAS_ANTICIPACION):
+    """Recordatorios (uno por pronóstico y tipo de fecha) que vencen entre hoy y `dias` días."""
+    collection = get_collection(Pronostico.collection_name)
+    if collection is None:
+        raise ConnectionError("MongoDB no disponible")
+    # Las fechas se guardan como texto 'YYYY-MM-DD': el rango por texto usa el índice de cada campo
+    desde = hoy.strftime('%Y-%m-%d')
+    hasta = (hoy + timedelta(days=dias + 1)).strftime('%Y-%m-%d')
+    pronosticos = collection.find(
+        {'$or': [{campo: {'$gte': desde, '$lt': hasta}} for campo in TIPOS_RECORDATORIO],
+         'activo': {'$ne': False}},
+        {'placa': 1, **{campo: 1 for campo in TIPOS_RECORDATORIO}},
+    )
+    recordatorios = []
+    for pronostico in pronosticos:
+        for campo, descripcion in TIPOS_RECORDATORIO.items():
+            fecha = pronostico.get(campo)
+            if isinstance(fecha, str) and desde <= fecha < hasta:
+                recordatorios.append({
+                    '_id': f"{pronostico['_id']}:{campo}:{fecha[:10]}",
+                    'placa': pronostico.get('placa', 'Sin placa'),
+                    'tipo': descripcion,
+                    'fecha': fecha[:10],
+                })
+    return recordatorios
+
+
+def registrar_nuevos(recordatorios):
+    """
+    Registra los recordatorios en `recordatorios_enviados` y devuelve solo los que no se
+    habían registrado antes (el _id es pronóstico:campo:fecha, así que un duplicado falla).
+    """
+    if not recordatorios:
+        return []
+    ahora = datetime.now()
+    documentos = [dict(r, enviado_en=ahora) for r in recordatorios]
+    try:
+        get_enviados_collection().insert_many(documentos, ordered=False)
+        return recordatorios
+    except BulkWriteError as e:
+        repetidos = {err['index'] for err in e.details.get('writeErrors', []) if err.get('code') == 11000}
+        otros = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+        if otros:
+            raise
+        return [r for i, r in enumerate(recordatorios) if i not in repetidos]
+
+
+def destinatarios():
+    """Correos de los usuarios activos, que reciben los recordatorios."""
+    collection = get_collection(Usuario.collection_name)
+    if collection is None:
+        raise ConnectionError("MongoDB no disponible")
+    usuarios = collection.find(
+        {'Email': {'$ne': None}, 'activo': {'$ne': False}}, {'Email': 1}
+    )
+    return [u['Email'] for u in usuarios if u.get('Email')]
+
+
+def html_recordatorios(recordatorios):
+    filas = ''.join(
+        f"<tr><td>{r['placa']}</td><td>{r['tipo']}</td><td>{r['fecha']}</td></tr>"
+        for r in sorted(recordatorios, key=lambda r: (r['fecha'], r['placa']))
+    )
+    return f"""
+    <h2>Recordatorios de Mantenimiento</h2>
+    <p>Las siguientes maquinarias tienen mantenimientos en los próximos días:</p>
+    <table style='border-collapse:collapse;' border='1' cellpadding='4'>
+      <tr><th>Placa</th><th>Tipo</th><th>Fecha</th></tr>
+      {filas}
+    </table>
+    """
+
+
+def texto_recordatorios(recordatorios):
+    return '\n'.join(
+        f"- {r['placa']}: {r['tipo'].lower()} para el {r['fecha']}"
+        for r in sorted(recordatorios, key=lambda r: (r['fecha'], r['placa']))
+    )
+
+
+def enviar_recordatorios(hoy=None, dias=DIAS_ANTICIPACION):
+    """
+    Encola los recordatorios nuevos que vencen en los próximos `dias` días: un correo por
+    destinatario con todos ellos. Devuelve los recordatorios nuevos.
+    """
+    hoy = hoy or datetime.now()
+    nuevos = registrar_nuevos(recordatorios_pendientes(hoy, dias))
+    if not nuevos:
+        return []
+    try:
+        # Hoy todos los usuarios reciben todos los recordatorios: un mismo mensaje en tandas de destinatarios
+        encolar_correo(f'Recordatorios de mantenimiento: {len(nuevos)} próximos',
+                       html_recordatorios(nuevos), destinatarios(),
+                       texto=texto_recordatorios(nuevos), remitente=REMITENTE)
+    except Exception:
+        # Sin encolar no quedan como enviados: la próxima corrida los vuelve a intentar
+        get_enviados_collection().delete_many({'_id': {'$in': [r['_id'] for r in nuevos]}})
+        raise
+    return nuevos
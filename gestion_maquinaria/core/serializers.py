@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from datetime import datetime, date
 from bson import ObjectId
+from .adjuntos import referencia_de
 
 class HistorialControlSerializer(serializers.Serializer):
     _id = serializers.CharField(read_only=True)
@@ -523,9 +524,9 @@ class ControlOdometroSerializer(serializers.Serializer):
         return value
 
     def validate_fotos(self, value):
-        # Validar que las fotos sean base64 válidos
+        # Validar que las fotos sean base64 válidos o fotos ya guardadas (URL del adjunto)
         for foto in value:
-            if foto and not foto.startswith('data:image/'):
+            if foto and not foto.startswith('data:image/') and referencia_de(foto) is None:
                 raise serializers.ValidationError("Formato de imagen inválido")
         return value
 
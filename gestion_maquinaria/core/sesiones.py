@@ -0,0 +1,222 @@
+"""
+Tokens de sesión firmados.
+
+El login entrega un token (django.core.signing, con fecha de emisión) que lleva el id, email,
+cargo, nombre y permisos del usuario junto con su `permisos_version`. El frontend lo manda en
+`Authorization: Bearer <token>` y `SesionTokenMiddleware` lo verifica sin consultar MongoDB:
+el usuario del request sale del token y X-User-Email se fija al email firmado.
+
+Cambiar el cargo o los permisos de un usuario, desactivarlo o eliminarlo incrementa su
+`permisos_version` y lo anota en `sesiones_revocadas`. Cada proceso mantiene esa lista en
+memoria y solo trae las novedades cada SESION_REVOCACIONES_SEGUNDOS; un token con una
+versión anterior ya no se acepta tal cual: el usuario se vuelve a leer de la base de datos
+(y si fue eliminado o desactivado, el token se rechaza).
+
+Cambiar la contraseña o el email además fija `sesiones_desde` en el usuario: los tokens
+emitidos antes de esa fecha se rechazan aunque el usuario siga activo.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from django.conf import settings
+from django.core import signing
+from django.http import JsonResponse
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+from .autenticacion import UsuarioAutenticado
+from .cache import invalidar_usuarios, obtener_usuario_por_email
+from .mongo_connection import get_db
+
+logger = logging.getLogger(__name__)
+
+COLECCION_REVOCADAS = 'sesiones_revocadas'
+SALT_TOKEN = 'core.sesiones.token'
+
+
+def horas_validez():
+    return getattr(settings, 'SESION_TOKEN_HORAS', 12)
+
+
+def get_revocadas_collection():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return db[COLECCION_REVOCADAS]
+
+
+def emitir_token(user):
+    """Token firmado para el usuario (documento de `usuarios`). Devuelve (token, expira_en)."""
+    datos = {
+        'id': str(user['_id']),
+        'e': user['Email'],
+        'c': user.get('Cargo'),
+        'n': user.get('Nombre'),
+        'p': user.get('permisos') or {},
+        'v': user.get('permisos_version', 0),
+        't': time.time(),
+    }
+    token = signing.dumps(datos, salt=SALT_TOKEN, compress=True)
+    return token, datetime.now() + timedelta(hours=horas_validez())
+
+
+def leer_token(token):
+    """Datos del token si la firma es válida y no venció; si no, lanza signing.BadSignature."""
+    return signing.loads(token, salt=SALT_TOKEN, max_age=timedelta(hours=horas_validez()))
+
+
+def usuario_del_token(datos):
+    return UsuarioAutenticado({
+        '_id': ObjectId(datos['id']),
+        'Email': datos['e'],
+        'Cargo': datos.get('c'),
+        'Nombre': datos.get('n'),
+        'permisos': datos.get('p') or {},
+        'permisos_version': datos.get('v', 0),
+    })
+
+
+class ListaRevocaciones:
+    """Versión mínima aceptada por email, sincronizada con `sesiones_revocadas` cada tanto."""
+
+    def __init__(self):
+        self._versiones = {}
+        self._desde = None
+        self._revisado = 0.0
+        self._lock = threading.Lock()
+
+    def _sincronizar(self):
+        ahora = time.monotonic()
+        if ahora - self._revisado < getattr(settings, 'SESION_REVOCACIONES_SEGUNDOS', 15):
+            return
+        with self._lock:
+            if ahora - self._revisado < getattr(settings, 'SESION_REVOCACIONES_SEGUNDOS', 15):
+                return
+            self._revisado = ahora
+            filtro = {'actualizado_en': {'$gt': self._desde}} if self._desde else {}
+            try:
+                nuevas = list(get_revocadas_collection().find(filtro, {'version': 1, 'actualizado_en': 1}))
+            except (PyMongoError, ConnectionError) as e:
+                # Sin base de datos se sigue con la última lista conocida
+                logger.warning(f"No se pudo sincronizar la lista de sesiones revocadas: {e}")
+                return
+            for doc in nuevas:
+                self._anotar(doc['_id'], doc['version'])
+                if self._desde is None or doc['actualizado_en'] > self._desde:
+                    self._desde = doc['actualizado_en']
+
+    def _anotar(self, email, version):
+        self._versiones[email] = max(version, self._versiones.get(email, 0))
+
+    def vigente(self, email, version):
+        self._sincronizar()
+        return version >= self._versiones.get(email, 0)
+
+    def revocar(self, email, version):
+        self._anotar(email, version)
+
+
+revocaciones = ListaRevocaciones()
+
+
+def revocar_sesiones(user_id, email_anterior=None, cerrar=False):
+    """
+    Invalida los tokens emitidos hasta ahora para el usuario (tras cambiar su cargo, permisos,
+    contraseña o email, desactivarlo o antes de eliminarlo). Si cambió el email, los tokens
+    viejos llevan `email_anterior` y también se revocan. Con `cerrar` (cambio de contraseña o
+    email) esos tokens se rechazan; si no, se vuelve a leer el usuario. Devuelve la nueva
+    versión, o None si no existe.
+    """
+    if not ObjectId.is_valid(str(user_id)):
+        return None
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    ahora = datetime.now()
+    cambios = {'$inc': {'permisos_version': 1}}
+    if cerrar:
+        cambios['$set'] = {'sesiones_desde': ahora}
+    user = db['usuarios'].find_one_and_update(
+        {'_id': ObjectId(str(user_id))}, cambios,
+        projection={'Email': 1, 'permisos_version': 1}, return_document=ReturnDocument.AFTER,
+    )
+    if not user or not user.get('Email'):
+        return None
+    if cerrar:
+        invalidar_usuarios()
+    for email in {user['Email'], email_anterior or user['Email']}:
+        get_revocadas_collection().update_one(
+            {'_id': email},
+            {'$set': {'version': user['permisos_version'], 'actualizado_en': ahora,
+                      # Pasado este tiempo ya no queda ningún token anterior sin vencer
+                      'expira_en': ahora + timedelta(hours=horas_validez())}},
+            upsert=True,
+        )
+        revocaciones.revocar(email, user['permisos_version'])
+    return user['permisos_version']
+
+
+def revocar_sesiones_tras_cambio(user_id, email_anterior=None, cerrar=False):
+    """
+    revocar_sesiones para después de un cambio que ya se guardó: si falla, el cambio sigue
+    valiendo (no se responde 500); queda en el log y los tokens vencen a las SESION_TOKEN_HORAS.
+    """
+    try:
+        return revocar_sesiones(user_id, email_anterior, cerrar)
+    except (PyMongoError, ConnectionError) as e:
+        logger.error(f"No se pudieron revocar las sesiones del usuario {user_id}: {e}")
+        return None
+
+
+def emitido_antes(datos, fecha):
+    """True si el token se emitió antes de `fecha` (los anteriores a 't' cuentan como viejos)."""
+    return fecha is not None and datetime.fromtimestamp(datos.get('t', 0)) < fecha
+
+
+def _sesion_invalida(mensaje):
+    return JsonResponse({'error': mensaje}, status=401)
+
+
+class SesionTokenMiddleware:
+    """
+    Con `Authorization: Bearer <token>` identifica al usuario por el token: lo deja en
+    `request.usuario_sesion` y fija X-User-Email al email firmado (no al que mande el cliente).
+    Sin token, X-User-Email solo se acepta si SESION_ACEPTAR_HEADER_EMAIL está activo.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        autorizacion = request.META.get('HTTP_AUTHORIZATION', '')
+        if autorizacion.startswith('Bearer '):
+            try:
+                datos = leer_token(autorizacion[len('Bearer '):].strip())
+            except signing.SignatureExpired:
+                return _sesion_invalida('La sesión expiró, vuelva a iniciar sesión')
+            except signing.BadSignature:
+                return _sesion_invalida('Sesión inválida')
+
+            if revocaciones.vigente(datos['e'], datos.get('v', 0)):
+                request.usuario_sesion = usuario_del_token(datos)
+            else:
+                # Cambiaron sus permisos: se usa el usuario actual de la base de datos
+                try:
+                    user = obtener_usuario_por_email(datos['e'])
+                except (PyMongoError, ConnectionError):
+                    # Sin base de datos el request queda sin usuario y la vista responde 503
+                    user = {}
+                if (user is None or user.get('activo') is False
+                        or emitido_antes(datos, (user or {}).get('sesiones_desde'))):
+                    return _sesion_invalida('La sesión fue revocada, vuelva a iniciar sesión')
+                if user:
+                    request.usuario_sesion = UsuarioAutenticado(user)
+            request.META['HTTP_X_USER_EMAIL'] = datos['e']
+        elif not getattr(settings, 'SESION_ACEPTAR_HEADER_EMAIL', False):
+            request.META.pop('HTTP_X_USER_EMAIL', None)
+        # request.headers se calcula una vez a partir de META
+        request.__dict__.pop('headers', None)
+        return self.get_response(request)
@@ -1,3 +1,679 @@
-from django.test import TestCase
+import base64
+import hashlib
+import time
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from django.test import Client, SimpleTestCase, override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from . import adjuntos, mongo_connection
+from .adjuntos import BUCKET_ADJUNTOS
+from .auditoria import EscritorAuditoria, limpiar_detalle
+from .cache import invalidar_usuarios
+from .colas import ColaMongo
+from .contrasenas import hashear
+from .management.commands.crear_indices import INDICES
+from .permisos import invalidar_permisos, tiene_permiso
+from .sesiones import ListaRevocaciones, emitir_token, revocar_sesiones
+from .views import (
+    CAMPOS_RESULTADO_PRONOSTICO, guardar_pronosticos_excel, listar_paginado, maquinaria_modificada,
+    opciones_maquinaria, opciones_usuarios, usuario_modificado,
+)
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+@skipUnless(mongomock, 'Requiere mongomock')
+class MongoEnMemoriaTestCase(SimpleTestCase):
+    """Pruebas contra una base MongoDB en memoria (mongomock) en lugar de la configurada."""
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+
+        def coleccion(nombre):
+            return self.db[getattr(nombre, 'collection_name', nombre)]
+
+        reemplazos = {
+            'core.views.get_collection': coleccion,
+            'core.cache.get_collection': coleccion,
+            'core.auditoria.get_collection': coleccion,
+            'core.sesiones.get_db': lambda: self.db,
+            'core.adjuntos.get_db': lambda: self.db,
+            'core.colas.get_db': lambda: self.db,
+            'core.views.is_mongodb_available': lambda: True,
+            'core.permisos.is_mongodb_available': lambda: True,
+        }
+        for objetivo, valor in reemplazos.items():
+            parche = mock.patch(objetivo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+        invalidar_usuarios()
+        self.addCleanup(invalidar_usuarios)
+
+
+class PaginacionCursorTests(MongoEnMemoriaTestCase):
+    def setUp(self):
+        super().setUp()
+        base = datetime(2024, 1, 1)
+        self.collection = self.db['registros']
+        # Fechas repetidas, nulas y ausentes: el desempate es siempre el _id
+        fechas = [base, None, base + timedelta(days=2), base, 'ausente', None, base + timedelta(days=1)]
+        for fecha in fechas:
+            doc = {'_id': ObjectId()}
+            if fecha != 'ausente':
+                doc['fecha_creacion'] = fecha
+            self.collection.insert_one(doc)
+
+    def listar(self, limite_lista=None, **params):
+        request = Request(APIRequestFactory().get('/', params))
+        return listar_paginado(request, self.collection, {}, limite_lista=limite_lista)
+
+    def esperado(self, descendente=False):
+        docs = list(self.collection.find())
+        # Los nulos/ausentes van primero en orden ascendente
+        docs.sort(key=lambda d: (d.get('fecha_creacion') is not None, d.get('fecha_creacion') or datetime.min, d['_id']),
+                  reverse=descendente)
+        return [str(d['_id']) for d in docs]
+
+    def recorrer(self, orden):
+        paginas = []
+        respuesta = self.listar(cursor='', orden=orden, page_size=2)
+        while True:
+            self.assertEqual(respuesta.status_code, 200)
+            paginas.append(respuesta.data)
+            if not respuesta.data['next']:
+                return paginas
+            respuesta = self.listar(cursor=respuesta.data['next'], orden=orden, page_size=2)
+
+    def ids(self, pagina):
+        return [doc['_id'] for doc in pagina['results']]
+
+    def test_siguiente_recorre_todo_en_orden_con_fechas_nulas(self):
+        for orden, descendente in (('fecha_creacion', False), ('-fecha_creacion', True), ('_id', False)):
+            with self.subTest(orden=orden):
+                paginas = self.recorrer(orden)
+                ids = [i for pagina in paginas for i in self.ids(pagina)]
+                if orden == '_id':
+                    self.assertEqual(ids, sorted(ids))
+                    self.assertEqual(len(ids), 7)
+                else:
+                    self.assertEqual(ids, self.esperado(descendente))
+                self.assertFalse(paginas[-1]['has_more'])
+                self.assertIsNone(paginas[0]['prev'])
+
+    def test_anterior_vuelve_a_las_mismas_paginas(self):
+        paginas = self.recorrer('fecha_creacion')
+        actual = paginas[-1]
+        for pagina in reversed(paginas[:-1]):
+            respuesta = self.listar(cursor=actual['prev'], orden='fecha_creacion', page_size=2)
+            self.assertEqual(respuesta.status_code, 200)
+            self.assertEqual(self.ids(respuesta.data), self.ids(pagina))
+            actual = respuesta.data
+        self.assertIsNone(actual['prev'])
+
+    def test_cursor_alterado_o_de_otro_orden_responde_400(self):
+        siguiente = self.listar(cursor='', orden='fecha_creacion', page_size=2).data['next']
+        for cursor, orden in ((siguiente[:-3] + 'xyz', 'fecha_creacion'), ('no-es-un-cursor', 'fecha_creacion'),
+                              (siguiente, '_id')):
+            with self.subTest(cursor=cursor, orden=orden):
+                self.assertEqual(self.listar(cursor=cursor, orden=orden).status_code, 400)
+        self.assertEqual(self.listar(cursor='', orden='nombre').status_code, 400)
+
+    def test_fechas_de_texto_y_de_tipo_fecha_no_se_saltean_ni_se_repiten(self):
+        # Registros viejos con la fecha como texto: el sort de MongoDB pone los textos antes que las fechas
+        for fecha in ('2023-05-01', '2023-01-15', '2023-05-01'):
+            self.collection.insert_one({'_id': ObjectId(), 'fecha_creacion': fecha})
+        for orden, sentido in (('fecha_creacion', 1), ('-fecha_creacion', -1)):
+            with self.subTest(orden=orden):
+                esperado = [str(d['_id']) for d in self.collection.find().sort([('fecha_creacion', sentido), ('_id', sentido)])]
+                paginas = self.recorrer(orden)
+                self.assertEqual([i for pagina in paginas for i in self.ids(pagina)], esperado)
+
+    @override_settings(PAGINACION_MAX=3)
+    def test_sin_cursor_se_devuelve_la_lista_completa(self):
+        self.assertEqual(len(self.listar(page_size=2).data), self.collection.count_documents({}))
+
+    def test_sin_cursor_con_limite_se_pagina_como_antes(self):
+        self.assertEqual(len(self.listar(limite_lista=3).data), 3)
+        self.assertEqual(len(self.listar(limite_lista=3, page=3).data), 1)
+        self.assertEqual(len(self.listar(limite_lista=3, page_size=5).data), 5)
+
+
+class AdjuntosReferenciasTests(MongoEnMemoriaTestCase):
+    SHA = 'a' * 64
+
+    def setUp(self):
+        super().setUp()
+        self.files = self.db[f'{BUCKET_ADJUNTOS}.files']
+        self.chunks = self.db[f'{BUCKET_ADJUNTOS}.chunks']
+        # De a uno: mongomock ignora partialFilterExpression en create_indexes
+        for indice in INDICES[f'{BUCKET_ADJUNTOS}.files']:
+            opciones = dict(indice.document)
+            self.files.create_index(list(opciones.pop('key').items()), **opciones)
+
+    def archivo(self, sha256=SHA, **metadata):
+        """Archivo ya escrito en GridFS (documento de files y un chunk)."""
+        archivo_id = ObjectId()
+        self.files.insert_one({'_id': archivo_id, 'filename': 'a.pdf', 'length': 4,
+                               'metadata': {'contentType': 'application/pdf', 'sha256': sha256, **metadata}})
+        self.chunks.insert_one({'files_id': archivo_id, 'n': 0, 'data': b'%PDF'})
+        return archivo_id
+
+    def referencias(self, archivo_id):
+        return self.files.find_one({'_id': archivo_id})['metadata'].get('referencias')
+
+    def test_subida_pendiente_se_adopta_y_se_libera_al_quedar_sin_referencias(self):
+        archivo_id = self.archivo(pendiente=True)
+        self.assertEqual(adjuntos.referencia_gridfs(archivo_id)['archivo_id'], archivo_id)
+        self.assertEqual(self.referencias(archivo_id), 1)
+        self.assertEqual(adjuntos.referencia_gridfs(archivo_id)['archivo_id'], archivo_id)
+        self.assertEqual(self.referencias(archivo_id), 2)
+
+        adjuntos.liberar_adjunto(archivo_id)
+        self.assertEqual(self.referencias(archivo_id), 1)
+        adjuntos.liberar_adjunto(archivo_id)
+        self.assertIsNone(self.files.find_one({'_id': archivo_id}))
+        self.assertEqual(self.chunks.count_documents({'files_id': archivo_id}), 0)
+
+    def test_al_liberar_se_borran_tambien_las_variantes(self):
+        archivo_id = self.archivo(referencias=1)
+        variante = self.archivo(sha256='b' * 64, variante_de=archivo_id, variante='miniatura')
+        adjuntos.liberar_adjunto(archivo_id)
+        self.assertEqual(self.files.count_documents({}), 0)
+        self.assertEqual(self.chunks.count_documents({'files_id': variante}), 0)
+
+    def test_archivo_anterior_al_conteo_vale_una_referencia(self):
+        archivo_id = self.archivo()
+        adjuntos.referencia_gridfs(archivo_id)
+        self.assertEqual(self.referencias(archivo_id), 2)
+
+    def test_subida_con_el_mismo_contenido_reutiliza_el_archivo(self):
+        existente = self.archivo(referencias=1)
+        pendiente = self.archivo(pendiente=True)
+        self.assertEqual(adjuntos.referencia_gridfs(pendiente)['archivo_id'], existente)
+        self.assertEqual(self.referencias(existente), 2)
+        self.assertIsNone(self.files.find_one({'_id': pendiente}))
+        self.assertEqual(self.chunks.count_documents({'files_id': pendiente}), 0)
+
+    def test_dos_subidas_simultaneas_terminan_en_un_solo_archivo(self):
+        primera = self.archivo(pendiente=True)
+        segunda = self.archivo(pendiente=True)
+        sumar = adjuntos._sumar_referencia
+        vistos = []
+
+        def sin_ver_a_la_otra(filtro):
+            # La primera búsqueda de la segunda subida ocurre antes de que la primera se adopte
+            vistos.append(filtro)
+            return None if len(vistos) == 1 else sumar(filtro)
+
+        adjuntos.referencia_gridfs(primera)
+        with mock.patch('core.adjuntos._sumar_referencia', side_effect=sin_ver_a_la_otra):
+            ref = adjuntos.referencia_gridfs(segunda)
+        self.assertEqual(ref['archivo_id'], primera)
+        self.assertEqual(self.referencias(primera), 2)
+        self.assertEqual(self.files.count_documents({'metadata.sha256': self.SHA}), 1)
+
+    def test_no_se_reutiliza_un_archivo_que_esta_por_borrarse(self):
+        muerto = self.archivo(referencias=0)
+        pendiente = self.archivo(pendiente=True)
+        self.assertEqual(adjuntos.referencia_gridfs(pendiente)['archivo_id'], pendiente)
+        self.assertIsNone(self.files.find_one({'_id': muerto}))
+        self.assertEqual(self.referencias(pendiente), 1)
+
+
+@override_settings(BCRYPT_ROUNDS=4, AUDITORIA_ASINCRONA=False, SESION_ACEPTAR_HEADER_EMAIL=False)
+class SesionTokenTests(MongoEnMemoriaTestCase):
+    URL = '/api/seguimiento/'
+
+    def setUp(self):
+        super().setUp()
+        parche = mock.patch('core.sesiones.revocaciones', ListaRevocaciones())
+        parche.start()
+        self.addCleanup(parche.stop)
+        self.client = Client(HTTP_HOST='localhost')
+        self.usuarios = self.db['usuarios']
+        self.usuarios.insert_many([
+            {'Email': 'admin@correo.com', 'Nombre': 'Admin', 'Cargo': 'Admin', 'Password': hashear('clave1234'),
+             'activo': True, 'permisos_version': 0},
+            {'Email': 'tecnico@correo.com', 'Nombre': 'Técnico', 'Cargo': 'Tecnico', 'Password': hashear('clave1234'),
+             'activo': True, 'permisos_version': 0},
+        ])
+
+    def usuario(self, email='admin@correo.com'):
+        return self.usuarios.find_one({'Email': email})
+
+    def con_token(self, token, **extra):
+        return self.client.get(self.URL, HTTP_AUTHORIZATION=f'Bearer {token}', **extra)
+
+    def test_login_entrega_un_token_que_identifica_al_usuario(self):
+        respuesta = self.client.post('/api/login/', {'Email': 'admin@correo.com', 'Password': 'clave1234'},
+                                     content_type='application/json')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertIn('token_expira_en', respuesta.json())
+        self.assertEqual(self.con_token(respuesta.json()['token']).status_code, 200)
+
+    def test_el_header_de_email_no_reemplaza_al_usuario_del_token(self):
+        token, _ = emitir_token(self.usuario('tecnico@correo.com'))
+        self.assertEqual(self.con_token(token, HTTP_X_USER_EMAIL='admin@correo.com').status_code, 403)
+
+    def test_token_alterado_o_vencido_responde_401(self):
+        token, _ = emitir_token(self.usuario())
+        self.assertEqual(self.con_token(token[:-2] + 'xx').status_code, 401)
+        with mock.patch('time.time', return_value=time.time() - 13 * 3600):
+            vencido, _ = emitir_token(self.usuario())
+        with override_settings(SESION_TOKEN_HORAS=12):
+            respuesta = self.con_token(vencido)
+        self.assertEqual(respuesta.status_code, 401)
+        self.assertIn('expiró', respuesta.json()['error'])
+
+    def test_cambio_de_cargo_vuelve_a_leer_el_usuario(self):
+        token, _ = emitir_token(self.usuario())
+        self.usuarios.update_one({'Email': 'admin@correo.com'}, {'$set': {'Cargo': 'Tecnico'}})
+        revocar_sesiones(self.usuario()['_id'])
+        self.assertEqual(self.con_token(token).status_code, 403)
+
+    def test_desactivar_revoca_el_token(self):
+        token, _ = emitir_token(self.usuario())
+        self.usuarios.update_one({'Email': 'admin@correo.com'}, {'$set': {'activo': False}})
+        revocar_sesiones(self.usuario()['_id'])
+        self.assertEqual(self.con_token(token).status_code, 401)
+
+    def test_cambio_de_contrasena_rechaza_los_tokens_anteriores(self):
+        anterior, _ = emitir_token(self.usuario())
+        respuesta = self.client.put('/api/usuarios/me/', {'Password': 'otra-clave-1234'}, content_type='application/json',
+                                    HTTP_AUTHORIZATION=f'Bearer {anterior}')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotIn('Password', respuesta.json())
+        self.assertEqual(self.con_token(anterior).status_code, 401)
+        self.assertEqual(self.con_token(respuesta.json()['token']).status_code, 200)
+
+    def test_header_de_email_sin_token_se_rechaza_salvo_que_este_habilitado(self):
+        self.assertEqual(self.client.get(self.URL, HTTP_X_USER_EMAIL='admin@correo.com').status_code, 401)
+        with override_settings(SESION_ACEPTAR_HEADER_EMAIL=True):
+            self.assertEqual(self.client.get(self.URL, HTTP_X_USER_EMAIL='admin@correo.com').status_code, 200)
+
+
+class LimpiarDetalleTests(SimpleTestCase):
+    def test_quita_base64_y_bytes_y_deja_tamaño_y_sha256(self):
+        pdf = b'%PDF-1.4 ' + b'x' * 3000
+        data_uri = 'data:application/pdf;base64,' + base64.b64encode(pdf).decode('ascii')
+        crudo = base64.b64encode(pdf).decode('ascii')
+        limpio = limpiar_detalle({'archivo_pdf': data_uri, 'fotos': [crudo], 'firma': pdf, 'placa': 'ABC-123'},
+                                 texto_max=100)
+        self.assertEqual(limpio['placa'], 'ABC-123')
+        self.assertEqual(limpio['archivo_pdf'], {'omitido': 'base64', 'bytes': len(data_uri),
+                                                 'sha256': hashlib.sha256(data_uri.encode('utf-8')).hexdigest()})
+        self.assertEqual(limpio['fotos'][0]['omitido'], 'base64')
+        self.assertEqual(limpio['firma'], {'omitido': 'binario', 'bytes': len(pdf),
+                                           'sha256': hashlib.sha256(pdf).hexdigest()})
+
+    def test_recorta_textos_largos_que_no_son_base64(self):
+        texto = 'observación con espacios ' * 20
+        limpio = limpiar_detalle({'detalle': texto, 'corto': 'abc'}, texto_max=50)
+        self.assertEqual(limpio['corto'], 'abc')
+        self.assertTrue(limpio['detalle'].startswith(texto[:50]))
+        self.assertIn(f'{len(texto) - 50} caracteres omitidos', limpio['detalle'])
+
+    def test_no_modifica_el_detalle_original(self):
+        detalle = {'archivo_pdf': 'A' * 5000}
+        limpiar_detalle(detalle, texto_max=100)
+        self.assertEqual(detalle['archivo_pdf'], 'A' * 5000)
+
+
+class EscritorAuditoriaTests(MongoEnMemoriaTestCase):
+    def test_vaciar_guarda_en_lotes_y_un_reintento_no_duplica(self):
+        escritor = EscritorAuditoria()
+        with override_settings(AUDITORIA_LOTE=2, AUDITORIA_ASINCRONA=True):
+            docs = [{'_id': ObjectId(), 'accion': 'login', 'n': i} for i in range(5)]
+            escritor._encolar(docs)
+            self.assertEqual(escritor.vaciar(), 5)
+            # Un lote que ya se había guardado y vuelve al buffer (fallo al confirmar)
+            escritor._encolar(docs[:2])
+            escritor.vaciar()
+        self.assertEqual(self.db['seguimiento'].count_documents({}), 5)
+        self.assertEqual(escritor.estadisticas()['pendientes'], 0)
+
+    def test_actualizar_pendiente_modifica_el_evento_del_buffer(self):
+        escritor = EscritorAuditoria()
+        escritor._encolar([{'_id': ObjectId(), 'usuario_email': 'a@correo.com', 'accion': 'login'}])
+        fecha = datetime(2024, 1, 1)
+        es_login = lambda doc: doc['accion'] == 'login'
+        self.assertTrue(escritor.actualizar_pendiente(es_login, {'fecha_logout': fecha}))
+        escritor.vaciar()
+        self.assertEqual(self.db['seguimiento'].find_one()['fecha_logout'], fecha)
+        self.assertFalse(escritor.actualizar_pendiente(es_login, {'fecha_logout': fecha}))
+
+
+class ColaMongoTests(MongoEnMemoriaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cola = ColaMongo('cola_pruebas', max_intentos=2)
+        self.coleccion = self.db['cola_pruebas']
+
+    def encolar(self, **campos):
+        return self.coleccion.insert_one(dict({'estado': 'pendiente', 'intentos': 0,
+                                               'disponible_en': datetime.now()}, **campos)).inserted_id
+
+    def test_tomar_reserva_pendientes_y_los_de_bloqueo_vencido(self):
+        pendiente = self.encolar()
+        abandonado = self.encolar(estado='procesando', bloqueado_hasta=datetime.now() - timedelta(minutes=1))
+        self.encolar(estado='procesando', bloqueado_hasta=datetime.now() + timedelta(minutes=1))
+        self.encolar(disponible_en=datetime.now() + timedelta(minutes=10))
+        tomados = {self.cola.tomar()['_id'], self.cola.tomar()['_id']}
+        self.assertEqual(tomados, {pendiente, abandonado})
+        self.assertIsNone(self.cola.tomar())
+        self.assertEqual(self.coleccion.find_one({'_id': pendiente})['intentos'], 1)
+
+    def test_reintenta_con_espera_creciente_y_despues_queda_en_error(self):
+        doc_id = self.encolar()
+
+        def fallar(doc):
+            raise RuntimeError('sin conexión')
+
+        self.assertEqual(self.cola.procesar_pendientes(fallar), (0, 1))
+        doc = self.coleccion.find_one({'_id': doc_id})
+        self.assertEqual(doc['estado'], 'pendiente')
+        self.assertGreater(doc['disponible_en'], datetime.now() + timedelta(seconds=90))
+        self.coleccion.update_one({'_id': doc_id}, {'$set': {'disponible_en': datetime.now()}})
+        self.assertEqual(self.cola.procesar_pendientes(fallar), (0, 1))
+        doc = self.coleccion.find_one({'_id': doc_id})
+        self.assertEqual((doc['estado'], doc['error']), ('error', 'sin conexión'))
+
+    def test_sin_reintento_y_borrado_de_los_procesados(self):
+        invalido, valido = self.encolar(valido=False), self.encolar(valido=True)
+
+        def procesar(doc):
+            if not doc['valido']:
+                raise ValueError('archivo dañado')
+            return True
+
+        self.assertEqual(self.cola.procesar_pendientes(procesar, sin_reintento=(ValueError,)), (1, 1))
+        self.assertIsNone(self.coleccion.find_one({'_id': valido}))
+        self.assertEqual(self.coleccion.find_one({'_id': invalido})['estado'], 'error')
+
+
+class MongoConexionDespuesDeForkTests(SimpleTestCase):
+    def test_un_worker_creado_con_el_breaker_abierto_vuelve_a_intentar(self):
+        breaker = mongo_connection.CircuitBreaker()
+        with mock.patch.object(mongo_connection, 'breaker', breaker), \
+                mock.patch.object(mongo_connection, '_start_monitor') as iniciar_monitor, \
+                mock.patch.object(mongo_connection, '_ping', return_value=False) as ping:
+            breaker.record_failure(ConnectionError('caído'), trip=True)
+            self.assertFalse(breaker.allow_request())
+            mongo_connection._after_fork_in_child()
+            self.assertTrue(breaker.allow_request())
+            self.assertIsNone(mongo_connection.get_client())
+        iniciar_monitor.assert_called_once()
+        ping.assert_called_once_with(trip=True)
+
+
+def _permiso_fila_por_fila(user, required_role=None, required_permission=None, module=None):
+    """check_user_permissions tal como era antes de compilar la matriz (referencia de las pruebas)."""
+    if not user:
+        return False
+    cargo = user.get('Cargo', '').lower()
+    if required_role:
+        if required_role == 'admin' and cargo != 'admin':
+            return False
+        elif required_role == 'encargado' and cargo not in ['admin', 'encargado']:
+            return False
+        elif required_role == 'tecnico' and cargo not in ['admin', 'encargado', 'tecnico', 'técnico']:
+            return False
+    if cargo == 'admin':
+        return not (module == 'Maquinaria' and required_permission in ['crear', 'editar', 'eliminar'])
+    if cargo == 'encargado':
+        return not (module == 'Usuarios' and required_permission in ['crear', 'editar', 'eliminar'])
+    if cargo == 'tecnico' or cargo == 'técnico':
+        if not module or not required_permission:
+            return True
+        if module in ['Maquinaria', 'HistorialControl', 'ActaAsignacion', 'Mantenimiento', 'Seguro', 'ITV',
+                      'Impuesto', 'SOAT', 'Liberacion']:
+            if required_permission == 'crear':
+                return True
+            elif required_permission in ['editar', 'eliminar']:
+                return False
+        if module == 'Depreciaciones' and required_permission == 'crear':
+            return True
+        return user.get('permisos', {}).get(module, {}).get(required_permission, False)
+    return False
+
+
+class MatrizPermisosTests(SimpleTestCase):
+    MODULOS = (None, 'Maquinaria', 'HistorialControl', 'Seguro', 'Liberacion', 'Depreciaciones', 'Usuarios',
+               'Pronostico', 'Reportes')
+    ACCIONES = (None, 'crear', 'editar', 'eliminar', 'ver')
+    ROLES = (None, 'admin', 'encargado', 'tecnico')
+
+    def setUp(self):
+        invalidar_permisos()
+        self.addCleanup(invalidar_permisos)
+
+    def usuarios(self):
+        permisos = {
+            'Maquinaria': {'editar': True, 'eliminar': True, 'ver': True},
+            'Depreciaciones': {'crear': False, 'editar': True},
+            'Usuarios': {'ver': True, 'editar': False},
+            'Reportes': {'ver': True},
+        }
+        cargos = ('admin', 'Admin', 'encargado', 'Encargado', 'tecnico', 'Técnico', 'técnico', 'operador', '')
+        for n, cargo in enumerate(cargos):
+            yield {'Email': f'usuario{n}@correo.com', 'Cargo': cargo, 'permisos': permisos}
+            yield {'Cargo': cargo}
+        yield None
+
+    def test_la_matriz_responde_igual_que_la_verificacion_fila_por_fila(self):
+        for user in self.usuarios():
+            for rol in self.ROLES:
+                for modulo in self.MODULOS:
+                    for accion in self.ACCIONES:
+                        with self.subTest(user=user, rol=rol, modulo=modulo, accion=accion):
+                            esperado = bool(_permiso_fila_por_fila(user, rol, accion, modulo))
+                            # Dos veces: la segunda sale de la caché de matrices
+                            self.assertIs(tiene_permiso(user, rol, accion, modulo), esperado)
+                            self.assertIs(tiene_permiso(user, rol, accion, modulo), esperado)
+
+    def test_cambiar_los_permisos_se_ve_despues_de_invalidar(self):
+        user = {'Email': 'tecnico@correo.com', 'Cargo': 'tecnico', 'permisos': {'Reportes': {'ver': False}}}
+        self.assertFalse(tiene_permiso(user, required_permission='ver', module='Reportes'))
+        user['permisos']['Reportes']['ver'] = True
+        invalidar_permisos()
+        self.assertTrue(tiene_permiso(user, required_permission='ver', module='Reportes'))
+
+
+@skipUnless(pd, 'Requiere pandas')
+class GuardarPronosticosExcelTests(MongoEnMemoriaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = self.db['pronostico']
+        modelo = mock.patch('core.views.registro_modelo')
+        self.modelo = modelo.start()
+        self.addCleanup(modelo.stop)
+        self.modelo.predict_batch.side_effect = lambda df: [
+            {'resultado': f"Preventivo {fila['horas_op']}", 'riesgo': 'ALTO' if fila['horas_op'] > 1000 else 'BAJO'}
+            for fila in df.to_dict('records')
+        ]
+        # mongomock numera `upserted` por cantidad de upserts y no por índice de operación como MongoDB
+        bulk = mock.patch.object(mongomock.collection.Collection, 'bulk_write', self.bulk_write_por_operacion)
+        bulk.start()
+        self.addCleanup(bulk.stop)
+
+    @staticmethod
+    def bulk_write_por_operacion(collection, operaciones, ordered=True):
+        upserted_ids = {}
+        for indice, operacion in enumerate(operaciones):
+            resultado = collection.update_one(operacion._filter, operacion._doc, upsert=True)
+            if resultado.upserted_id is not None:
+                upserted_ids[indice] = resultado.upserted_id
+        return mock.Mock(upserted_ids=upserted_ids)
+
+    def validas(self, filas):
+        # Índice original de cada fila del Excel (con huecos donde hubo filas inválidas)
+        return pd.DataFrame(filas, columns=['placa', 'fecha_asig', 'horas_op', 'recorrido'],
+                            index=[i * 2 for i in range(len(filas))])
+
+    def guardar_fila_por_fila(self, collection, filas):
+        """Estado de cada fila como se guardaba antes: un find_one y un insert o update por fila."""
+        estados = []
+        for placa, fecha, horas, recorrido in filas:
+            data = {'placa': placa, 'fecha_asig': fecha, 'horas_op': horas, 'recorrido': recorrido}
+            pronostico = {'resultado': f"Preventivo {horas}", 'riesgo': 'ALTO' if horas > 1000 else 'BAJO'}
+            data.update({campo: pronostico.get(campo) for campo in CAMPOS_RESULTADO_PRONOSTICO})
+            existente = collection.find_one({'placa': placa, 'fecha_asig': fecha})
+            if existente:
+                collection.update_one({'_id': existente['_id']}, {'$set': data})
+                estados.append('actualizado')
+            else:
+                collection.insert_one(data)
+                estados.append('creado')
+        return estados
+
+    def sin_ids(self, collection):
+        return sorted((sorted((k, v) for k, v in doc.items() if k != '_id') for doc in collection.find()), key=str)
+
+    def test_creado_y_actualizado_como_al_guardar_fila_por_fila(self):
+        existente = {'placa': 'AAA-111', 'fecha_asig': '2024-01-01', 'horas_op': 10, 'recorrido': 5}
+        self.collection.insert_one(dict(existente))
+        antes = self.db['pronostico_antes']
+        antes.insert_one(dict(existente))
+        filas = [
+            ('AAA-111', '2024-01-01', 100, 50),
+            ('BBB-222', '2024-01-02', 200, 60),
+            ('BBB-222', '2024-01-02', 1500, 70),
+            ('CCC-333', '2024-01-03', 300, 80),
+            ('BBB-222', '2024-01-05', 400, 90),
+        ]
+
+        resultados, alertas = guardar_pronosticos_excel(self.validas(filas))
+
+        self.assertEqual([r['estado'] for r in resultados], self.guardar_fila_por_fila(antes, filas))
+        self.assertEqual([r['fila'] for r in resultados], [1, 3, 5, 7, 9])
+        # Con la clave repetida gana la última fila, igual que con los updates sucesivos
+        self.assertEqual(self.sin_ids(self.collection), self.sin_ids(antes))
+        self.assertEqual([a['placa'] for a in alertas], ['BBB-222'])
+
+    def test_los_errores_del_bulk_vuelven_a_sus_filas(self):
+        filas = [
+            ('AAA-111', '2024-01-01', 100, 50),
+            ('BBB-222', '2024-01-02', 200, 60),
+            ('BBB-222', '2024-01-02', 250, 65),
+            ('CCC-333', '2024-01-03', 300, 80),
+        ]
+        # Índices de las operaciones (una por clave): 0 AAA, 1 BBB, 2 CCC
+        error = BulkWriteError({
+            'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key'}],
+            'upserted': [{'index': 0, '_id': ObjectId()}],
+        })
+        collection = mock.Mock()
+        collection.bulk_write.side_effect = error
+        with mock.patch('core.views.get_collection', return_value=collection):
+            resultados, _ = guardar_pronosticos_excel(self.validas(filas))
+
+        self.assertEqual([(r['placa'], r['estado']) for r in resultados], [
+            ('AAA-111', 'creado'), ('BBB-222', 'error'), ('BBB-222', 'error'), ('CCC-333', 'actualizado'),
+        ])
+        self.assertEqual(resultados[1]['error'], 'E11000 duplicate key')
+        self.assertFalse(collection.bulk_write.call_args.kwargs['ordered'])
+
+
+class OpcionesMaquinariaTests(MongoEnMemoriaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db['maquinaria'].insert_many([
+            {'unidad': 'POTOSÍ', 'tipo': 'Volqueta', 'marca': 'Volvo', 'modelo': 2015, 'color': 'Blanco',
+             'adqui': 'Compra', 'gestion': '2020'},
+            {'unidad': 'POTOSÍ', 'tipo': 'Excavadora', 'marca': ' ', 'modelo': '320D', 'color': None},
+            {'unidad': 'OF. CENTRAL', 'tipo': 'Volqueta', 'marca': 'Caterpillar', 'gestion': ''},
+            {},
+        ])
+        self.db['historial_control'].insert_many([
+            {'ubicacion': 'Tupiza', 'gerente': 'Ana Pérez', 'encargado': 'Luis Mamani'},
+            {'ubicacion': 'Tupiza', 'gerente': None, 'encargado': 'Luis Mamani'},
+        ])
+        self.db['mantenimiento'].insert_many([{'lugar': 'Taller central'}, {'lugar': ''}, {'lugar': 'Uyuni'}])
+        opciones_maquinaria.invalidar()
+        self.addCleanup(opciones_maquinaria.invalidar)
+        self.client = Client(HTTP_HOST='localhost')
+
+    def opciones_fila_por_fila(self):
+        """Opciones como se armaban antes: recorriendo todos los documentos de cada colección."""
+        opciones = {opcion: set() for campos in opciones_maquinaria.fuentes.values() for opcion in campos}
+        for coleccion, campos in opciones_maquinaria.fuentes.items():
+            for doc in self.db[coleccion].find({}):
+                for opcion, campo in campos.items():
+                    if doc.get(campo):
+                        opciones[opcion].add(str(doc[campo]))
+        return {opcion: sorted(v for v in valores if v and v.strip()) for opcion, valores in opciones.items()}
+
+    def test_mismas_opciones_y_304_con_el_etag(self):
+        respuesta = self.client.get('/api/maquinaria/options/')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json(), self.opciones_fila_por_fila())
+        self.assertEqual(respuesta['Cache-Control'], 'private, no-cache')
+
+        hits = opciones_maquinaria.stats()['hits']
+        respuesta = self.client.get('/api/maquinaria/options/', HTTP_IF_NONE_MATCH=respuesta['ETag'])
+        self.assertEqual(respuesta.status_code, 304)
+        self.assertEqual(respuesta.content, b'')
+        self.assertEqual(opciones_maquinaria.stats()['hits'], hits + 1)
+
+    def test_registrar_un_documento_nuevo_cambia_las_opciones_y_el_etag(self):
+        etag = self.client.get('/api/maquinaria/options/')['ETag']
+        for coleccion, doc in (('maquinaria', {'unidad': 'UYUNI', 'marca': 'Volvo'}),
+                               ('historial_control', {'ubicacion': 'Atocha', 'gerente': '  '})):
+            self.db[coleccion].insert_one(doc)
+            opciones_maquinaria.registrar(coleccion, doc)
+
+        respuesta = self.client.get('/api/maquinaria/options/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertNotEqual(respuesta['ETag'], etag)
+        self.assertEqual(respuesta.json(), self.opciones_fila_por_fila())
+
+
+class OpcionesUsuariosTests(MongoEnMemoriaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db['usuarios'].insert_many([{'Cargo': 'admin'}, {'Cargo': 'tecnico'}, {'Cargo': 'tecnico'}, {}])
+        self.db['maquinaria'].insert_many([{'unidad': 'POTOSÍ'}, {'unidad': 'TUPIZA'}])
+        # mongomock no implementa $trim ni $indexOfCP: la normalización de cargos y unidades
+        # solo corre en MongoDB; aquí se prueban el ETag y la invalidación con los campos tal cual
+        fuentes = mock.patch.object(opciones_usuarios, 'fuentes', {
+            'usuarios': {'cargos': 'Cargo'}, 'maquinaria': {'unidades': 'unidad'},
+        })
+        fuentes.start()
+        self.addCleanup(fuentes.stop)
+        opciones_usuarios.invalidar()
+        self.addCleanup(opciones_usuarios.invalidar)
+        self.client = Client(HTTP_HOST='localhost')
+
+    def test_304_hasta_que_se_modifica_un_usuario_o_una_maquinaria(self):
+        respuesta = self.client.get('/api/usuarios/opciones/')
+        self.assertEqual(respuesta.json(), {'cargos': ['admin', 'tecnico'], 'unidades': ['POTOSÍ', 'TUPIZA']})
+        etag = respuesta['ETag']
+        self.assertEqual(self.client.get('/api/usuarios/opciones/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.db['usuarios'].insert_one({'Cargo': 'encargado'})
+        # Sin invalidar se sigue sirviendo la versión en memoria
+        self.assertEqual(self.client.get('/api/usuarios/opciones/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        usuario_modificado()
+        respuesta = self.client.get('/api/usuarios/opciones/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['cargos'], ['admin', 'encargado', 'tecnico'])
+        etag = respuesta['ETag']
+
+        self.db['maquinaria'].insert_one({'unidad': 'UYUNI'})
+        maquinaria_modificada(ObjectId())
+        respuesta = self.client.get('/api/usuarios/opciones/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json()['unidades'], ['POTOSÍ', 'TUPIZA', 'UYUNI'])
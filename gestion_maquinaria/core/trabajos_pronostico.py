@@ -0,0 +1,192 @@
+"""
+Cargas de Excel de pronósticos en segundo plano.
+
+Un Excel grande (o subido con ?async=1) no se procesa dentro del request: la vista guarda
+las filas ya normalizadas en lotes (`trabajos_pronostico_lotes`), crea el trabajo en
+`trabajos_pronostico` y responde 202 con su id. Un worker (hilo del proceso o el comando
+`procesar_trabajos_pronostico`) procesa lote por lote y guarda el avance después de cada
+uno, así que si el proceso se reinicia el trabajo se retoma desde el último lote guardado.
+Al terminar se encola un solo correo de resumen con las máquinas de riesgo alto.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from .colas import MINUTOS_BLOQUEO, SEGUNDOS_ESPERA_WORKER, ColaMongo, WorkerEnProceso
+from .mongo_connection import get_db
+
+logger = logging.getLogger(__name__)
+
+COLECCION_TRABAJOS = 'trabajos_pronostico'
+COLECCION_LOTES = 'trabajos_pronostico_lotes'
+COLUMNAS = ['placa', 'fecha_asig', 'horas_op', 'recorrido']
+FILAS_POR_LOTE = 200
+# Errores por fila que se guardan en el trabajo (los conteos siempre son completos)
+MAX_ERRORES_REPORTADOS = 1000
+MAX_INTENTOS = 3
+
+# El bloqueo (MINUTOS_BLOQUEO) se renueva en cada lote: si el worker se cae, otro retoma el trabajo
+cola = ColaMongo(COLECCION_TRABAJOS, max_intentos=MAX_INTENTOS, proyeccion={'errores_filas': 0, 'alertas': 0})
+
+
+def get_trabajos_collection():
+    return cola.collection()
+
+
+def get_lotes_collection():
+    db = get_db()
+    if db is None:
+        raise ConnectionError("MongoDB no disponible")
+    return db[COLECCION_LOTES]
+
+
+def crear_trabajo(validas, errores_filas, total_filas, archivo, creado_por=None):
+    """
+    Guarda las filas válidas (DataFrame con el índice original de cada fila) en lotes y
+    encola el trabajo. `errores_filas` son las filas que ya fallaron al validar el Excel.
+    """
+    trabajos = get_trabajos_collection()
+    lotes = get_lotes_collection()
+    trabajo_id = ObjectId()
+    ahora = datetime.now()
+
+    filas = [dict(datos, fila=index + 1) for index, datos in validas[COLUMNAS].to_dict('index').items()]
+    documentos_lotes = [
+        {'trabajo_id': trabajo_id, 'numero': numero, 'filas': filas[inicio:inicio + FILAS_POR_LOTE], 'creado_en': ahora}
+        for numero, inicio in enumerate(range(0, len(filas), FILAS_POR_LOTE))
+    ]
+    if documentos_lotes:
+        lotes.insert_many(documentos_lotes, ordered=False)
+    # El trabajo se crea después de sus lotes: el worker nunca ve un trabajo incompleto
+    trabajos.insert_one({
+        '_id': trabajo_id,
+        'estado': 'pendiente',
+        'archivo': archivo,
+        'creado_por': creado_por,
+        'total_filas': total_filas,
+        'lotes': len(documentos_lotes),
+        'lotes_procesados': 0,
+        'procesadas': len(errores_filas),
+        'exitosos': 0,
+        'creados': 0,
+        'actualizados': 0,
+        'errores': len(errores_filas),
+        'errores_filas': errores_filas[:MAX_ERRORES_REPORTADOS],
+        'alertas': [],
+        'intentos': 0,
+        'disponible_en': ahora,
+        'creado_en': ahora,
+        'actualizado_en': ahora,
+    })
+    despertar_worker()
+    return trabajo_id
+
+
+def obtener_trabajo(trabajo_id):
+    if not ObjectId.is_valid(trabajo_id):
+        return None
+    return get_trabajos_collection().find_one({'_id': ObjectId(trabajo_id)})
+
+
+def serializar_trabajo(trabajo):
+    total = trabajo.get('total_filas') or 0
+    procesadas = trabajo.get('procesadas', 0)
+    datos = {
+        'job_id': str(trabajo['_id']),
+        'estado': trabajo['estado'],
+        'archivo': trabajo.get('archivo'),
+        'progreso': {
+            'procesadas': procesadas,
+            'total_filas': total,
+            'porcentaje': round(procesadas * 100 / total, 1) if total else 100.0,
+        },
+        'resumen': {
+            'total_filas': total,
+            'exitosos': trabajo.get('exitosos', 0),
+            'creados': trabajo.get('creados', 0),
+            'actualizados': trabajo.get('actualizados', 0),
+            'errores': trabajo.get('errores', 0),
+        },
+        'errores_filas': sorted(trabajo.get('errores_filas', []), key=lambda r: r['fila']),
+        'creado_en': trabajo['creado_en'].isoformat(),
+        'terminado_en': trabajo['terminado_en'].isoformat() if trabajo.get('terminado_en') else None,
+    }
+    if trabajo['estado'] == 'completado':
+        datos['mensaje'] = (f"Procesamiento completado. {datos['resumen']['exitosos']} pronósticos procesados "
+                            f"exitosamente, {datos['resumen']['errores']} errores.")
+    if trabajo.get('error'):
+        datos['error'] = trabajo['error']
+    return datos
+
+
+# --- Procesamiento ---
+
+def tomar_trabajo():
+    return cola.tomar()
+
+
+def procesar_trabajo(trabajo):
+    """
+    Procesa los lotes que le faltan al trabajo, guardando el avance después de cada uno.
+    Devuelve False si otro worker lo retomó mientras tanto.
+    """
+    import pandas as pd
+    # El guardado es el mismo de la carga directa del Excel
+    from .views import encolar_resumen_pronosticos, guardar_pronosticos_excel
+
+    trabajos = get_trabajos_collection()
+    lotes = get_lotes_collection()
+    pendientes = lotes.find(
+        {'trabajo_id': trabajo['_id'], 'numero': {'$gte': trabajo['lotes_procesados']}}
+    ).sort('numero', 1)
+    for lote in pendientes:
+        filas = lote['filas']
+        validas = pd.DataFrame(filas, index=[f['fila'] - 1 for f in filas], columns=COLUMNAS)
+        resultados, alertas = guardar_pronosticos_excel(validas)
+        errores = [r for r in resultados if r['estado'] == 'error']
+        creados = sum(1 for r in resultados if r['estado'] == 'creado')
+        ahora = datetime.now()
+        # Si el lote se repite tras una caída, los upserts lo dejan igual; el avance se guarda una sola vez
+        avance = trabajos.update_one(
+            {'_id': trabajo['_id'], 'estado': 'procesando', 'lotes_procesados': lote['numero']},
+            {'$set': {'lotes_procesados': lote['numero'] + 1, 'actualizado_en': ahora,
+                      'bloqueado_hasta': ahora + timedelta(minutes=MINUTOS_BLOQUEO)},
+             '$inc': {'procesadas': len(filas), 'exitosos': len(resultados) - len(errores), 'creados': creados,
+                      'actualizados': len(resultados) - len(errores) - creados, 'errores': len(errores)},
+             '$push': {'errores_filas': {'$each': errores, '$slice': MAX_ERRORES_REPORTADOS},
+                       'alertas': {'$each': alertas}}},
+        )
+        if not avance.matched_count:
+            return False
+
+    terminado = trabajos.find_one_and_update(
+        {'_id': trabajo['_id'], 'estado': 'procesando'},
+        {'$set': {'estado': 'completado', 'terminado_en': datetime.now()}, '$unset': {'bloqueado_hasta': ''}},
+        projection={'alertas': 1, 'exitosos': 1},
+    )
+    if terminado is None:
+        return False
+    lotes.delete_many({'trabajo_id': trabajo['_id']})
+    try:
+        encolar_resumen_pronosticos(terminado.get('alertas', []), terminado.get('exitosos', 0))
+    except Exception as e:
+        logger.error(f"Error al encolar el resumen del trabajo de pronóstico {trabajo['_id']}: {e}")
+    return True
+
+
+def procesar_trabajos(limite=None):
+    """Procesa trabajos hasta vaciar la cola (o llegar a `limite`). Devuelve (completados, errores)."""
+    # Los trabajos completados quedan en la colección para consultar el resultado; un reintento
+    # sigue desde el último lote guardado
+    return cola.procesar_pendientes(procesar_trabajo, limite, borrar=False,
+                                    describir=lambda trabajo: f"el trabajo de pronóstico {trabajo['_id']}")
+
+
+# Hilo dentro del proceso web (o el comando `procesar_trabajos_pronostico` si
+# PRONOSTICO_WORKER_EN_PROCESO está apagado)
+worker = WorkerEnProceso(procesar_trabajos, 'worker-pronosticos', 'PRONOSTICO_WORKER_EN_PROCESO')
+
+
+def despertar_worker():
+    worker.despertar()
@@ -9,6 +9,7 @@ from .views import (
     ReenviarCodigoRegistroView,
     PronosticoSummaryView,
     PronosticoExcelUploadView,
+    PronosticoJobView,
     UsuarioListView,
     UsuarioCargoUpdateView,
     UsuarioMemorandumUpdateView,
@@ -53,7 +54,12 @@ from .views import (
     ControlOdometroDetailView,
     SolicitarResetPasswordView,
     VerificarCodigoResetPasswordView,
-    ReenviarCodigoResetPasswordView
+    ReenviarCodigoResetPasswordView,
+    CacheEstadisticasView,
+    AdjuntoDescargaView,
+    SubidaAdjuntoView,
+    SubidaAdjuntoDetalleView,
+    AdjuntosEstadisticasView
 )
 
 router = DefaultRouter()
@@ -69,6 +75,7 @@ urlpatterns = [
     path('dashboard/', DashboardStatsView.as_view(), name='dashboard'),
     path('api/pronostico/summary/', PronosticoSummaryView.as_view(), name='pronostico-summary'),
     path('api/pronostico/excel-upload/', PronosticoExcelUploadView.as_view(), name='pronostico-excel-upload'),
+    path('api/pronostico/jobs/<str:job_id>/', PronosticoJobView.as_view(), name='pronostico-job'),
     path('usuarios/', UsuarioListView.as_view(), name='usuarios-list'),
     path('usuarios/opciones/', UsuarioOpcionesView.as_view(), name='usuarios-opciones'),
     path('usuarios/crear/', CrearUsuarioView.as_view(), name='usuarios-crear'),
@@ -96,6 +103,11 @@ urlpatterns = [
     path('api/maquinaria/<str:maquinaria_id>/desactivados/', RegistrosDesactivadosView.as_view(), name='registros-desactivados'),
     path('api/registros-desactivados/', TodosRegistrosDesactivadosView.as_view(), name='todos-registros-desactivados'),
     path('api/test/', test_api, name='test-api'),
+    path('cache/estadisticas/', CacheEstadisticasView.as_view(), name='cache-estadisticas'),
+    path('adjuntos/estadisticas/', AdjuntosEstadisticasView.as_view(), name='adjuntos-estadisticas'),
+    path('adjuntos/subidas/', SubidaAdjuntoView.as_view(), name='adjunto-subidas'),
+    path('adjuntos/subidas/<str:subida_id>/', SubidaAdjuntoDetalleView.as_view(), name='adjunto-subida-detalle'),
+    path('adjuntos/<str:archivo_id>/', AdjuntoDescargaView.as_view(), name='adjunto-descarga'),
     # Detalle de maquinaria (GET/PUT/PATCH/DELETE)
     path('api/maquinaria/<str:id>/', MaquinariaDetailView.as_view(), name='maquinaria-detail'),
     
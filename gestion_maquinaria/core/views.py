@@ -1,10 +1,16 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework import status, serializers
 from rest_framework.views import APIView
 from django.core.exceptions import ObjectDoesNotExist
-from bson import ObjectId, json_util
-import json, requests, logging, os, traceback, re
+from bson import Decimal128, ObjectId, json_util
+import json, requests, logging, os, traceback, re, threading
+from time import monotonic
+import gridfs
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from django.urls import reverse
+from django.utils.http import content_disposition_header
 from django.views.decorators.csrf import csrf_exempt
 from datetime import datetime, date, timedelta, time
 from rest_framework import viewsets
@@ -30,11 +36,28 @@ from .serializers import (
     ControlOdometroSerializer
 )
 from django.conf import settings
-from .mongo_connection import get_collection, get_collection_from_activos_db, is_mongodb_available
+from .autenticacion import usuario_de_request
+from .sesiones import emitir_token, revocar_sesiones, revocar_sesiones_tras_cambio
+from .contrasenas import ContrasenasSaturadas, hashear, rehash_si_corresponde, verificar
+from .auditoria import escritor as escritor_auditoria, limpiar_detalle
+from .permisos import EsAdministrador, EsEncargado, PermisoModulo, UsuarioRegistrado, invalidar_permisos, tiene_permiso
+from .mongo_connection import get_collection, get_collection_from_activos_db, is_mongodb_available, mongodb_health
+from .cache import (
+    obtener_maquinaria, obtener_maquinarias, obtener_maquinaria_por_placa, obtener_maquinarias_por_placas,
+    invalidar_maquinaria, estadisticas_caches, OpcionesCache, invalidar_usuarios
+)
+from .adjuntos import (
+    CAMPO_CONTENIDO, TAMAÑO_CHUNK, AdjuntoInvalido, ArchivoGridFS, abrir_adjunto, guardar_adjuntos_registro,
+    liberar_adjuntos_registro, hidratar_adjuntos, proyeccion_sin_contenido, completar_fotos_listado, url_adjunto,
+    iniciar_subida, obtener_subida, recibir_parte, estadisticas_almacenamiento, SubidaGridFSMixin
+)
+from .imagenes import elegir_variante
+from .correos import encolar_correo
+from .pronostico import ModeloNoDisponible, registro_modelo
+from .trabajos_pronostico import crear_trabajo, despertar_worker, obtener_trabajo, serializar_trabajo
 from functools import wraps
-import bcrypt
 from rest_framework.permissions import AllowAny, IsAuthenticated
-from django.core.mail import send_mail, EmailMultiAlternatives
+from django.core.mail import send_mail
 import ast
 from dateutil.relativedelta import relativedelta
 
@@ -66,7 +89,7 @@ def create_default_admin():
                 "Cargo": "admin",
                 "Unidad": "Sistema",
                 "Email": "admin123@gmail.com",
-                "Password": bcrypt.hashpw("Aleatorio12$".encode('utf-8'), bcrypt.gensalt()).decode('utf-8'),
+                "Password": hashear("Aleatorio12$"),
                 "Permiso": "Admin",
                 "permisos": {
                     "Dashboard": {"ver": True, "crear": True, "editar": True, "eliminar": True},
@@ -89,79 +112,77 @@ def create_default_admin():
                 "Memorandum": datetime.now().strftime('%d/%m/%Y')
             }
             usuarios_collection.insert_one(admin_data)
+            usuario_modificado()
             logger.info("Usuario admin por defecto creado exitosamente")
             return True
         return False
     except Exception as e:
         logger.error(f"Error al crear usuario admin por defecto: {str(e)}")
-        return False
+        return None
+
+_admin_verificado = False
+_admin_lock = threading.Lock()
+
+def asegurar_admin_por_defecto():
+    """
+    Llama a create_default_admin una sola vez por proceso: al iniciar (wsgi.py) o, si la
+    base de datos no estaba disponible entonces, en el siguiente login.
+    """
+    global _admin_verificado
+    if _admin_verificado:
+        return
+    with _admin_lock:
+        if not _admin_verificado:
+            _admin_verificado = create_default_admin() is not None
+
+def respuesta_contrasenas_saturadas():
+    return Response({
+        "error": "Demasiadas solicitudes con contraseña en curso",
+        "message": "Por favor, intente nuevamente en unos segundos."
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "5"})
 
 def check_user_permissions(user, required_role=None, required_permission=None, module=None):
-    if not user:
-        return False
-    
-    cargo = user.get('Cargo', '').lower()
-    
-    # Verificar rol requerido
-    if required_role:
-        if required_role == 'admin' and cargo != 'admin':
-            return False
-        elif required_role == 'encargado' and cargo not in ['admin', 'encargado']:
-            return False
-        elif required_role == 'tecnico' and cargo not in ['admin', 'encargado', 'tecnico', 'técnico']:
-            return False
-    
-    # Si es admin, tiene acceso completo excepto modificar maquinaria
-    if cargo == 'admin':
-        # Restricciones específicas del admin
-        if module == 'Maquinaria' and required_permission in ['crear', 'editar', 'eliminar']:
-            return False
-        # Para todo lo demás, el admin tiene acceso completo
-        return True
-    
-    # Si es encargado, tiene permisos completos excepto gestión de roles
-    if cargo == 'encargado':
-        if module == 'Usuarios' and required_permission in ['crear', 'editar', 'eliminar']:
-            return False
-        return True
-    
-    # Si es técnico, verificar permisos granulares
-    if cargo == 'tecnico' or cargo == 'técnico':
-        if not module or not required_permission:
-            return True
-        
-        # Para maquinaria, el técnico solo puede crear, no editar ni eliminar
-        if module == 'Maquinaria':
-            if required_permission == 'crear':
-                logger.info(f"check_user_permissions - técnico puede crear maquinaria, returning True")
-                return True
-            elif required_permission in ['editar', 'eliminar']:
-                logger.info(f"check_user_permissions - técnico NO puede {required_permission} maquinaria, returning False")
-                return False
-        
-        # Para control, asignación, mantenimiento, seguros, ITV, impuestos, SOAT, liberación, el técnico solo puede crear
-        if module in ['HistorialControl', 'ActaAsignacion', 'Mantenimiento', 'Seguro', 'ITV', 'Impuesto', 'SOAT', 'Liberacion']:
-            if required_permission == 'crear':
-                logger.info(f"check_user_permissions - técnico puede crear {module}, returning True")
-                return True
-            elif required_permission in ['editar', 'eliminar']:
-                logger.info(f"check_user_permissions - técnico NO puede {required_permission} {module}, returning False")
-                return False
-        
-        permisos = user.get('permisos', {})
-        module_permissions = permisos.get(module, {})
-        
-        # Para depreciaciones, técnicos pueden crear por defecto
-        if module == 'Depreciaciones' and required_permission == 'crear':
-            # Técnicos pueden crear depreciaciones sin restricciones
-            return True
-        
-        return module_permissions.get(required_permission, False)
-    
-    return False
+    """Reglas de cargo y permisos por módulo, precompiladas en core/permisos.py."""
+    return tiene_permiso(user, required_role, required_permission, module)
+
+def _maquinaria_ref(doc):
+    """Devuelve la referencia a maquinaria de un documento (o None si no tiene)."""
+    if 'maquinaria' in doc:
+        return doc['maquinaria']
+    return doc.get('maquinaria_id')
 
-def serialize_doc(doc):
-    """Convierte un documento de PyMongo a un formato JSON serializable (recursivo)."""
+def obtener_placas(maquinaria_ids):
+    """
+    Resuelve las placas de varias maquinarias: primero la caché del proceso y
+    las que falten con una sola consulta ($in).
+    Devuelve {id_str: placa} con los mismos textos que se mostraban por registro.
+    """
+    ids = {str(m) for m in maquinaria_ids if m is not None}
+    placas = {m: 'Error al obtener maquinaria' for m in ids if not ObjectId.is_valid(m)}
+    validos = {m: ObjectId(m) for m in ids if ObjectId.is_valid(m)}
+    if not validos:
+        return placas
+    try:
+        encontradas = {
+            ObjectId(m): resumen.get('placa', 'Sin placa')
+            for m, resumen in obtener_maquinarias(validos.values()).items()
+        }
+    except Exception as e:
+        logger.error(f"Error obteniendo placas de maquinaria: {str(e)}")
+        encontradas = None
+    for m, oid in validos.items():
+        if encontradas is None:
+            placas[m] = 'Error al obtener maquinaria'
+        else:
+            placas[m] = encontradas.get(oid, 'Maquinaria no encontrada')
+    return placas
+
+def serialize_doc(doc, placas=None):
+    """
+    Convierte un documento de PyMongo a un formato JSON serializable (recursivo).
+    `placas` es un mapa {maquinaria_id: placa} ya resuelto (ver serialize_list);
+    si no se pasa se consulta solo la maquinaria de este documento.
+    """
     if not doc:
         return None
     from bson import ObjectId
@@ -205,15 +226,9 @@ def serialize_doc(doc):
     # --- Asegurar maquinaria_id como string si existe ---
     if 'maquinaria_id' in doc:
         # Obtener la placa de la maquinaria en lugar del ID
-        try:
-            maquinaria_collection = get_collection('maquinaria')
-            maquinaria = maquinaria_collection.find_one({"_id": ObjectId(doc['maquinaria_id'])})
-            if maquinaria:
-                doc['Maquinaria'] = maquinaria.get('placa', 'Sin placa')
-            else:
-                doc['Maquinaria'] = 'Maquinaria no encontrada'
-        except:
-            doc['Maquinaria'] = 'Error al obtener maquinaria'
+        if placas is None:
+            placas = obtener_placas([doc['maquinaria_id']])
+        doc['Maquinaria'] = placas.get(str(doc['maquinaria_id']), 'Maquinaria no encontrada')
         # NO eliminar maquinaria_id, lo necesitamos para reactivación
     
     # Solo mapear campos que realmente necesitan ser renombrados
@@ -233,10 +248,19 @@ def serialize_doc(doc):
     
     return doc
 
-def serialize_list(docs):
-    """Serializa una lista de documentos de PyMongo."""
+def serialize_list(docs, placas=None):
+    """
+    Serializa una lista de documentos de PyMongo resolviendo todas las placas en una consulta.
+    `placas` permite compartir el mapa ya resuelto entre varias listas de la misma petición.
+    """
     try:
-        return [serialize_doc(doc.copy()) for doc in docs]
+        docs = [doc for doc in docs if doc]
+        if placas is None:
+            placas = {}
+        faltantes = {str(ref) for ref in map(_maquinaria_ref, docs) if ref is not None} - placas.keys()
+        if faltantes:
+            placas.update(obtener_placas(faltantes))
+        return [serialize_doc(doc.copy(), placas) for doc in docs]
     except Exception as e:
         logger.error(f"Error en serialize_list: {str(e)}")
         raise
@@ -259,6 +283,15 @@ def process_file_upload(file_obj, filename):
     """
     try:
         logger.info(f"Procesando archivo: {filename}, tipo: {type(file_obj)}")
+        if isinstance(file_obj, ArchivoGridFS):
+            # GridFSUploadHandler ya lo guardó mientras llegaba: se pasa la referencia sin leer el contenido
+            referencia = file_obj.referencia
+            return {
+                'content': url_adjunto(referencia['archivo_id']),
+                'filename': referencia['nombre_archivo'],
+                'mime_type': referencia['tipo_archivo'],
+                'size': referencia['tamaño_archivo']
+            }
         if file_obj and hasattr(file_obj, 'read'):
             # Leer el contenido del archivo
             file_content = file_obj.read()
@@ -290,9 +323,26 @@ def process_file_upload(file_obj, filename):
         logger.error(f"Error procesando archivo {filename}: {str(e)}")
         return None
 
+def maquinaria_modificada(maquinaria_id, *placas):
+    """Invalida lo que se haya cacheado de una maquinaria tras escribirla (placa anterior y nueva)."""
+    invalidar_maquinaria(maquinaria_id, *placas)
+    dashboard_snapshot.invalidar()
+    opciones_usuarios.invalidar()
+
+def usuario_modificado():
+    """Invalida lo que se haya cacheado de los usuarios tras crear, editar o borrar uno."""
+    opciones_usuarios.invalidar()
+    invalidar_usuarios()
+    invalidar_permisos()
+
 # --- Vistas para Maquinaria Principal ---
 
 class MaquinariaListView(APIView):
+    # POST requiere el permiso 'crear' de Maquinaria
+    permission_classes = [PermisoModulo]
+    modulo_permiso = 'Maquinaria'
+    mensaje_permiso = 'No tienes permisos para crear maquinaria'
+
     def get(self, request):
         maquinaria_collection = get_collection(Maquinaria)
         
@@ -305,12 +355,12 @@ class MaquinariaListView(APIView):
         
         try:
             # Solo mostrar maquinarias activas (activo=True o no tiene campo activo)
-            maquinarias_cursor = maquinaria_collection.find({
+            filtro = {
                 "$or": [
                     {"activo": True},
                     {"activo": {"$exists": False}}
                 ]
-            })
+            }
             
             # Serializar sin mapeo de campos para maquinaria
             def serialize_maquinaria(doc):
@@ -337,8 +387,11 @@ class MaquinariaListView(APIView):
                         return value
                 return convert(doc)
             
-            maquinarias_data = [serialize_maquinaria(doc) for doc in maquinarias_cursor]
-            return Response(maquinarias_data)
+            return listar_paginado(
+                request, maquinaria_collection, filtro,
+                serializar=lambda docs: [serialize_maquinaria(doc) for doc in docs],
+                ordenes=('_id', 'fecha_registro', 'placa')
+            )
         except Exception as e:
             logger.error(f"Error al obtener lista de maquinarias: {str(e)}")
             return Response({"error": f"Error al obtener datos: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -346,13 +399,8 @@ class MaquinariaListView(APIView):
     def post(self, request):
         maquinaria_collection = get_collection(Maquinaria)
         try:
-            # Verificar permisos
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
-            
-            if not check_user_permissions(user, required_permission='crear', module='Maquinaria'):
-                return Response({"error": "No tienes permisos para crear maquinaria"}, status=status.HTTP_403_FORBIDDEN)
-            
+            user = request.user
             data = request.data.copy()
             
             # Ensure fecha_registro is in the correct format
@@ -384,6 +432,8 @@ class MaquinariaListView(APIView):
                 validated_data['activo'] = True
                 validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
                 result = maquinaria_collection.insert_one(validated_data)
+                maquinaria_modificada(result.inserted_id, validated_data.get('placa'))
+                opciones_maquinaria.registrar(Maquinaria.collection_name, validated_data)
                 new_maquinaria = maquinaria_collection.find_one({"_id": result.inserted_id})
                 # --- REGISTRO DE ACTIVIDAD ---
                 try:
@@ -486,7 +536,7 @@ class MaquinariaDetailView(APIView):
         try:
             # Verificar permisos
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             
             if not check_user_permissions(user, required_permission='editar', module='Maquinaria'):
                 return Response({"error": "No tienes permisos para editar maquinaria"}, status=status.HTTP_403_FORBIDDEN)
@@ -548,6 +598,8 @@ class MaquinariaDetailView(APIView):
                 {"_id": ObjectId(id)},
                 {"$set": validated_data}
             )
+            maquinaria_modificada(id, existing_maquinaria.get('placa'), validated_data.get('placa'))
+            opciones_maquinaria.registrar(Maquinaria.collection_name, validated_data)
             
             # Obtener y devolver el registro actualizado
             updated_maquinaria = maquinaria_collection.find_one({"_id": ObjectId(id)})
@@ -578,7 +630,7 @@ class MaquinariaDetailView(APIView):
         try:
             # Verificar permisos
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
 
             existing_maquinaria = maquinaria_collection.find_one({"_id": ObjectId(id)})
             if not existing_maquinaria:
@@ -590,6 +642,7 @@ class MaquinariaDetailView(APIView):
                 if not user or user.get('Cargo', '').lower() != 'admin':
                     return Response({"error": "Solo el administrador puede eliminar maquinaria permanentemente"}, status=status.HTTP_403_FORBIDDEN)
                 maquinaria_collection.delete_one({"_id": ObjectId(id)})
+                maquinaria_modificada(id, existing_maquinaria.get('placa'))
                 try:
                     mensaje = f"Eliminó permanentemente maquinaria con placa {existing_maquinaria.get('placa', id)}"
                     registrar_actividad(
@@ -611,6 +664,7 @@ class MaquinariaDetailView(APIView):
                 {"_id": ObjectId(id)},
                 {"$set": {"activo": False, "fecha_desactivacion": datetime.now()}}
             )
+            maquinaria_modificada(id, existing_maquinaria.get('placa'))
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 mensaje = f"Desactivó maquinaria con placa {existing_maquinaria.get('placa', id)}"
@@ -636,7 +690,7 @@ class MaquinariaDetailView(APIView):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden reactivar maquinarias"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -653,6 +707,7 @@ class MaquinariaDetailView(APIView):
                 {"_id": ObjectId(id)},
                 {"$set": {"activo": True, "fecha_reactivacion": datetime.now()}}
             )
+            maquinaria_modificada(id, existing_maquinaria.get('placa'))
             
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -674,90 +729,201 @@ class MaquinariaDetailView(APIView):
             logger.error(f"Error al reactivar maquinaria: {str(e)}")
             return Response({"error": f"Error al reactivar registro: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Opciones de los desplegables: lo que se guarda en control va a 'historial_control'
+opciones_maquinaria = OpcionesCache({
+    Maquinaria.collection_name: {
+        'unidades': 'unidad', 'tipos': 'tipo', 'marcas': 'marca', 'modelos': 'modelo',
+        'colores': 'color', 'adquisiciones': 'adqui', 'gestiones': 'gestion',
+    },
+    'historial_control': {'ubicaciones': 'ubicacion', 'gerentes': 'gerente', 'encargados': 'encargado'},
+    Mantenimiento.collection_name: {'lugares_mantenimiento': 'lugar'},
+}, ttl=settings.OPCIONES_CACHE_TTL, nombre='opciones_maquinaria')
+
+
+def respuesta_con_etag(request, datos, etag):
+    """Response con ETag; 304 sin cuerpo si el navegador ya tiene esa versión (If-None-Match)."""
+    if etag in [e.strip() for e in request.headers.get('If-None-Match', '').split(',')]:
+        respuesta = HttpResponseNotModified()
+    else:
+        respuesta = Response(datos)
+    respuesta['ETag'] = etag
+    # El navegador guarda la respuesta pero revalida siempre con el ETag
+    respuesta['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+
 class MaquinariaOptionsView(APIView):
     def get(self, request):
-        # Check MongoDB availability first
-        mongodb_check = check_mongodb_availability()
-        if mongodb_check:
-            return mongodb_check
-        
-        maquinaria_collection = get_collection(Maquinaria)
-        historial_control_collection = get_collection(HistorialControl)
-        mantenimiento_collection = get_collection(Mantenimiento)
-        
-        # Check if any collection is None
-        if not maquinaria_collection or not historial_control_collection or not mantenimiento_collection:
+        try:
+            options, etag = opciones_maquinaria.obtener()
+        except (ConnectionError, PyMongoError) as e:
+            logger.warning(f"Opciones de maquinaria no disponibles: {str(e)}")
             return Response({
                 "error": "Base de datos no disponible temporalmente",
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
-                "options": {
-                    'unidades': [],
-                    'tipos': [],
-                    'marcas': [],
-                    'modelos': [],
-                    'colores': [],
-                    'adquisiciones': [],
-                    'gestiones': [],
-                    'estados': [],
-                    'encargados': [],
-                    'responsables': [],
-                    'tipos_mantenimiento': [],
-                    'estados_mantenimiento': []
-                }
+                "options": {opcion: [] for campos in opciones_maquinaria.fuentes.values() for opcion in campos}
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-        try:
-            options = {
-                'unidades': set(),
-                'tipos': set(),
-                'marcas': set(),
-                'modelos': set(),
-                'colores': set(),
-                'adquisiciones': set(),
-                'gestiones': set(),
-                'ubicaciones': set(),
-                'gerentes': set(),
-                'encargados': set(),
-                'lugares_mantenimiento': set()
-            }
-            
-            for m in maquinaria_collection.find({}):
-                if m.get('unidad'): options['unidades'].add(str(m['unidad']))
-                if m.get('tipo'): options['tipos'].add(str(m['tipo']))
-                if m.get('marca'): options['marcas'].add(str(m['marca']))
-                if m.get('modelo'): options['modelos'].add(str(m['modelo']))
-                if m.get('color'): options['colores'].add(str(m['color']))
-                if m.get('adqui'): options['adquisiciones'].add(str(m['adqui']))
-                if m.get('gestion'): options['gestiones'].add(str(m['gestion']))
-
-            for hc in historial_control_collection.find({}):
-                if hc.get('ubicacion'): options['ubicaciones'].add(str(hc['ubicacion']))
-                if hc.get('gerente'): options['gerentes'].add(str(hc['gerente']))
-                if hc.get('encargado'): options['encargados'].add(str(hc['encargado']))
-            
-            for m in mantenimiento_collection.find({}):
-                if m.get('lugar'): options['lugares_mantenimiento'].add(str(m['lugar']))
-
-            for key in options:
-                options[key] = sorted([v for v in options[key] if v and v.strip()])
-            
-            return Response(options)
-            
         except Exception as e:
             logger.error(f"Error al obtener opciones: {str(e)}")
             return Response({"error": f"Error al obtener opciones: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return respuesta_con_etag(request, options, etag)
     
 
-# Utilidad para paginación y proyección
+# Utilidad para paginación por cursor (keyset) y proyección
+
+class CursorInvalido(ValueError):
+    pass
+
+def _codificar_cursor(valores, direccion, orden):
+    import base64
+    crudo = json_util.dumps({'k': valores, 'd': direccion, 'o': orden})
+    return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decodificar_cursor(token, orden):
+    """Devuelve (valor, ultimo_id, direccion); el cursor solo vale para el orden con que se generó."""
+    import base64
+    try:
+        crudo = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        datos = json_util.loads(crudo)
+        valores, direccion = datos['k'], datos['d']
+        if datos['o'] != orden or direccion not in ('next', 'prev'):
+            raise ValueError
+        valor, ultimo_id = (None, valores[0]) if len(valores) == 1 else valores
+        if not isinstance(ultimo_id, ObjectId):
+            raise ValueError
+        return valor, ultimo_id, direccion
+    except Exception:
+        raise CursorInvalido("Cursor de paginación inválido")
+
+# Orden de los tipos BSON en un sort de MongoDB (los que pueden tener los campos de orden).
+# $gt/$lt solo comparan valores del mismo tipo: en colecciones donde `fecha_creacion` es
+# texto en los registros viejos y fecha en los nuevos hay que saltar de un tipo al siguiente
+_TIPOS_BSON_EN_ORDEN = (
+    (('int', 'long', 'double', 'decimal'), (int, float, Decimal128)),
+    (('string',), (str,)),
+    (('object',), (dict,)),
+    (('objectId',), (ObjectId,)),
+    (('bool',), (bool,)),
+    (('date',), (datetime,)),
+)
+
+def _rango_tipo(valor):
+    # bool antes que int: True también es un int en Python
+    if isinstance(valor, bool):
+        return 4
+    for rango, (_, clases) in enumerate(_TIPOS_BSON_EN_ORDEN):
+        if isinstance(valor, clases):
+            return rango
+    return None
+
+def _condicion_despues(campo, valor, ultimo_id, ascendente):
+    """Filtro de los documentos que van después de (valor, ultimo_id) en el orden dado."""
+    op = '$gt' if ascendente else '$lt'
+    if campo == '_id':
+        return {'_id': {op: ultimo_id}}
+    if valor is None:
+        # Los nulos/ausentes van primero en orden ascendente y al final en descendente
+        if ascendente:
+            return {'$or': [{campo: {'$ne': None}}, {campo: None, '_id': {op: ultimo_id}}]}
+        return {campo: None, '_id': {op: ultimo_id}}
+    condiciones = [{campo: {op: valor}}, {campo: valor, '_id': {op: ultimo_id}}]
+    rango = _rango_tipo(valor)
+    if rango is not None:
+        # Los valores de los tipos que el sort pone después (o antes, en descendente)
+        otros = _TIPOS_BSON_EN_ORDEN[rango + 1:] if ascendente else _TIPOS_BSON_EN_ORDEN[:rango]
+        condiciones += [{campo: {'$type': alias}} for aliases, _ in otros for alias in aliases]
+    if not ascendente:
+        condiciones.append({campo: None})
+    return {'$or': condiciones}
+
+def incluir_archivo(request):
+    """?include=archivo pide el contenido completo de los PDF/fotos en los listados y el detalle."""
+    return 'archivo' in request.query_params.get('include', '').split(',')
+
+
+def serializar_adjuntos(request, collection, docs, incluir, serializar=serialize_list):
+    """Serializa registros de una colección con adjuntos: URL de descarga, cantidad de fotos y miniaturas."""
+    if CAMPO_CONTENIDO.get(collection.name) == 'fotos' and not incluir:
+        completar_fotos_listado(collection, docs)
+    return [hidratar_adjuntos(doc, request, incluir) for doc in serializar(docs)]
+
+
+def _entero_param(request, nombre, defecto):
+    try:
+        return int(request.query_params.get(nombre, defecto))
+    except (TypeError, ValueError):
+        return defecto
+
+
+def listar_paginado(request, collection, filtro, projection=None, serializar=None,
+                    orden_por_defecto='_id', ordenes=('_id', 'fecha_creacion'), limite_lista=None):
+    """
+    Responde un listado. Si la petición trae `cursor` (vacío para la primera página)
+    se pagina por keyset sobre (campo de orden, _id) y se devuelve
+    {results, next, prev, has_more, page_size}; `page_size` se limita a PAGINACION_MAX.
+
+    Sin `cursor` se mantiene la respuesta de siempre (una lista): completa, o si se indica
+    `limite_lista` la página `?page` de `?page_size` documentos (por defecto `limite_lista`).
+    """
+    serializar = serializar or serialize_list
+    maximo = getattr(settings, 'PAGINACION_MAX', 200)
+    if 'cursor' not in request.query_params:
+        cursor = collection.find(filtro, projection)
+        if limite_lista:
+            page_size = max(1, _entero_param(request, 'page_size', limite_lista))
+            page = max(1, _entero_param(request, 'page', 1))
+            cursor = cursor.sort('_id', 1).skip((page - 1) * page_size).limit(page_size)
+        return Response(serializar(list(cursor)))
+
+    orden = request.query_params.get('orden', orden_por_defecto)
+    if orden.lstrip('-') not in ordenes:
+        return Response({"error": f"Orden no permitido. Opciones: {', '.join(ordenes)}"}, status=status.HTTP_400_BAD_REQUEST)
+    campo, ascendente = orden.lstrip('-'), not orden.startswith('-')
+
+    page_size = max(1, min(_entero_param(request, 'page_size', getattr(settings, 'PAGINACION_DEFECTO', 50)), maximo))
+
+    token = request.query_params.get('cursor')
+    direccion = 'next'
+    condicion = None
+    if token:
+        try:
+            valor, ultimo_id, direccion = _decodificar_cursor(token, orden)
+        except CursorInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Hacia atrás se recorre el orden invertido y luego se da vuelta la página
+        condicion = _condicion_despues(campo, valor, ultimo_id, ascendente == (direccion == 'next'))
+
+    sentido = 1 if ascendente == (direccion == 'next') else -1
+    orden_mongo = [(campo, sentido)] + ([('_id', sentido)] if campo != '_id' else [])
+    consulta = {'$and': [filtro, condicion]} if condicion else filtro
+    docs = list(collection.find(consulta, projection).sort(orden_mongo).limit(page_size + 1))
+    hay_mas = len(docs) > page_size
+    docs = docs[:page_size]
+    if direccion == 'prev':
+        docs.reverse()
+
+    def clave(doc):
+        return [doc['_id']] if campo == '_id' else [doc.get(campo), doc['_id']]
+
+    if direccion == 'next':
+        siguiente = _codificar_cursor(clave(docs[-1]), 'next', orden) if hay_mas and docs else None
+        anterior = _codificar_cursor(clave(docs[0]), 'prev', orden) if token and docs else None
+        has_more = hay_mas
+    else:
+        siguiente = _codificar_cursor(clave(docs[-1]), 'next', orden) if docs else None
+        anterior = _codificar_cursor(clave(docs[0]), 'prev', orden) if hay_mas and docs else None
+        has_more = bool(docs)
 
-def paginar_cursor(cursor, page=1, page_size=50):
-    page = max(1, int(page))
-    page_size = max(1, int(page_size))
-    skip = (page - 1) * page_size
-    return cursor.skip(skip).limit(page_size)
+    return Response({
+        'results': serializar(docs),
+        'next': siguiente,
+        'prev': anterior,
+        'has_more': has_more,
+        'page_size': page_size,
+    })
 
 # --- Optimización de BaseSectionAPIView y BaseSectionDetailAPIView ---
-class BaseSectionAPIView(APIView):
+class BaseSectionAPIView(SubidaGridFSMixin, APIView):
     collection_class = None 
     serializer_class = None 
     projection = None  # Añadido para optimización
@@ -773,21 +939,30 @@ class BaseSectionAPIView(APIView):
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
                 "records": []
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 50))
+        return self.listar(request, collection, maquinaria_id)
+
+    def listar(self, request, collection, maquinaria_id, filtro_activo=None):
+        """Listado paginable de los registros activos de una maquinaria (ver listar_paginado)."""
         # Solo mostrar registros activos
         filtro = {
             'maquinaria': ObjectId(maquinaria_id),
-            "$or": [
+            **(filtro_activo or {"$or": [
                 {"activo": True},
                 {"activo": {"$exists": False}}
-            ]
+            ]})
         }
-        cursor = collection.find(filtro, self.projection or None)
-        cursor = paginar_cursor(cursor, page, page_size)
-        records = list(cursor)
-        
-        return Response(serialize_list(records))
+        projection = self.projection or None
+        serializar = None
+        if collection.name in CAMPO_CONTENIDO:
+            # Sin ?include=archivo el listado trae solo los metadatos de los archivos
+            incluir = incluir_archivo(request)
+            if not incluir:
+                projection = proyeccion_sin_contenido(collection.name)
+            def serializar(docs):
+                return serializar_adjuntos(request, collection, docs, incluir)
+        # Sin cursor: ?page/?page_size de 50 en 50 como antes de la paginación por cursor
+        return listar_paginado(request, collection, filtro, projection, serializar,
+                               limite_lista=getattr(settings, 'PAGINACION_DEFECTO', 50))
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -808,7 +983,7 @@ class BaseSectionAPIView(APIView):
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos."
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
-        user = usuarios_collection.find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         cargo = user.get('Cargo', '').lower() if user else ''
         if cargo != 'encargado':
             data.pop('validado_por', None)
@@ -842,7 +1017,7 @@ class BaseSectionAPIView(APIView):
             return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class BaseSectionDetailAPIView(APIView):
+class BaseSectionDetailAPIView(SubidaGridFSMixin, APIView):
     collection_class = None
     serializer_class = None
     projection = None
@@ -862,7 +1037,7 @@ class BaseSectionDetailAPIView(APIView):
         data = request.data.copy()
         # --- RESTRICCIÓN DE CAMPOS POR ROL ---
         actor_email = request.headers.get('X-User-Email')
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         cargo = user.get('Cargo', '').lower() if user else ''
         if cargo != 'encargado':
             data.pop('validado_por', None)
@@ -934,11 +1109,12 @@ class BaseSectionDetailAPIView(APIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+            liberar_adjuntos_registro(existing_record)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 maquinaria_placa = get_maquinaria_info(maquinaria_id)
@@ -986,7 +1162,7 @@ class BaseSectionDetailAPIView(APIView):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden reactivar registros"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -1047,8 +1223,7 @@ class LiberacionListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('liberacion')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -1060,7 +1235,7 @@ class LiberacionListView(BaseSectionAPIView):
             data = request.data.copy()
             data['maquinaria'] = str(maquinaria_id)
             logger.info(f"Datos preparados: {data}")
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
 
             serializer = self.serializer_class(data=data)
             if not serializer.is_valid():
@@ -1075,7 +1250,7 @@ class LiberacionListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -1162,7 +1337,7 @@ class LiberacionDetailView(BaseSectionDetailAPIView):
             
             # Agregar o actualizar el campo registrado_por con el nombre del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             
             validated_data = self.convert_date_to_datetime(validated_data)
@@ -1212,7 +1387,7 @@ class LiberacionDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
@@ -1273,7 +1448,7 @@ class LiberacionDetailView(BaseSectionDetailAPIView):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden reactivar registros"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -1352,14 +1527,7 @@ class HistorialControlListView(BaseSectionAPIView):
         
         collection = get_collection('historial_control')
         # Solo mostrar registros activos
-        records = list(collection.find({
-            'maquinaria': ObjectId(maquinaria_id),
-            "$or": [
-                {"activo": True},
-                {"activo": {"$exists": False}}
-            ]
-        }))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id)
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -1389,7 +1557,7 @@ class HistorialControlListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -1402,8 +1570,9 @@ class HistorialControlListView(BaseSectionAPIView):
             collection = get_collection('historial_control')
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
             result = collection.insert_one(validated_data)
+            opciones_maquinaria.registrar('historial_control', validated_data)
             new_record = collection.find_one({"_id": result.inserted_id})
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 actor_email = request.headers.get('X-User-Email')
@@ -1471,7 +1640,7 @@ class HistorialControlDetailView(BaseSectionDetailAPIView):
         # Solo deja los campos válidos para el serializer
         valid_fields = set(self.serializer_class().get_fields().keys())
         data = {k: v for k, v in data.items() if k in valid_fields}
-        maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria_doc = obtener_maquinaria(maquinaria_id)
         
         serializer = self.serializer_class(existing_record, data=data, partial=True)
         if serializer.is_valid():
@@ -1481,11 +1650,12 @@ class HistorialControlDetailView(BaseSectionDetailAPIView):
             
             # Agregar o actualizar el campo registrado_por con el nombre del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
             collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
+            opciones_maquinaria.registrar('historial_control', validated_data)
             updated_record = collection.find_one({'_id': ObjectId(record_id)})
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -1524,7 +1694,7 @@ class HistorialControlDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
@@ -1576,7 +1746,7 @@ class HistorialControlDetailView(BaseSectionDetailAPIView):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden reactivar registros"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -1635,8 +1805,7 @@ class ActaAsignacionListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('acta_asignacion')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -1648,7 +1817,7 @@ class ActaAsignacionListView(BaseSectionAPIView):
             data = request.data.copy()
             data['maquinaria'] = str(maquinaria_id)
             logger.info(f"Datos preparados: {data}")
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
 
             serializer = self.serializer_class(data=data)
             if not serializer.is_valid():
@@ -1663,7 +1832,7 @@ class ActaAsignacionListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -1739,7 +1908,7 @@ class ActaAsignacionDetailView(BaseSectionDetailAPIView):
 
         data = request.data.copy()
         data['maquinaria'] = str(maquinaria_id)
-        maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria_doc = obtener_maquinaria(maquinaria_id)
         
         serializer = self.serializer_class(existing_record, data=data, partial=True)
         if serializer.is_valid():
@@ -1749,7 +1918,7 @@ class ActaAsignacionDetailView(BaseSectionDetailAPIView):
             
             # Agregar o actualizar el campo registrado_por con el nombre del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
             validated_data = self.convert_date_to_datetime(validated_data)
@@ -1794,7 +1963,7 @@ class ActaAsignacionDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
@@ -1846,7 +2015,7 @@ class ActaAsignacionDetailView(BaseSectionDetailAPIView):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden reactivar registros"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -1905,8 +2074,7 @@ class MantenimientoListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('mantenimiento')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -1941,7 +2109,7 @@ class MantenimientoListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -1953,6 +2121,7 @@ class MantenimientoListView(BaseSectionAPIView):
             logger.info(f"Mantenimiento POST - Datos finales para MongoDB: {validated_data}")
             
             result = collection.insert_one(validated_data)
+            opciones_maquinaria.registrar(Mantenimiento.collection_name, validated_data)
             new_record = collection.find_one({"_id": result.inserted_id})
             
             # --- REGISTRO DE ACTIVIDAD ---
@@ -2006,7 +2175,7 @@ class MantenimientoDetailView(BaseSectionDetailAPIView):
 
         data = request.data.copy()
         data['maquinaria'] = str(maquinaria_id)
-        maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria_doc = obtener_maquinaria(maquinaria_id)
         
         logger.info(f"Mantenimiento PUT - Datos recibidos: {data}")
         logger.info(f"Mantenimiento PUT - Registro existente: {existing_record}")
@@ -2019,11 +2188,12 @@ class MantenimientoDetailView(BaseSectionDetailAPIView):
             
             # Agregar o actualizar el campo registrado_por con el nombre del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
             collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
+            opciones_maquinaria.registrar(Mantenimiento.collection_name, validated_data)
             updated_record = collection.find_one({'_id': ObjectId(record_id)})
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -2064,7 +2234,7 @@ class MantenimientoDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
@@ -2132,8 +2302,7 @@ class SeguroListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('seguro')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -2202,7 +2371,7 @@ class SeguroListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -2211,6 +2380,7 @@ class SeguroListView(BaseSectionAPIView):
             logger.info(f"Seguro POST - Datos convertidos: {validated_data}")
 
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+            validated_data = guardar_adjuntos_registro(validated_data)
             logger.info(f"Seguro POST - Datos finales para MongoDB: {validated_data}")
             
             try:
@@ -2246,8 +2416,10 @@ class SeguroListView(BaseSectionAPIView):
                 logger.error(f"Error al registrar actividad de creación de seguro: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
             
-            return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
+            return Response(hidratar_adjuntos(serialize_doc(new_record), request), status=status.HTTP_201_CREATED)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al crear seguro: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2265,7 +2437,7 @@ class SeguroDetailView(BaseSectionDetailAPIView):
         record = collection.find_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
         if not record:
             return Response({"error": "Seguro no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-        return Response(serialize_doc(record))
+        return Response(hidratar_adjuntos(serialize_doc(record), request, incluir_archivo(request)))
 
     def put(self, request, maquinaria_id, record_id):
         if not ObjectId.is_valid(maquinaria_id) or not ObjectId.is_valid(record_id):
@@ -2316,7 +2488,7 @@ class SeguroDetailView(BaseSectionDetailAPIView):
                 data = dict(request.data)
             
             data['maquinaria'] = str(maquinaria_id)
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             logger.info(f"Seguro PUT - Datos preparados: {data}")
             logger.info(f"Seguro PUT - Registro existente: {existing_record}")
@@ -2337,7 +2509,7 @@ class SeguroDetailView(BaseSectionDetailAPIView):
             
             # Manejar campos de validación y autorización
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             cargo = user.get('Cargo', '').lower() if user else ''
             
             if cargo == 'encargado':
@@ -2358,6 +2530,7 @@ class SeguroDetailView(BaseSectionDetailAPIView):
                 validated_data['autorizado_por'] = existing_record.get('autorizado_por')
 
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+            validated_data = guardar_adjuntos_registro(validated_data, existing_record)
             logger.info(f"Seguro PUT - Datos finales para MongoDB: {validated_data}")
             
             collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
@@ -2384,8 +2557,10 @@ class SeguroDetailView(BaseSectionDetailAPIView):
                 logger.error(f"Error al registrar actividad de edición de seguro: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
             
-            return Response(serialize_doc(updated_record))
+            return Response(hidratar_adjuntos(serialize_doc(updated_record), request))
             
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al actualizar seguro: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2403,11 +2578,12 @@ class SeguroDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+            liberar_adjuntos_registro(existing_record)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 maquinaria_placa = get_maquinaria_info(maquinaria_id)
@@ -2471,8 +2647,7 @@ class ITVListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('itv')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -2506,7 +2681,7 @@ class ITVListView(BaseSectionAPIView):
             
             data['maquinaria'] = str(maquinaria_id)
             logger.info(f"ITV POST - Datos preparados: {data}")
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
 
             serializer = self.serializer_class(data=data)
             if not serializer.is_valid():
@@ -2521,13 +2696,14 @@ class ITVListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
 
             collection = get_collection('itv')
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+            validated_data = guardar_adjuntos_registro(validated_data)
             result = collection.insert_one(validated_data)
             new_record = collection.find_one({"_id": result.inserted_id})
             # --- REGISTRO DE ACTIVIDAD ---
@@ -2549,8 +2725,10 @@ class ITVListView(BaseSectionAPIView):
             except Exception as e:
                 logger.error(f"Error al registrar actividad de creación de ITV: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
-            return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
+            return Response(hidratar_adjuntos(serialize_doc(new_record), request), status=status.HTTP_201_CREATED)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al crear ITV: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2568,7 +2746,7 @@ class ITVDetailView(BaseSectionDetailAPIView):
         record = collection.find_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
         if not record:
             return Response({"error": "ITV no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-        return Response(serialize_doc(record))
+        return Response(hidratar_adjuntos(serialize_doc(record), request, incluir_archivo(request)))
 
     def put(self, request, maquinaria_id, record_id):
         if not ObjectId.is_valid(maquinaria_id) or not ObjectId.is_valid(record_id):
@@ -2619,7 +2797,7 @@ class ITVDetailView(BaseSectionDetailAPIView):
                 data = dict(request.data)
             
             data['maquinaria'] = str(maquinaria_id)
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             logger.info(f"ITV PUT - Datos preparados: {data}")
             logger.info(f"ITV PUT - Registro existente: {existing_record}")
@@ -2632,10 +2810,11 @@ class ITVDetailView(BaseSectionDetailAPIView):
                 
                 # Agregar o actualizar el campo registrado_por con el nombre del usuario
                 actor_email = request.headers.get('X-User-Email')
-                user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+                user = usuario_de_request(request, actor_email) if actor_email else None
                 validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
                 validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+                validated_data = guardar_adjuntos_registro(validated_data, existing_record)
                 collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
                 updated_record = collection.find_one({'_id': ObjectId(record_id)})
                 # --- REGISTRO DE ACTIVIDAD ---
@@ -2658,10 +2837,12 @@ class ITVDetailView(BaseSectionDetailAPIView):
                 except Exception as e:
                     logger.error(f"Error al registrar actividad de edición de ITV: {str(e)}")
                 # --- FIN REGISTRO DE ACTIVIDAD ---
-                return Response(serialize_doc(updated_record))
+                return Response(hidratar_adjuntos(serialize_doc(updated_record), request))
             # Responder el error exacto del serializer en el JSON
             return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
         
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al actualizar ITV: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2679,11 +2860,12 @@ class ITVDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+            liberar_adjuntos_registro(existing_record)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 maquinaria_placa = get_maquinaria_info(maquinaria_id)
@@ -2747,8 +2929,7 @@ class SOATListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('soat')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -2803,7 +2984,7 @@ class SOATListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
@@ -2812,6 +2993,7 @@ class SOATListView(BaseSectionAPIView):
             logger.info(f"SOAT POST - Datos convertidos: {validated_data}")
 
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+            validated_data = guardar_adjuntos_registro(validated_data)
             logger.info(f"SOAT POST - Datos finales para MongoDB: {validated_data}")
             
             result = collection.insert_one(validated_data)
@@ -2836,8 +3018,10 @@ class SOATListView(BaseSectionAPIView):
                 logger.error(f"Error al registrar actividad de creación de SOAT: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
             
-            return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
+            return Response(hidratar_adjuntos(serialize_doc(new_record), request), status=status.HTTP_201_CREATED)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al crear SOAT: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2855,7 +3039,7 @@ class SOATDetailView(BaseSectionDetailAPIView):
         record = collection.find_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
         if not record:
             return Response({"error": "SOAT no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-        return Response(serialize_doc(record))
+        return Response(hidratar_adjuntos(serialize_doc(record), request, incluir_archivo(request)))
 
     def put(self, request, maquinaria_id, record_id):
         if not ObjectId.is_valid(maquinaria_id) or not ObjectId.is_valid(record_id):
@@ -2906,7 +3090,7 @@ class SOATDetailView(BaseSectionDetailAPIView):
                 data = dict(request.data)
             
             data['maquinaria'] = str(maquinaria_id)
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             logger.info(f"SOAT PUT - Datos preparados: {data}")
             logger.info(f"SOAT PUT - Registro existente: {existing_record}")
@@ -2919,10 +3103,11 @@ class SOATDetailView(BaseSectionDetailAPIView):
                 
                 # Agregar o actualizar el campo registrado_por con el nombre del usuario
                 actor_email = request.headers.get('X-User-Email')
-                user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+                user = usuario_de_request(request, actor_email) if actor_email else None
                 validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
                 validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+                validated_data = guardar_adjuntos_registro(validated_data, existing_record)
                 collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
                 updated_record = collection.find_one({'_id': ObjectId(record_id)})
                 # --- REGISTRO DE ACTIVIDAD ---
@@ -2945,10 +3130,12 @@ class SOATDetailView(BaseSectionDetailAPIView):
                 except Exception as e:
                     logger.error(f"Error al registrar actividad de edición de SOAT: {str(e)}")
                 # --- FIN REGISTRO DE ACTIVIDAD ---
-                return Response(serialize_doc(updated_record))
+                return Response(hidratar_adjuntos(serialize_doc(updated_record), request))
             # Responder el error exacto del serializer en el JSON
             return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
         
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al actualizar SOAT: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -2967,11 +3154,12 @@ class SOATDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+            liberar_adjuntos_registro(existing_record)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 maquinaria_placa = get_maquinaria_info(maquinaria_id)
@@ -3037,8 +3225,7 @@ class ImpuestoListView(BaseSectionAPIView):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
         collection = get_collection('impuesto')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
-        return Response(serialize_list(records))
+        return self.listar(request, collection, maquinaria_id, {'activo': {'$ne': False}})
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -3072,7 +3259,7 @@ class ImpuestoListView(BaseSectionAPIView):
             
             data['maquinaria'] = str(maquinaria_id)
             logger.info(f"Impuesto POST - Datos preparados: {data}")
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
 
             serializer = self.serializer_class(data=data)
             if not serializer.is_valid():
@@ -3087,13 +3274,14 @@ class ImpuestoListView(BaseSectionAPIView):
             
             # Agregar campos de auditoría
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+            user = usuario_de_request(request, actor_email) if actor_email else None
             validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
             validated_data['validado_por'] = None  # Se asignará cuando se valide
             validated_data['autorizado_por'] = None  # Se asignará cuando se autorice
 
             collection = get_collection('impuesto')
             validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+            validated_data = guardar_adjuntos_registro(validated_data)
             result = collection.insert_one(validated_data)
             new_record = collection.find_one({"_id": result.inserted_id})
             # --- REGISTRO DE ACTIVIDAD ---
@@ -3115,8 +3303,10 @@ class ImpuestoListView(BaseSectionAPIView):
             except Exception as e:
                 logger.error(f"Error al registrar actividad de creación de impuesto: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
-            return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
+            return Response(hidratar_adjuntos(serialize_doc(new_record), request), status=status.HTTP_201_CREATED)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al crear impuesto: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -3134,7 +3324,7 @@ class ImpuestoDetailView(BaseSectionDetailAPIView):
         record = collection.find_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
         if not record:
             return Response({"error": "Impuesto no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-        return Response(serialize_doc(record))
+        return Response(hidratar_adjuntos(serialize_doc(record), request, incluir_archivo(request)))
 
     def put(self, request, maquinaria_id, record_id):
         if not ObjectId.is_valid(maquinaria_id) or not ObjectId.is_valid(record_id):
@@ -3185,7 +3375,7 @@ class ImpuestoDetailView(BaseSectionDetailAPIView):
                 data = dict(request.data)
             
             data['maquinaria'] = str(maquinaria_id)
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             logger.info(f"Impuesto PUT - Datos preparados: {data}")
             logger.info(f"Impuesto PUT - Registro existente: {existing_record}")
@@ -3198,10 +3388,11 @@ class ImpuestoDetailView(BaseSectionDetailAPIView):
                 
                 # Agregar o actualizar el campo registrado_por con el nombre del usuario
                 actor_email = request.headers.get('X-User-Email')
-                user = get_collection(Usuario).find_one({"Email": actor_email}) if actor_email else None
+                user = usuario_de_request(request, actor_email) if actor_email else None
                 validated_data['registrado_por'] = user['Nombre'] if user and 'Nombre' in user else actor_email
 
                 validated_data = convert_dates_to_str(validated_data)  # <-- BSON safe
+                validated_data = guardar_adjuntos_registro(validated_data, existing_record)
                 collection.update_one({'_id': ObjectId(record_id)}, {'$set': validated_data})
                 updated_record = collection.find_one({'_id': ObjectId(record_id)})
                 # --- REGISTRO DE ACTIVIDAD ---
@@ -3224,10 +3415,12 @@ class ImpuestoDetailView(BaseSectionDetailAPIView):
                 except Exception as e:
                     logger.error(f"Error al registrar actividad de edición de impuesto: {str(e)}")
                 # --- FIN REGISTRO DE ACTIVIDAD ---
-                return Response(serialize_doc(updated_record))
+                return Response(hidratar_adjuntos(serialize_doc(updated_record), request))
             # Responder el error exacto del serializer en el JSON
             return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
         
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al actualizar Impuesto: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": f"Error interno del servidor: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -3245,11 +3438,12 @@ class ImpuestoDetailView(BaseSectionDetailAPIView):
         if permanent:
             # Requerir ADMIN para eliminación permanente
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
 
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+            liberar_adjuntos_registro(existing_record)
             # --- REGISTRO DE ACTIVIDAD ---
             try:
                 maquinaria_placa = get_maquinaria_info(maquinaria_id)
@@ -3299,7 +3493,7 @@ def format_metodo_oracion(metodo):
 def get_maquinaria_info(maquinaria_id):
     """Obtiene información descriptiva de una maquinaria para usar en mensajes."""
     try:
-        maquinaria = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria = obtener_maquinaria(maquinaria_id)
         if maquinaria:
             return maquinaria.get('placa', 'Sin placa')
         return 'Maquinaria no encontrada'
@@ -3354,6 +3548,8 @@ class DepreciacionesGeneralView(APIView):
     def get(self, request):
         try:
             depreciaciones_collection = get_collection("depreciaciones")
+            if 'cursor' in request.query_params:
+                return listar_paginado(request, depreciaciones_collection, {})
             depreciaciones = list(depreciaciones_collection.find({}))
             if depreciaciones:
                 return Response(serialize_list(depreciaciones))
@@ -3389,7 +3585,7 @@ class DepreciacionesListView(APIView):
         if not ObjectId.is_valid(maquinaria_id):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         collection = get_collection('depreciaciones')
-        records = list(collection.find({'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}))
+        filtro = {'maquinaria': ObjectId(maquinaria_id), 'activo': {'$ne': False}}
         
         # Serializar sin mapeo de campos para depreciaciones
         def serialize_depreciaciones(doc):
@@ -3416,7 +3612,10 @@ class DepreciacionesListView(APIView):
                     return value
             return convert(doc)
         
-        return Response([serialize_depreciaciones(record) for record in records])
+        return listar_paginado(
+            request, collection, filtro,
+            serializar=lambda records: [serialize_depreciaciones(record) for record in records]
+        )
 
     def post(self, request, maquinaria_id):
         if not ObjectId.is_valid(maquinaria_id):
@@ -3426,8 +3625,7 @@ class DepreciacionesListView(APIView):
         
         data = request.data.copy()
         data['maquinaria'] = str(maquinaria_id)
-        maquinaria_collection = get_collection(Maquinaria)
-        maquinaria_doc = maquinaria_collection.find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria_doc = obtener_maquinaria(maquinaria_id)
         tipo_maquinaria = maquinaria_doc.get('tipo', '') if maquinaria_doc else ''
         detalle_maquinaria = maquinaria_doc.get('detalle', '') if maquinaria_doc else ''
         bien_uso, vida_util = DepreciacionesGeneralView().determinar_bien_uso_y_vida_util(tipo_maquinaria, detalle_maquinaria)
@@ -3494,7 +3692,7 @@ class DepreciacionesDetailView(APIView):
             except Exception as e:
                 print(f"Error al convertir fecha_compra: {e}")
         serializer = DepreciacionSerializer(existing_record, data=data, partial=True)
-        maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+        maquinaria_doc = obtener_maquinaria(maquinaria_id)
         if serializer.is_valid():
             validated_data = serializer.validated_data
             validated_data['maquinaria'] = ObjectId(maquinaria_id)
@@ -3538,7 +3736,7 @@ class DepreciacionesDetailView(APIView):
         if permanent:
             # Requerir ADMIN
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden eliminar permanentemente"}, status=status.HTTP_403_FORBIDDEN)
             collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
@@ -3597,10 +3795,7 @@ class RegistroView(APIView):
 
             data.pop("confirmPassword", None)
 
-            data["Password"] = bcrypt.hashpw(
-                data["Password"].encode("utf-8"),
-                bcrypt.gensalt()
-            ).decode("utf-8")
+            data["Password"] = hashear(data["Password"])
 
             # Si el correo ya existe, no hacemos nada (usuarios existentes no se tocan)
             usuarios_collection = get_collection(Usuario)
@@ -3655,6 +3850,8 @@ class RegistroView(APIView):
 
             return Response({"message": "Código enviado al correo"}, status=status.HTTP_200_OK)
 
+        except ContrasenasSaturadas:
+            return respuesta_contrasenas_saturadas()
         except Exception as e:
             logger.error(f"Error al registrar: {str(e)}")
             return Response(
@@ -3705,6 +3902,7 @@ class VerificarCodigoRegistroView(APIView):
             registro['fecha_creacion'] = datetime.now()
 
             usuarios.insert_one(registro)
+            usuario_modificado()
             verificaciones.delete_one({"Email": email})
 
             try:
@@ -3750,13 +3948,13 @@ class ReenviarCodigoRegistroView(APIView):
             return Response({"error": "Error interno"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 def registrar_actividad(email, accion, modulo, mensaje, detalle=None, fecha_login=None, fecha_logout=None):
-    collection = get_collection(Seguimiento)
+    """Encola el evento en el escritor de auditoría (se guarda en lotes, ver core/auditoria.py)."""
     doc = {
         'usuario_email': email,
         'accion': accion,
         'modulo': modulo,
         'mensaje': mensaje,
-        'detalle': detalle or '',
+        'detalle': limpiar_detalle(detalle or ''),
         'fecha_hora': datetime.now()
     }
     
@@ -3766,15 +3964,15 @@ def registrar_actividad(email, accion, modulo, mensaje, detalle=None, fecha_logi
     if fecha_logout:
         doc['fecha_logout'] = fecha_logout
     
-    collection.insert_one(doc)
+    escritor_auditoria.registrar(doc)
 
 class LoginView(APIView):
     serializer_class = LoginSerializer  
 
     def post(self, request):
         try:
-            # Crear usuario admin por defecto si no existe
-            create_default_admin()
+            # Crear usuario admin por defecto si no existe (una vez por proceso)
+            asegurar_admin_por_defecto()
             
             data = request.data
             print("Datos recibidos:", data)
@@ -3786,8 +3984,10 @@ class LoginView(APIView):
             user = collection.find_one({"Email": data["Email"]})
             if not user:
                 return Response({"error": "Usuario no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-            if not bcrypt.checkpw(data["Password"].encode("utf-8"), user["Password"].encode("utf-8")):
+            if not verificar(data["Password"], user["Password"]):
                 return Response({"error": "Contraseña inválida"}, status=status.HTTP_401_UNAUTHORIZED)
+            # Si cambió BCRYPT_ROUNDS, el hash se rehace con el nuevo costo
+            rehash_si_corresponde(collection, user, data["Password"])
             # Comentado temporalmente para debugging
             # if user.get("Permiso", "Editor").lower() == "denegado":
             #     return Response({"error": "Acceso denegado por el administrador"}, status=status.HTTP_403_FORBIDDEN)
@@ -3803,7 +4003,13 @@ class LoginView(APIView):
                 fecha_login=fecha_login
             )
             
-            return Response(json.loads(json_util.dumps(serialize_doc(user))), status=status.HTTP_200_OK)
+            datos = json.loads(json_util.dumps(serialize_doc(user)))
+            # Token de sesión: el frontend lo manda en Authorization en lugar de confiar en X-User-Email
+            datos['token'], expira_en = emitir_token(user)
+            datos['token_expira_en'] = expira_en.isoformat()
+            return Response(datos, status=status.HTTP_200_OK)
+        except ContrasenasSaturadas:
+            return respuesta_contrasenas_saturadas()
         except Exception as e:
             logger.error(f"Error interno en LoginView: {str(e)}")
             return Response(
@@ -3818,14 +4024,19 @@ class LogoutView(APIView):
             if not email:
                 return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
             
-            # Buscar el último login del usuario para actualizarlo con la fecha de logout
-            seguimiento_collection = get_collection(Seguimiento)
-            ultimo_login = seguimiento_collection.find_one(
-                {"usuario_email": email, "accion": "login"},
-                sort=[("fecha_hora", -1)]
-            )
-            
             fecha_logout = datetime.now()
+
+            # El último login del usuario puede estar todavía en el buffer de auditoría: se le
+            # pone ahí la fecha de logout; si no, se busca en la colección
+            ultimo_login = None
+            seguimiento_collection = get_collection(Seguimiento)
+            if not escritor_auditoria.actualizar_pendiente(
+                    lambda doc: doc.get("usuario_email") == email and doc.get("accion") == "login",
+                    {"fecha_logout": fecha_logout}):
+                ultimo_login = seguimiento_collection.find_one(
+                    {"usuario_email": email, "accion": "login"},
+                    sort=[("fecha_hora", -1)]
+                )
             
             # Registrar actividad de logout
             registrar_actividad(
@@ -3852,11 +4063,130 @@ class LogoutView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+def _a_numero(expr):
+    """Expresión de agregación que convierte a double (0 si falta o no es numérico)."""
+    return {"$convert": {"input": expr, "to": "double", "onError": 0, "onNull": 0}}
+
+def _contar_si(condicion):
+    return {"$sum": {"$cond": [condicion, 1, 0]}}
+
+def calcular_estadisticas_dashboard():
+    """
+    Calcula todos los indicadores del dashboard en una sola agregación:
+    se parte de maquinaria, se agregan las demás colecciones con $unionWith
+    (solo los campos necesarios) y un único $group suma cada indicador.
+    """
+    hoy = datetime.now()
+    en_30_dias = hoy.replace(hour=23, minute=59, second=59) + timedelta(days=30)
+    primer_dia_mes = hoy.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    def origen(coleccion, campos=None):
+        proyeccion = {"_id": 0, "_c": {"$literal": coleccion}}
+        proyeccion.update(campos or {})
+        return [{"$project": proyeccion}]
+
+    def union(coleccion, campos=None):
+        return {"$unionWith": {"coll": coleccion, "pipeline": origen(coleccion, campos)}}
+
+    ultimo_acumulado = {"$let": {
+        "vars": {"ultimo": {"$cond": [
+            {"$isArray": "$depreciacion_por_anio"},
+            {"$arrayElemAt": ["$depreciacion_por_anio", -1]},
+            None
+        ]}},
+        "in": "$$ultimo.depreciacion_acumulada"
+    }}
+    es = lambda coleccion: {"$eq": ["$_c", coleccion]}
+
+    pipeline = origen(Maquinaria.collection_name) + [
+        union(Seguro.collection_name, {"fecha_vencimiento": 1}),
+        union(Mantenimiento.collection_name, {"estado": 1, "fecha": 1}),
+        union(HistorialControl.collection_name),
+        union(Pronostico.collection_name, {"horas_op": 1, "riesgo": 1}),
+        union("depreciaciones", {"acumulado": ultimo_acumulado}),
+        {"$group": {
+            "_id": None,
+            "total_maquinarias": _contar_si(es(Maquinaria.collection_name)),
+            "total_seguros": _contar_si(es(Seguro.collection_name)),
+            "seguros_proximos_vencer": _contar_si({"$and": [
+                es(Seguro.collection_name),
+                {"$gte": ["$fecha_vencimiento", hoy]},
+                {"$lte": ["$fecha_vencimiento", en_30_dias]},
+            ]}),
+            "mantenimientos_pendientes": _contar_si({"$and": [
+                es(Mantenimiento.collection_name), {"$eq": ["$estado", "PENDIENTE"]}
+            ]}),
+            "mantenimientos_este_mes": _contar_si({"$and": [
+                es(Mantenimiento.collection_name),
+                {"$gte": ["$fecha", primer_dia_mes]},
+                {"$lte": ["$fecha", hoy]},
+            ]}),
+            "unidades_en_control": _contar_si(es(HistorialControl.collection_name)),
+            "horas_totales_operativas": {"$sum": {"$cond": [
+                es(Pronostico.collection_name), _a_numero("$horas_op"), 0
+            ]}},
+            "proximos_mantenimientos_ia": _contar_si({"$and": [
+                es(Pronostico.collection_name), {"$eq": ["$riesgo", "ALTO"]}
+            ]}),
+            "depreciacion_total": {"$sum": {"$cond": [
+                es("depreciaciones"), _a_numero("$acumulado"), 0
+            ]}},
+        }},
+    ]
+    resultado = next(get_collection(Maquinaria).aggregate(pipeline), None) or {}
+    resultado.pop('_id', None)
+    return resultado
+
+class _DashboardSnapshot:
+    """
+    Última foto calculada del dashboard (por proceso).
+    Si está vencida se sirve igual y se recalcula en segundo plano;
+    solo la primera petición del proceso espera el cálculo.
+    """
+    def __init__(self):
+        self.datos = None
+        self.calculado_en = 0.0
+        self._lock = threading.Lock()
+        self._recalculando = False
+
+    def vencido(self):
+        return monotonic() - self.calculado_en > getattr(settings, 'DASHBOARD_SNAPSHOT_TTL', 60)
+
+    def invalidar(self):
+        self.calculado_en = 0.0
+
+    def recalcular(self):
+        datos = calcular_estadisticas_dashboard()
+        self.datos, self.calculado_en = datos, monotonic()
+        return datos
+
+    def _recalcular_en_segundo_plano(self):
+        try:
+            self.recalcular()
+        except Exception as e:
+            logger.warning(f"No se pudo recalcular el dashboard en segundo plano: {e}")
+        finally:
+            self._recalculando = False
+
+    def obtener(self):
+        if self.datos is None:
+            with self._lock:
+                if self.datos is None:
+                    return self.recalcular()
+        if self.vencido():
+            with self._lock:
+                if not self._recalculando:
+                    self._recalculando = True
+                    threading.Thread(target=self._recalcular_en_segundo_plano, daemon=True).start()
+        return self.datos
+
+dashboard_snapshot = _DashboardSnapshot()
+
 class DashboardStatsView(APIView):
     def get(self, request):
         try:
-            # Check if MongoDB is available
-            if not is_mongodb_available():
+            # Solo se comprueba la conexión cuando todavía no hay una foto que servir
+            if dashboard_snapshot.datos is None and not is_mongodb_available():
                 return Response({
                     "error": "Base de datos no disponible temporalmente",
                     "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
@@ -3870,106 +4200,16 @@ class DashboardStatsView(APIView):
                     }
                 }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
             
-            # Total de seguros
-            seguro_collection = get_collection(Seguro)
-            total_seguros = 0
-            if seguro_collection is not None:
-                try:
-                    total_seguros = seguro_collection.count_documents({})
-                except Exception as e:
-                    logger.warning(f"Error contando seguros: {e}")
-                    total_seguros = 0
-
-            # Mantenimientos pendientes
-            mantenimiento_collection = get_collection(Mantenimiento)
-            mantenimientos_pendientes = 0
-            if mantenimiento_collection is not None:
-                try:
-                    mantenimientos_pendientes = mantenimiento_collection.count_documents({"estado": "PENDIENTE"})
-                except Exception as e:
-                    logger.warning(f"Error contando mantenimientos pendientes: {e}")
-                    mantenimientos_pendientes = 0
-
-            # Unidades en control
-            historial_collection = get_collection(HistorialControl)
-            unidades_en_control = 0
-            if historial_collection is not None:
-                try:
-                    unidades_en_control = historial_collection.count_documents({})
-                except Exception as e:
-                    logger.warning(f"Error contando unidades en control: {e}")
-                    unidades_en_control = 0
-
-            # Total de maquinarias
-            maquinaria_collection = get_collection(Maquinaria)
-            total_maquinarias = 0
-            if maquinaria_collection is not None:
-                try:
-                    total_maquinarias = maquinaria_collection.count_documents({})
-                except Exception as e:
-                    logger.warning(f"Error contando maquinarias: {e}")
-                    total_maquinarias = 0
-
-            # Horas totales operativas (sumar horas_op de todos los pronósticos, si existen)
-            horas_totales_operativas = 0
-            try:
-                pronostico_collection = get_collection(Pronostico)
-                if pronostico_collection is not None:
-                    horas_totales_operativas = sum([
-                        float(doc.get("horas_op", 0)) for doc in pronostico_collection.find({})
-                    ])
-            except Exception as e:
-                logger.warning(f"No se pudo calcular horas totales operativas: {e}")
-                horas_totales_operativas = 0
-            seguros_proximos_vencer = 0
-            try:
-                hoy = datetime.now()
-                en_30_dias = hoy.replace(hour=23, minute=59, second=59) + timedelta(days=30)
-                seguros_collection = get_collection(Seguro)
-                if seguros_collection is not None:
-                    seguros_proximos_vencer = seguros_collection.count_documents({
-                        "fecha_vencimiento": {"$gte": hoy, "$lte": en_30_dias}
-                    })
-            except Exception as e:
-                logger.warning(f"Error contando seguros próximos a vencer: {e}")
-                seguros_proximos_vencer = 0
-
-            # Mantenimientos realizados este mes
-            mantenimientos_este_mes = 0
-            try:
-                hoy = datetime.now()
-                primer_dia_mes = hoy.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                mantenimientos_collection = get_collection(Mantenimiento)
-                if mantenimientos_collection is not None:
-                    mantenimientos_este_mes = mantenimientos_collection.count_documents({
-                        "fecha": {"$gte": primer_dia_mes, "$lte": hoy}
-                    })
-            except Exception as e:
-                logger.warning(f"Error contando mantenimientos este mes: {e}")
-                mantenimientos_este_mes = 0
-
-            depreciacion_total = 0
-            try:
-                depreciaciones_collection = get_collection("depreciaciones")
-                if depreciaciones_collection is not None:
-                    for dep in depreciaciones_collection.find({}):
-                        por_anio = dep.get("depreciacion_por_anio", [])
-                        if por_anio:
-                            ultimo = por_anio[-1]
-                            depreciacion_total += float(ultimo.get("depreciacion_acumulada", 0))
-            except Exception as e:
-                logger.warning(f"Error calculando depreciación total: {e}")
-                depreciacion_total = 0
-
-            # Próximos mantenimientos según IA (riesgo ALTO en pronóstico)
-            proximos_mantenimientos_ia = 0
-            try:
-                pronostico_collection = get_collection(Pronostico)
-                if pronostico_collection is not None:
-                    proximos_mantenimientos_ia = pronostico_collection.count_documents({"riesgo": "ALTO"})
-            except Exception as e:
-                logger.warning(f"Error contando próximos mantenimientos IA: {e}")
-                proximos_mantenimientos_ia = 0
+            stats = dashboard_snapshot.obtener()
+            total_maquinarias = stats.get('total_maquinarias', 0)
+            total_seguros = stats.get('total_seguros', 0)
+            seguros_proximos_vencer = stats.get('seguros_proximos_vencer', 0)
+            mantenimientos_pendientes = stats.get('mantenimientos_pendientes', 0)
+            mantenimientos_este_mes = stats.get('mantenimientos_este_mes', 0)
+            unidades_en_control = stats.get('unidades_en_control', 0)
+            horas_totales_operativas = stats.get('horas_totales_operativas', 0)
+            depreciacion_total = stats.get('depreciacion_total', 0)
+            proximos_mantenimientos_ia = stats.get('proximos_mantenimientos_ia', 0)
 
             data = [
                 {"title": "Total de Maquinarias", "value": str(total_maquinarias), "icon": "mdi:tractor", "color": "secondary.main"},
@@ -4028,26 +4268,17 @@ def activos_list(request):
 
 def cargar_funcion_pronostico():
     """
-    Carga la función de pronóstico desde el archivo optimizado
+    Función de pronóstico del modelo ya cargado en el proceso (ver core/pronostico.py)
     """
-    import sys
-    import os
-    
-    # Agregar el directorio del pronóstico al path
-    pronostico_dir = os.path.join(settings.BASE_DIR, "pronostico-v1")
-    if pronostico_dir not in sys.path:
-        sys.path.insert(0, pronostico_dir)
-    
-    try:
-        from pronostico_model import predecir_mantenimiento
-        return predecir_mantenimiento
-    except ImportError as e:
-        print(f"Error al importar pronostico_model: {e}")
-        raise
+    return registro_modelo.predecir
+
+def emails_todos_usuarios():
+    return [u['Email'] for u in get_collection(Usuario).find({'Email': {'$ne': None}}, {'Email': 1}) if u.get('Email')]
+
 
-def enviar_correo_a_todos_usuarios_html(maquinaria, pronostico):
-    usuarios = get_collection(Usuario).find({})
-    emails = [u.get('Email') for u in usuarios if u.get('Email')]
+def enviar_correo_a_todos_usuarios_html(maquinaria, pronostico, emails=None):
+    if emails is None:
+        emails = emails_todos_usuarios()
     if not emails:
         return
     placa = maquinaria.get('placa', pronostico.get('placa', 'Sin placa'))
@@ -4115,21 +4346,65 @@ def enviar_correo_a_todos_usuarios_html(maquinaria, pronostico):
     </table>
     """
     subject = f"Pronóstico de mantenimiento para {placa}"
-    msg = EmailMultiAlternatives(subject, '', 'noreply@tusistema.com', emails)
-    msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    # Lo envía el worker de core/correos.py, fuera del request
+    encolar_correo(subject, html_content, emails, remitente='noreply@tusistema.com')
+
+
+def es_riesgo_alto(pronostico):
+    return str(pronostico.get('riesgo') or '').upper() == 'ALTO'
+
+
+def alerta_pronostico(maquinaria, pronostico):
+    """Fila del resumen de una carga masiva para una máquina con riesgo alto."""
+    return {
+        'placa': pronostico.get('placa'),
+        'detalle': maquinaria.get('detalle', ''),
+        'fecha_asig': pronostico.get('fecha_asig'),
+        'resultado': pronostico.get('resultado'),
+        'riesgo': pronostico.get('riesgo'),
+        'probabilidad': pronostico.get('probabilidad'),
+        'urgencia': pronostico.get('urgencia'),
+        'fecha_mantenimiento': pronostico.get('fecha_mantenimiento'),
+    }
+
+
+def encolar_resumen_pronosticos(alertas, total, emails=None):
+    """
+    Un solo correo por usuario al terminar una carga de Excel, con la tabla de las máquinas
+    de riesgo alto (en lugar de un correo por fila). Sin máquinas de riesgo alto no se envía.
+    """
+    if not alertas:
+        return
+    if emails is None:
+        emails = emails_todos_usuarios()
+    filas = ''.join(
+        f"<tr><td>{a['placa']}</td><td>{a.get('detalle') or ''}</td><td>{a.get('fecha_asig') or ''}</td>"
+        f"<td>{a.get('resultado') or ''}</td><td style='color:red;'><b>{a.get('riesgo') or ''}</b></td>"
+        f"<td>{a.get('probabilidad') or ''}</td><td>{a.get('urgencia') or ''}</td>"
+        f"<td>{a.get('fecha_mantenimiento') or ''}</td></tr>"
+        for a in alertas
+    )
+    html_content = f"""
+    <h2>Resumen de Pronósticos</h2>
+    <p>Se procesaron {total} pronósticos; {len(alertas)} máquinas tienen riesgo alto.</p>
+    <table style='border-collapse:collapse;' border='1' cellpadding='4'>
+      <tr><th>Placa</th><th>Detalle</th><th>Fecha de Asignación</th><th>Tipo de Mantenimiento</th>
+        <th>Riesgo</th><th>Probabilidad</th><th>Urgencia</th><th>Fecha de Mantenimiento</th></tr>
+      {filas}
+    </table>
+    """
+    subject = f"Resumen de pronósticos: {len(alertas)} máquinas con riesgo alto"
+    encolar_correo(subject, html_content, emails, remitente='noreply@tusistema.com')
 
 class PronosticoAPIView(APIView):
     def post(self, request):
         serializer = PronosticoInputSerializer(data=request.data)
         if serializer.is_valid():
             data = serializer.validated_data
-            import sys, os
-            pronostico_dir = os.path.join(os.path.dirname(__file__), '../pronostico-v1')
-            if pronostico_dir not in sys.path:
-                sys.path.insert(0, pronostico_dir)
-            from pronostico_model import predecir_mantenimiento
-            resultado_dict = predecir_mantenimiento(data)
+            try:
+                resultado_dict = registro_modelo.predecir(data)
+            except ModeloNoDisponible as e:
+                return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
             data['resultado'] = resultado_dict.get('resultado')
             data['recomendaciones'] = resultado_dict.get('recomendaciones')
             data['riesgo'] = resultado_dict.get('riesgo')
@@ -4148,29 +4423,124 @@ class PronosticoAPIView(APIView):
             collection = get_collection(Pronostico)
             data = convert_dates_to_str(data)
             existing = collection.find_one({'placa': placa, 'fecha_asig': fecha_asig})
-            maquinaria_collection = get_collection(Maquinaria)
-            maquinaria_doc = maquinaria_collection.find_one({'placa': placa}) or {}
+            maquinaria_doc = obtener_maquinaria_por_placa(placa) or {}
             if existing:
                 collection.update_one({'_id': existing['_id']}, {'$set': data})
+                dashboard_snapshot.invalidar()
                 updated = collection.find_one({'_id': existing['_id']})
                 enviar_correo_a_todos_usuarios_html(maquinaria_doc, data)
                 return Response(serialize_doc(updated), status=status.HTTP_200_OK)
             else:
                 result = collection.insert_one(data)
+                dashboard_snapshot.invalidar()
                 new_doc = collection.find_one({'_id': result.inserted_id})
                 enviar_correo_a_todos_usuarios_html(maquinaria_doc, data)
                 return Response(serialize_doc(new_doc), status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def get(self, request):
-        # Devolver todos los pronósticos sin paginación
-        cursor = Pronostico().collection.find({'activo': {'$ne': False}}, {
+        collection = get_collection(Pronostico)
+        if collection is None:
+            return Response({"error": "Base de datos no disponible temporalmente"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        # Sin `cursor` se devuelven todos los pronósticos (compatibilidad con el frontend)
+        return listar_paginado(request, collection, {'activo': {'$ne': False}}, {
             "_id": 1, "placa": 1, "fecha_asig": 1, "horas_op": 1, "recorrido": 1, "resultado": 1, "creado_en": 1, "recomendaciones": 1,
             "riesgo": 1, "probabilidad": 1, "fecha_sugerida": 1, "fecha_mantenimiento": 1, "fecha_recordatorio": 1, "dias_hasta_mantenimiento": 1, "urgencia": 1
-        })
-        registros = list(cursor)
-        registros_serializados = [serialize_doc(r) for r in registros]
-        return Response(registros_serializados, status=status.HTTP_200_OK)
+        }, ordenes=('_id', 'fecha_asig', 'creado_en'))
+
+# Campos del resultado del modelo que se guardan en el pronóstico
+CAMPOS_RESULTADO_PRONOSTICO = (
+    'resultado', 'recomendaciones', 'riesgo', 'probabilidad', 'fecha_prediccion', 'fecha_sugerida',
+    'fecha_mantenimiento', 'fecha_recordatorio', 'dias_hasta_mantenimiento', 'urgencia'
+)
+FORMATOS_FECHA_EXCEL = ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y', '%m/%d/%Y']
+
+
+def normalizar_fechas_excel(serie):
+    """
+    Fechas de la columna fecha_asig a 'YYYY-MM-DD' de una vez: las celdas de fecha de
+    Excel y los textos en FORMATOS_FECHA_EXCEL (en ese orden); lo demás queda como texto.
+    """
+    import pandas as pd
+    textos = serie.astype(str).str.strip()
+    es_fecha = serie.map(lambda v: isinstance(v, (datetime, date)))
+    fechas = pd.to_datetime(serie.where(es_fecha), errors='coerce')
+    for fmt in FORMATOS_FECHA_EXCEL:
+        faltantes = fechas.isna()
+        if not faltantes.any():
+            break
+        fechas = fechas.where(~faltantes, pd.to_datetime(textos.where(faltantes), format=fmt, errors='coerce'))
+    return fechas.dt.strftime('%Y-%m-%d').where(fechas.notna(), textos)
+
+
+def guardar_pronosticos_excel(validas):
+    """
+    Pronostica y guarda las filas válidas de un Excel (DataFrame con el índice original de
+    cada fila) con un upsert por (placa, fecha_asig). Devuelve (resultado de cada fila,
+    alertas de riesgo alto para el correo de resumen). La usan la carga directa y los
+    trabajos en segundo plano (core/trabajos_pronostico.py); lanza ModeloNoDisponible si el
+    modelo no carga.
+    """
+    collection = get_collection(Pronostico)
+    if collection is None:
+        raise ConnectionError("MongoDB no disponible")
+    resultados = []
+
+    # 1) Pronosticar todas las filas en una sola llamada al modelo cargado
+    pronosticos = registro_modelo.predict_batch(validas.reset_index(drop=True))
+
+    # 2) Un UpdateOne(upsert) por (placa, fecha_asig); si se repite en el Excel, gana la última fila
+    filas = {}
+    for (index, datos), resultado_dict in zip(validas.to_dict('index').items(), pronosticos):
+        if 'error' in resultado_dict and 'resultado' not in resultado_dict:
+            resultados.append({'fila': index + 1, 'placa': datos['placa'], 'estado': 'error',
+                               'error': resultado_dict['error']})
+            continue
+        data = dict(datos)
+        for campo in CAMPOS_RESULTADO_PRONOSTICO:
+            data[campo] = resultado_dict.get(campo)
+        data = convert_dates_to_str(data)
+        filas.setdefault((data['placa'], data['fecha_asig']), []).append((index, data))
+
+    claves = list(filas)
+    operaciones = [
+        UpdateOne({'placa': placa, 'fecha_asig': fecha}, {'$set': filas[(placa, fecha)][-1][1]}, upsert=True)
+        for placa, fecha in claves
+    ]
+    errores_escritura = {}
+    creados = set()
+    if operaciones:
+        try:
+            resultado_bulk = collection.bulk_write(operaciones, ordered=False)
+            creados = set(resultado_bulk.upserted_ids)
+        except BulkWriteError as e:
+            detalles = e.details
+            creados = {u['index'] for u in detalles.get('upserted', [])}
+            errores_escritura = {err['index']: err.get('errmsg', 'Error al guardar') for err in detalles.get('writeErrors', [])}
+
+    # 3) Reporte por fila y alertas de los guardados con riesgo alto
+    maquinarias = obtener_maquinarias_por_placas({placa for placa, _ in claves})
+    alertas = []
+    for posicion, clave in enumerate(claves):
+        for orden, (index, data) in enumerate(filas[clave]):
+            if posicion in errores_escritura:
+                resultados.append({'fila': index + 1, 'placa': data['placa'], 'estado': 'error',
+                                   'error': errores_escritura[posicion]})
+                continue
+            resultados.append({
+                'fila': index + 1,
+                'placa': data['placa'],
+                # Igual que al procesar fila por fila: la primera aparición crea, las repetidas actualizan
+                'estado': 'creado' if posicion in creados and orden == 0 else 'actualizado',
+                'resultado': data['resultado']
+            })
+        if posicion not in errores_escritura and es_riesgo_alto(filas[clave][-1][1]):
+            alertas.append(alerta_pronostico(maquinarias.get(clave[0]) or {}, filas[clave][-1][1]))
+
+    if any(r['estado'] != 'error' for r in resultados):
+        dashboard_snapshot.invalidar()
+    return resultados, alertas
+
 
 class PronosticoExcelUploadView(APIView):
     def post(self, request):
@@ -4237,133 +4607,52 @@ class PronosticoExcelUploadView(APIView):
                     }
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Importar el modelo de pronóstico
-            import sys, os
-            pronostico_dir = os.path.join(os.path.dirname(__file__), '../pronostico-v1')
-            if pronostico_dir not in sys.path:
-                sys.path.insert(0, pronostico_dir)
-            from pronostico_model import predecir_mantenimiento
-            
-            # Procesar cada fila del CSV
-            collection = get_collection(Pronostico)
-            maquinaria_collection = get_collection(Maquinaria)
-            
             resultados = []
-            exitosos = 0
-            errores = 0
             
-            for index, row in df.iterrows():
+            # 1) Normalizar columnas en bloque: fechas a YYYY-MM-DD y números
+            df['placa'] = df['placa'].astype(str).str.strip()
+            df['horas_op'] = pd.to_numeric(df['horas_op'], errors='coerce')
+            df['recorrido'] = pd.to_numeric(df['recorrido'], errors='coerce')
+            df['fecha_asig'] = normalizar_fechas_excel(df['fecha_asig'])
+            
+            invalidas = df['horas_op'].isna() | df['recorrido'].isna() | df['placa'].isin(['', 'nan'])
+            for index, row in df[invalidas].iterrows():
+                resultados.append({
+                    'fila': index + 1,
+                    'placa': row['placa'],
+                    'estado': 'error',
+                    'error': 'placa vacía o horas_op/recorrido no numéricos'
+                })
+            validas = df.loc[~invalidas, ['placa', 'fecha_asig', 'horas_op', 'recorrido']]
+            
+            # 2) Trabajo en segundo plano si se pide (?async=1) o si el Excel es grande
+            if request.query_params.get('async') in ('1', 'true') or len(validas) > settings.PRONOSTICO_EXCEL_MAX_SINCRONO:
                 try:
-                    # Preparar datos para el pronóstico
-                    fecha_asig_raw = row['fecha_asig']
-                    
-                    # Procesar fecha de asignación para asegurar formato YYYY-MM-DD
-                    if isinstance(fecha_asig_raw, (datetime, date)):
-                        fecha_asig = fecha_asig_raw.strftime('%Y-%m-%d')
-                    elif isinstance(fecha_asig_raw, str):
-                        # Si es string, intentar parsear y formatear
-                        try:
-                            # Intentar diferentes formatos de fecha
-                            for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y', '%m/%d/%Y']:
-                                try:
-                                    parsed_date = datetime.strptime(fecha_asig_raw, fmt)
-                                    fecha_asig = parsed_date.strftime('%Y-%m-%d')
-                                    break
-                                except ValueError:
-                                    continue
-                            else:
-                                fecha_asig = str(fecha_asig_raw).strip()
-                        except:
-                            fecha_asig = str(fecha_asig_raw).strip()
-                    else:
-                        fecha_asig = str(fecha_asig_raw).strip()
-                    
-                    datos = {
-                        'placa': str(row['placa']).strip(),
-                        'fecha_asig': fecha_asig,
-                        'horas_op': float(row['horas_op']),
-                        'recorrido': float(row['recorrido'])
-                    }
-                    
-                    # Generar pronóstico
-                    resultado_dict = predecir_mantenimiento(datos)
-                    
-                    # Preparar datos para guardar
-                    data = datos.copy()
-                    data['resultado'] = resultado_dict.get('resultado')
-                    data['recomendaciones'] = resultado_dict.get('recomendaciones')
-                    data['riesgo'] = resultado_dict.get('riesgo')
-                    data['probabilidad'] = resultado_dict.get('probabilidad')
-                    data['fecha_prediccion'] = resultado_dict.get('fecha_prediccion')
-                    data['fecha_sugerida'] = resultado_dict.get('fecha_sugerida')
-                    data['fecha_mantenimiento'] = resultado_dict.get('fecha_mantenimiento')
-                    data['fecha_recordatorio'] = resultado_dict.get('fecha_recordatorio')
-                    data['dias_hasta_mantenimiento'] = resultado_dict.get('dias_hasta_mantenimiento')
-                    data['urgencia'] = resultado_dict.get('urgencia')
-                    
-                    # Formatear fecha de asignación para asegurar formato YYYY-MM-DD
-                    fecha_asig = data.get('fecha_asig')
-                    if isinstance(fecha_asig, (datetime, date)):
-                        fecha_asig = fecha_asig.strftime('%Y-%m-%d')
-                    elif isinstance(fecha_asig, str):
-                        # Si es string, intentar parsear y formatear
-                        try:
-                            # Intentar diferentes formatos de fecha
-                            for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y', '%m/%d/%Y']:
-                                try:
-                                    parsed_date = datetime.strptime(fecha_asig, fmt)
-                                    fecha_asig = parsed_date.strftime('%Y-%m-%d')
-                                    break
-                                except ValueError:
-                                    continue
-                        except:
-                            # Si no se puede parsear, mantener como está
-                            pass
-                    data['fecha_asig'] = fecha_asig
-                    
-                    # Convertir fechas a string
-                    data = convert_dates_to_str(data)
-                    
-                    # Verificar si ya existe un pronóstico para esta placa y fecha
-                    existing = collection.find_one({'placa': data['placa'], 'fecha_asig': data['fecha_asig']})
-                    
-                    # Obtener información de la maquinaria
-                    maquinaria_doc = maquinaria_collection.find_one({'placa': data['placa']}) or {}
-                    
-                    if existing:
-                        # Actualizar pronóstico existente
-                        collection.update_one({'_id': existing['_id']}, {'$set': data})
-                        updated = collection.find_one({'_id': existing['_id']})
-                        enviar_correo_a_todos_usuarios_html(maquinaria_doc, data)
-                        resultados.append({
-                            'fila': index + 1,
-                            'placa': data['placa'],
-                            'estado': 'actualizado',
-                            'resultado': data['resultado']
-                        })
-                    else:
-                        # Crear nuevo pronóstico
-                        result = collection.insert_one(data)
-                        new_doc = collection.find_one({'_id': result.inserted_id})
-                        enviar_correo_a_todos_usuarios_html(maquinaria_doc, data)
-                        resultados.append({
-                            'fila': index + 1,
-                            'placa': data['placa'],
-                            'estado': 'creado',
-                            'resultado': data['resultado']
-                        })
-                    
-                    exitosos += 1
-                    
-                except Exception as e:
-                    errores += 1
-                    resultados.append({
-                        'fila': index + 1,
-                        'placa': str(row.get('placa', 'N/A')),
-                        'estado': 'error',
-                        'error': str(e)
-                    })
+                    trabajo_id = crear_trabajo(validas, resultados, len(df), excel_file.name,
+                                               request.headers.get('X-User-Email'))
+                except ConnectionError as e:
+                    return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                return Response({
+                    'mensaje': f'El archivo se procesará en segundo plano ({len(df)} filas).',
+                    'job_id': str(trabajo_id),
+                    'estado': 'pendiente',
+                    'url': reverse('pronostico-job', args=[str(trabajo_id)]),
+                }, status=status.HTTP_202_ACCEPTED)
+
+            # 3) Pronóstico y guardado dentro del request
+            try:
+                guardados, alertas = guardar_pronosticos_excel(validas)
+            except ModeloNoDisponible as e:
+                return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            resultados += guardados
             
+            exitosos = sum(1 for r in resultados if r['estado'] != 'error')
+            errores = len(resultados) - exitosos
+            try:
+                encolar_resumen_pronosticos(alertas, exitosos)
+            except Exception as e:
+                logger.error(f"Error al encolar el resumen de pronósticos: {str(e)}")
+            resultados.sort(key=lambda r: r['fila'])
             return Response({
                 'mensaje': f'Procesamiento completado. {exitosos} pronósticos procesados exitosamente, {errores} errores.',
                 'resumen': {
@@ -4381,6 +4670,20 @@ class PronosticoExcelUploadView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class PronosticoJobView(APIView):
+    """Avance, errores por fila y conteos de una carga de Excel en segundo plano."""
+    def get(self, request, job_id):
+        try:
+            trabajo = obtener_trabajo(job_id)
+        except ConnectionError as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if trabajo is None:
+            return Response({'error': 'Trabajo no encontrado'}, status=status.HTTP_404_NOT_FOUND)
+        if trabajo['estado'] in ('pendiente', 'procesando'):
+            # Si el proceso que lo tenía se reinició, este lo retoma al vencer el bloqueo
+            despertar_worker()
+        return Response(serializar_trabajo(trabajo))
+
 class PronosticoSummaryView(APIView):
     def get(self, request):
         try:
@@ -4456,11 +4759,10 @@ class MaquinariaViewSet(viewsets.ViewSet):
 
 class UsuarioListView(APIView):
     """Solo el admin puede ver la lista de usuarios."""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede ver la lista de usuarios'
+
     def get(self, request):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
-        
         collection = get_collection(Usuario)
         
         # Check if MongoDB is available
@@ -4470,26 +4772,21 @@ class UsuarioListView(APIView):
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
                 "usuarios": []
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='admin'):
-            return Response({'error': 'Solo el administrador puede ver la lista de usuarios'}, status=status.HTTP_403_FORBIDDEN)
         # Solo mostrar usuarios activos
-        usuarios = list(collection.find({
+        return listar_paginado(request, collection, {
             "$or": [
                 {"activo": True},
                 {"activo": {"$exists": False}}
             ]
-        }, {"_id": 1, "Email": 1, "Cargo": 1, "Permiso": 1, "Nombre": 1, "Unidad": 1, "permisos": 1, "Memorandum": 1}))
-        return Response([serialize_doc(u) for u in usuarios], status=status.HTTP_200_OK)
+        }, {"_id": 1, "Email": 1, "Cargo": 1, "Permiso": 1, "Nombre": 1, "Unidad": 1, "permisos": 1, "Memorandum": 1},
+            ordenes=('_id', 'Nombre', 'Email'))
 
 class UsuarioCargoUpdateView(APIView):
     """Solo el admin puede cambiar el cargo de otros usuarios."""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede cambiar roles'
+
     def put(self, request, id):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
-        
         collection = get_collection(Usuario)
         if collection is None:
             return Response({
@@ -4497,9 +4794,7 @@ class UsuarioCargoUpdateView(APIView):
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos."
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='admin'):
-            return Response({'error': 'Solo el administrador puede cambiar roles'}, status=status.HTTP_403_FORBIDDEN)
+        user = request.user
         # No puede cambiarse a sí mismo
         if str(user.get('_id')) == id:
             return Response({'error': 'No puedes cambiar tu propio cargo'}, status=status.HTTP_400_BAD_REQUEST)
@@ -4513,6 +4808,8 @@ class UsuarioCargoUpdateView(APIView):
             return Response({'error': 'Cargo inválido. Debe ser: admin, encargado o tecnico'}, status=status.HTTP_400_BAD_REQUEST)
         
         result = collection.update_one({'_id': ObjectId(id)}, {'$set': {'Cargo': nuevo_cargo}})
+        usuario_modificado()
+        revocar_sesiones_tras_cambio(id)
         if result.matched_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         usuario_actualizado = collection.find_one({'_id': ObjectId(id)})
@@ -4520,14 +4817,13 @@ class UsuarioCargoUpdateView(APIView):
 
 class UsuarioMemorandumUpdateView(APIView):
     """Solo el admin y encargado pueden cambiar el memorandum de otros usuarios."""
+    permission_classes = [EsEncargado]
+    mensaje_permiso = 'Solo el administrador y encargado pueden cambiar memorandum'
+
     def put(self, request, id):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
+        email = request.user.email
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='encargado'):
-            return Response({'error': 'Solo el administrador y encargado pueden cambiar memorandum'}, status=status.HTTP_403_FORBIDDEN)
+        user = request.user
         # No puede cambiarse a sí mismo
         if str(user.get('_id')) == id:
             return Response({'error': 'No puedes cambiar tu propio memorandum'}, status=status.HTTP_400_BAD_REQUEST)
@@ -4554,6 +4850,7 @@ class UsuarioMemorandumUpdateView(APIView):
                 return Response({'error': 'Fecha inválida. Verifique día, mes y año'}, status=status.HTTP_400_BAD_REQUEST)
         
         result = collection.update_one({'_id': ObjectId(id)}, {'$set': {'Memorandum': nuevo_memorandum}})
+        usuario_modificado()
         if result.matched_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         
@@ -4574,35 +4871,33 @@ class UsuarioMemorandumUpdateView(APIView):
 
 class UsuarioPermisoUpdateView(APIView):
     """Solo el admin puede cambiar el permiso de otros usuarios."""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede cambiar permisos'
+
     def put(self, request, id):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='admin'):
-            return Response({'error': 'Solo el administrador puede cambiar permisos'}, status=status.HTTP_403_FORBIDDEN)
+        user = request.user
         if str(user.get('_id')) == id:
             return Response({'error': 'No puedes cambiar tu propio permiso'}, status=status.HTTP_400_BAD_REQUEST)
         nuevo_permiso = request.data.get('Permiso')
         if not nuevo_permiso:
             return Response({'error': 'Permiso requerido'}, status=status.HTTP_400_BAD_REQUEST)
         result = collection.update_one({'_id': ObjectId(id)}, {'$set': {'Permiso': nuevo_permiso}})
+        usuario_modificado()
         if result.matched_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         usuario_actualizado = collection.find_one({'_id': ObjectId(id)})
         return Response(serialize_doc(usuario_actualizado), status=status.HTTP_200_OK)
 
 class UsuarioDeleteView(APIView):
-    """Solo el admin puede desactivar usuarios (no a sí mismo)."""
+    """Solo el admin puede desactivar, eliminar y reactivar usuarios (no a sí mismo)."""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede gestionar usuarios'
+
     def delete(self, request, id):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
+        email = request.user.email
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='admin'):
-            return Response({'error': 'Solo el administrador puede gestionar usuarios'}, status=status.HTTP_403_FORBIDDEN)
+        user = request.user
         if str(user.get('_id')) == id:
             return Response({'error': 'No puedes operar sobre tu propio usuario'}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -4612,7 +4907,14 @@ class UsuarioDeleteView(APIView):
             target = collection.find_one({'_id': ObjectId(id)})
             if not target:
                 return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
+            # Antes de borrarlo: sus tokens dejan de valer (si no se puede, no se borra)
+            try:
+                revocar_sesiones(id)
+            except (PyMongoError, ConnectionError) as e:
+                logger.error(f"No se pudieron revocar las sesiones del usuario {id}: {e}")
+                return Response({'error': 'Base de datos no disponible temporalmente'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
             collection.delete_one({'_id': ObjectId(id)})
+            usuario_modificado()
             try:
                 registrar_actividad(
                     email,
@@ -4643,40 +4945,32 @@ class UsuarioDeleteView(APIView):
                 "desactivado_por": desactivado_por
             }}
         )
+        usuario_modificado()
+        revocar_sesiones_tras_cambio(id)
         if result.modified_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         return Response({'success': True}, status=status.HTTP_200_OK)
 
     def patch(self, request, id):
         """Reactivar un usuario desactivado"""
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not user or user.get('Cargo', '').lower() != 'admin':
-            return Response({'error': 'Solo el administrador puede reactivar usuarios'}, status=status.HTTP_403_FORBIDDEN)
-        
+
         # Reactivar el usuario
         result = collection.update_one(
             {'_id': ObjectId(id)},
             {"$set": {"activo": True, "fecha_reactivacion": datetime.now()}}
         )
+        usuario_modificado()
         if result.modified_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         return Response({'success': True}, status=status.HTTP_200_OK)
 
 class RegistrosDesactivadosView(APIView):
+    # Solo administradores
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo los administradores pueden ver registros desactivados'
+
     def get(self, request, maquinaria_id):
-        # Verificar permisos de ADMINISTRADOR únicamente
-        actor_email = request.headers.get('X-User-Email')
-        if not actor_email:
-            return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
-        
-        user = get_collection(Usuario).find_one({"Email": actor_email})
-        if not user or user.get('Cargo', '').lower() != 'admin':
-            return Response({"error": "Solo los administradores pueden ver registros desactivados"}, status=status.HTTP_403_FORBIDDEN)
-        
         if not ObjectId.is_valid(maquinaria_id):
             return Response({"error": "ID de maquinaria inválido"}, status=status.HTTP_400_BAD_REQUEST)
         
@@ -4694,30 +4988,31 @@ class RegistrosDesactivadosView(APIView):
         ]
         
         registros_desactivados = {}
+        # Todas las colecciones apuntan a la misma maquinaria: una sola consulta de placa
+        placas = obtener_placas([maquinaria_id])
+        incluir = incluir_archivo(request)
         
         for collection_name, label in collections:
             collection = get_collection(collection_name)
             registros = list(collection.find({
                 'maquinaria': ObjectId(maquinaria_id),
                 'activo': False
-            }))
-            if registros:
-                registros_desactivados[label] = serialize_list(registros)
+            }, None if incluir else proyeccion_sin_contenido(collection_name)))
+            if registros and collection_name in CAMPO_CONTENIDO:
+                registros_desactivados[label] = serializar_adjuntos(
+                    request, collection, registros, incluir, lambda docs: serialize_list(docs, placas)
+                )
+            elif registros:
+                registros_desactivados[label] = serialize_list(registros, placas)
         
         return Response(registros_desactivados)
 
 class TodosRegistrosDesactivadosView(APIView):
-    """Vista para obtener todos los registros desactivados del sistema"""
+    """Vista para obtener todos los registros desactivados del sistema (solo administradores)"""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo los administradores pueden ver registros desactivados'
+
     def get(self, request):
-        # Verificar permisos de ADMINISTRADOR únicamente
-        actor_email = request.headers.get('X-User-Email')
-        if not actor_email:
-            return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
-        
-        user = get_collection(Usuario).find_one({"Email": actor_email})
-        if not user or user.get('Cargo', '').lower() != 'admin':
-            return Response({"error": "Solo los administradores pueden ver registros desactivados"}, status=status.HTTP_403_FORBIDDEN)
-        
         # Obtener parámetros de consulta
         dias = request.GET.get('dias', '30')  # Por defecto 30 días
         try:
@@ -4742,6 +5037,9 @@ class TodosRegistrosDesactivadosView(APIView):
         ]
         
         registros_desactivados = {}
+        # Placas ya resueltas durante esta petición (compartidas entre colecciones)
+        placas = {}
+        incluir = incluir_archivo(request)
         
         try:
             # Calcular fecha límite
@@ -4846,17 +5144,23 @@ class TodosRegistrosDesactivadosView(APIView):
                         ]
                     }
                     
-                    # Buscar registros recientes
-                    registros = list(collection.find(query))
+                    # Buscar registros recientes (sin el contenido de los archivos salvo ?include=archivo)
+                    proyeccion = None if incluir else proyeccion_sin_contenido(collection_name)
+                    registros = list(collection.find(query, proyeccion))
                     print(f"Encontrados {len(registros)} registros desactivados recientes en {collection_name}")
                     
                     # Si no hay registros recientes, buscar solo los desactivados (sin filtro de fecha)
                     if not registros:
                         query_simple = {'activo': False}
-                        registros = list(collection.find(query_simple))
+                        registros = list(collection.find(query_simple, proyeccion))
                         print(f"Encontrados {len(registros)} registros desactivados totales en {collection_name}")
                 
                     if registros:
+                        # Resolver en bloque las placas que aún no conocemos
+                        faltantes = {str(ref) for ref in map(_maquinaria_ref, registros) if ref is not None} - placas.keys()
+                        if faltantes:
+                            placas.update(obtener_placas(faltantes))
+                        
                         # Serializar registros desactivados
                         def serialize_desactivados(doc):
                             if not doc:
@@ -4901,15 +5205,7 @@ class TodosRegistrosDesactivadosView(APIView):
                             # --- Asegurar maquinaria_id como string si existe ---
                             if 'maquinaria_id' in doc:
                                 # Obtener la placa de la maquinaria en lugar del ID
-                                try:
-                                    maquinaria_collection = get_collection('maquinaria')
-                                    maquinaria = maquinaria_collection.find_one({"_id": ObjectId(doc['maquinaria_id'])})
-                                    if maquinaria:
-                                        doc['Maquinaria'] = maquinaria.get('placa', 'Sin placa')
-                                    else:
-                                        doc['Maquinaria'] = 'Maquinaria no encontrada'
-                                except:
-                                    doc['Maquinaria'] = 'Error al obtener maquinaria'
+                                doc['Maquinaria'] = placas.get(doc['maquinaria_id'], 'Maquinaria no encontrada')
                                 # NO eliminar maquinaria_id, lo necesitamos para reactivación
                             
                             # Mejorar nombres de campos para mejor legibilidad
@@ -4956,7 +5252,13 @@ class TodosRegistrosDesactivadosView(APIView):
                             
                             return doc
                         
-                        registros_desactivados[label] = [serialize_desactivados(record) for record in registros]
+                        if collection_name in CAMPO_CONTENIDO:
+                            registros_desactivados[label] = serializar_adjuntos(
+                                request, collection, registros, incluir,
+                                lambda docs: [serialize_desactivados(record) for record in docs]
+                            )
+                        else:
+                            registros_desactivados[label] = [serialize_desactivados(record) for record in registros]
                         print(f"Agregados {len(registros)} registros de {label}")
                 
                 print(f"Total de colecciones con registros: {len(registros_desactivados)}")
@@ -4969,6 +5271,184 @@ class TodosRegistrosDesactivadosView(APIView):
             traceback.print_exc()
             return Response({"error": f"Error interno: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+class CacheEstadisticasView(APIView):
+    """Contadores de hits/misses de las cachés en memoria, estado de la conexión a MongoDB y del buffer de auditoría de este proceso (solo administradores)"""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo los administradores pueden ver las estadísticas de caché'
+
+    def get(self, request):
+        return Response({'pid': os.getpid(), 'caches': estadisticas_caches(), 'mongodb': mongodb_health(),
+                         'auditoria': escritor_auditoria.estadisticas()})
+
+class AdjuntosEstadisticasView(APIView):
+    """Espacio usado por los adjuntos en GridFS y el ahorrado por deduplicación (solo administradores)"""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo los administradores pueden ver las estadísticas de adjuntos'
+
+    def get(self, request):
+        return Response(estadisticas_almacenamiento())
+
+
+_RANGO_BYTES = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _leer_rango(archivo, inicio, fin):
+    """Genera los bytes [inicio, fin] del archivo en bloques del tamaño de chunk de GridFS."""
+    archivo.seek(inicio)
+    restante = fin - inicio + 1
+    bloque = archivo.chunk_size or 255 * 1024
+    while restante > 0:
+        datos = archivo.read(min(bloque, restante))
+        if not datos:
+            break
+        restante -= len(datos)
+        yield datos
+    archivo.close()
+
+
+class AdjuntoDescargaView(APIView):
+    """
+    Descarga en streaming de un adjunto guardado en GridFS.
+    Soporta Range (un solo rango) para el visor de PDF y ETag/If-None-Match para la caché del navegador.
+    Se usa directamente como src de <img>/<iframe>, por eso no exige X-User-Email.
+    Las fotos se sirven recomprimidas; ?variante=miniatura u ?variante=original (ver imagenes.py).
+    """
+    def get(self, request, archivo_id):
+        if not ObjectId.is_valid(archivo_id):
+            return Response({"error": "ID de archivo inválido"}, status=status.HTTP_400_BAD_REQUEST)
+        if not is_mongodb_available():
+            return Response({"error": "Base de datos no disponible temporalmente"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        variante = request.query_params.get('variante')
+        try:
+            archivo = abrir_adjunto(elegir_variante(ObjectId(archivo_id), variante, request.headers.get('Accept', '')))
+        except gridfs.errors.NoFile:
+            return Response({"error": "Archivo no encontrado"}, status=status.HTTP_404_NOT_FOUND)
+
+        metadata = archivo.metadata or {}
+        etag = f'"{metadata.get("sha256") or archivo_id}"'
+        if etag in [e.strip() for e in request.headers.get('If-None-Match', '').split(',')]:
+            archivo.close()
+            respuesta = HttpResponseNotModified()
+            respuesta['ETag'] = etag
+            return respuesta
+
+        total = archivo.length
+        inicio, fin = 0, total - 1
+        estado = status.HTTP_200_OK
+        rango = _RANGO_BYTES.match(request.headers.get('Range', '').strip())
+        if rango and total > 0:
+            desde, hasta = rango.groups()
+            if desde:
+                inicio = int(desde)
+                fin = min(int(hasta), total - 1) if hasta else total - 1
+            elif hasta:
+                inicio = max(total - int(hasta), 0)
+            if inicio > fin or inicio >= total:
+                archivo.close()
+                respuesta = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                respuesta['Content-Range'] = f'bytes */{total}'
+                return respuesta
+            estado = status.HTTP_206_PARTIAL_CONTENT
+
+        respuesta = StreamingHttpResponse(
+            _leer_rango(archivo, inicio, fin) if total else iter(()),
+            status=estado,
+            content_type=metadata.get('contentType') or 'application/octet-stream',
+        )
+        respuesta['Content-Length'] = str(fin - inicio + 1 if total else 0)
+        respuesta['Accept-Ranges'] = 'bytes'
+        respuesta['ETag'] = etag
+        respuesta['Cache-Control'] = 'private, max-age=86400'
+        respuesta['Content-Disposition'] = content_disposition_header(False, archivo.filename or archivo_id)
+        if variante == 'miniatura':
+            respuesta['Vary'] = 'Accept'
+        if estado == status.HTTP_206_PARTIAL_CONTENT:
+            respuesta['Content-Range'] = f'bytes {inicio}-{fin}/{total}'
+        return respuesta
+
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def _estado_subida(subida, request):
+    estado = {
+        'subida_id': str(subida['_id']),
+        'nombre': subida['nombre'],
+        'tamaño': subida['tamaño'],
+        'recibido': subida['recibido'],
+        'completa': subida['completa'],
+        'tamaño_parte': TAMAÑO_CHUNK,
+    }
+    if subida['completa']:
+        estado['archivo_id'] = str(subida['archivo_id'])
+        estado['archivo_url'] = url_adjunto(subida['archivo_id'], request)
+    return estado
+
+
+class SubidaAdjuntoView(APIView):
+    """
+    Inicia una subida por partes (reanudable) de una foto o PDF: POST {nombre, tamaño, tipo}.
+    Las partes se envían luego con PUT a adjuntos/subidas/<id>/; la archivo_url final se
+    usa como valor de archivo_pdf o como elemento de fotos al guardar el registro.
+    """
+    permission_classes = [UsuarioRegistrado]
+
+    def post(self, request):
+        if not is_mongodb_available():
+            return Response({"error": "Base de datos no disponible temporalmente"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            tamaño = int(request.data.get('tamaño') or 0)
+        except (TypeError, ValueError):
+            return Response({"error": "Tamaño inválido"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            subida = iniciar_subida(request.data.get('nombre'), tamaño, request.data.get('tipo'))
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(_estado_subida(subida, request), status=status.HTTP_201_CREATED)
+
+
+class SubidaAdjuntoDetalleView(APIView):
+    """
+    GET: estado de la subida (para retomar desde `recibido`).
+    PUT: cuerpo binario con una parte; Content-Range: bytes <inicio>-<fin>/<total>.
+    """
+    permission_classes = [UsuarioRegistrado]
+
+    def _obtener(self, request, subida_id):
+        if not ObjectId.is_valid(subida_id):
+            return None, Response({"error": "ID de subida inválido"}, status=status.HTTP_400_BAD_REQUEST)
+        if not is_mongodb_available():
+            return None, Response({"error": "Base de datos no disponible temporalmente"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        subida = obtener_subida(subida_id)
+        if not subida:
+            return None, Response({"error": "Subida no encontrada o vencida"}, status=status.HTTP_404_NOT_FOUND)
+        return subida, None
+
+    def get(self, request, subida_id):
+        subida, error = self._obtener(request, subida_id)
+        if error:
+            return error
+        return Response(_estado_subida(subida, request))
+
+    def put(self, request, subida_id):
+        subida, error = self._obtener(request, subida_id)
+        if error:
+            return error
+        try:
+            longitud = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response({"error": "Content-Length inválido"}, status=status.HTTP_400_BAD_REQUEST)
+        rango = _CONTENT_RANGE.match(request.headers.get('Content-Range', '').strip())
+        if not rango or not longitud:
+            return Response({"error": "Se requiere Content-Range: bytes inicio-fin/total y un cuerpo no vacío"}, status=status.HTTP_400_BAD_REQUEST)
+        inicio, fin = int(rango.group(1)), int(rango.group(2))
+        if fin - inicio + 1 != longitud:
+            return Response({"error": "Content-Range no coincide con el tamaño del cuerpo"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            subida = recibir_parte(subida, inicio, request.stream, longitud)
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e), **_estado_subida(obtener_subida(subida_id), request)}, status=status.HTTP_409_CONFLICT)
+        return Response(_estado_subida(subida, request))
+
 @api_view(['POST'])
 def sugerir_bien_uso(request):
     tipo = request.data.get('tipo_maquinaria', '')
@@ -5093,20 +5573,21 @@ class MaquinariaConDepreciacionBuscarView(APIView):
 
 class UsuarioPermisosUpdateView(APIView):
     """Solo el admin puede cambiar los permisos granulares de otros usuarios."""
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede gestionar permisos'
+
     def put(self, request, id):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
+        email = request.user.email
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not check_user_permissions(user, required_role='admin'):
-            return Response({'error': 'Solo el administrador puede gestionar permisos'}, status=status.HTTP_403_FORBIDDEN)
+        user = request.user
         if str(user.get('_id')) == id:
             return Response({'error': 'No puedes cambiar tus propios permisos'}, status=status.HTTP_400_BAD_REQUEST)
         nuevos_permisos = request.data.get('permisos')
         if not isinstance(nuevos_permisos, dict):
             return Response({'error': 'Permisos inválidos'}, status=status.HTTP_400_BAD_REQUEST)
         result = collection.update_one({'_id': ObjectId(id)}, {'$set': {'permisos': nuevos_permisos}})
+        usuario_modificado()
+        revocar_sesiones_tras_cambio(id)
         if result.matched_count == 0:
             return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         usuario_actualizado = collection.find_one({'_id': ObjectId(id)})
@@ -5126,17 +5607,13 @@ class UsuarioPermisosUpdateView(APIView):
 class CrearUsuarioView(APIView):
     """Solo el admin puede crear nuevos usuarios."""
     serializer_class = RegistroSerializer
+    permission_classes = [EsAdministrador]
+    mensaje_permiso = 'Solo el administrador puede crear usuarios'
 
     def post(self, request):
         try:
-            email = request.headers.get('X-User-Email')
-            if not email:
-                return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
-            
+            email = request.user.email
             collection = get_collection(Usuario)
-            admin_user = collection.find_one({"Email": email})
-            if not check_user_permissions(admin_user, required_role='admin'):
-                return Response({'error': 'Solo el administrador puede crear usuarios'}, status=status.HTTP_403_FORBIDDEN)
 
             data = request.data
             print("Datos recibidos para crear usuario:", data)
@@ -5181,10 +5658,7 @@ class CrearUsuarioView(APIView):
                 password = ''.join(password_list)
 
             # Hashear la contraseña
-            data["Password"] = bcrypt.hashpw(
-                password.encode("utf-8"),
-                bcrypt.gensalt()
-            ).decode("utf-8")
+            data["Password"] = hashear(password)
 
             # Crear el usuario
             usuario_data = {
@@ -5215,6 +5689,7 @@ class CrearUsuarioView(APIView):
             }
 
             result = collection.insert_one(usuario_data)
+            usuario_modificado()
             usuario_creado = collection.find_one({"_id": result.inserted_id})
 
             # Enviar correo con la contraseña usando la misma configuración que pronósticos
@@ -5258,6 +5733,8 @@ Equipo de Administración
 
             return Response(serialize_doc(usuario_creado), status=status.HTTP_201_CREATED)
 
+        except ContrasenasSaturadas:
+            return respuesta_contrasenas_saturadas()
         except Exception as e:
             logger.error(f"Error interno en CrearUsuarioView: {str(e)}")
             return Response(
@@ -5267,19 +5744,22 @@ Equipo de Administración
 
 class SeguimientoListView(APIView):
     """Solo admin o encargado puede ver el registro de actividad."""
+    permission_classes = [EsEncargado]
+    mensaje_permiso = 'Permiso denegado'
+
     def get(self, request):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
-        collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        cargo = user.get('Cargo', '').lower() if user else ''
-        if cargo not in ['admin', 'encargado']:
-            return Response({'error': 'Permiso denegado'}, status=status.HTTP_403_FORBIDDEN)
+        # Los eventos de los últimos AUDITORIA_INTERVALO_MS pueden no estar todavía (ver auditoria.py)
         seguimiento_col = get_collection(Seguimiento)
-        
+
         # Usar find() con sort() en lugar de aggregate para mejor rendimiento
         try:
+            if 'cursor' in request.query_params:
+                def sin_id(docs):
+                    for doc in docs:
+                        doc.pop('_id', None)
+                    return docs
+                return listar_paginado(request, seguimiento_col, {}, serializar=sin_id,
+                                       orden_por_defecto='-fecha_hora', ordenes=('fecha_hora',))
             cursor = seguimiento_col.find().sort("fecha_hora", -1).limit(100)
             registros = []
             for doc in cursor:
@@ -5297,14 +5777,12 @@ class SeguimientoListView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 class UsuarioUpdateView(APIView):
+    permission_classes = [UsuarioRegistrado]
+
     def put(self, request):
-        email = request.headers.get('X-User-Email')
-        if not email:
-            return Response({'error': 'No autenticado'}, status=status.HTTP_401_UNAUTHORIZED)
+        user = request.user
+        email = user.email
         collection = get_collection(Usuario)
-        user = collection.find_one({"Email": email})
-        if not user:
-            return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
         data = request.data.copy()
         update_fields = {}
         # Solo permitir actualizar ciertos campos
@@ -5317,79 +5795,66 @@ class UsuarioUpdateView(APIView):
                     update_fields[field] = data[field]
         # Cambio de contraseña
         if "Password" in data and data["Password"]:
-            import bcrypt
-            hashed = bcrypt.hashpw(data["Password"].encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-            update_fields["Password"] = hashed
+            try:
+                update_fields["Password"] = hashear(data["Password"])
+            except ContrasenasSaturadas:
+                return respuesta_contrasenas_saturadas()
         if not update_fields:
             return Response({'error': 'No hay datos para actualizar'}, status=status.HTTP_400_BAD_REQUEST)
         # Eliminar campo imagen si corresponde
         if "imagen" in update_fields and update_fields["imagen"] is None:
             collection.update_one({'_id': user['_id']}, {'$unset': {'imagen': ""}})
+            usuario_modificado()
             update_fields.pop("imagen")
         if update_fields:
             result = collection.update_one({'_id': user['_id']}, {'$set': update_fields})
+            usuario_modificado()
             if result.matched_count == 0:
                 return Response({'error': 'Usuario no encontrado'}, status=status.HTTP_404_NOT_FOUND)
+            if "Password" in update_fields or update_fields.get("Email", email) != email:
+                # Los tokens emitidos con la contraseña o el email anteriores dejan de valer
+                revocar_sesiones_tras_cambio(user['_id'], email_anterior=email, cerrar=True)
         usuario_actualizado = collection.find_one({'_id': user['_id']})
         # Registrar actividad
         try:
             registrar_actividad(email, "editar_perfil", "Usuarios", f"Actualizó sus datos de perfil", {k: update_fields[k] for k in update_fields if k != 'Password'})
         except Exception as e:
             logger.error(f"Error al registrar actividad de edición de perfil: {str(e)}")
-        return Response(serialize_doc(usuario_actualizado), status=status.HTTP_200_OK)
+        datos = serialize_doc(usuario_actualizado)
+        datos.pop('Password', None)
+        # El frontend guarda esta respuesta como sesión: se entrega un token nuevo (el anterior
+        # pudo quedar revocado)
+        datos['token'], expira_en = emitir_token(usuario_actualizado)
+        datos['token_expira_en'] = expira_en.isoformat()
+        return Response(datos, status=status.HTTP_200_OK)
+
+# Unidad normalizada en el servidor: en mayúsculas y todas las "OF. ..." como OFICINA CENTRAL
+_UNIDAD_NORMALIZADA = {'$let': {
+    'vars': {'u': {'$toUpper': {'$trim': {'input': {'$ifNull': [{'$toString': '$unidad'}, '']}}}}},
+    'in': {'$cond': [{'$gte': [{'$indexOfCP': ['$$u', 'OF.']}, 0]}, 'OFICINA CENTRAL', '$$u']},
+}}
+
+# Se invalida con usuario_modificado() y maquinaria_modificada()
+opciones_usuarios = OpcionesCache({
+    Usuario.collection_name: {'cargos': {'$trim': {'input': {'$toString': '$Cargo'}}}},
+    Maquinaria.collection_name: {'unidades': _UNIDAD_NORMALIZADA},
+}, ttl=settings.OPCIONES_CACHE_TTL, nombre='opciones_usuarios')
+
 
 class UsuarioOpcionesView(APIView):
     """Devuelve los cargos únicos de usuarios y las unidades únicas de maquinaria (normalizadas)."""
     def get(self, request):
-        # Check if MongoDB is available
-        if not is_mongodb_available():
-            return Response({
-                "error": "Base de datos no disponible temporalmente",
-                "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
-                "cargos": [],
-                "unidades": []
-            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
-        # Cargos desde usuarios
-        collection = get_collection(Usuario)
-        if collection is None:
+        try:
+            opciones, etag = opciones_usuarios.obtener()
+        except (ConnectionError, PyMongoError) as e:
+            logger.warning(f"Opciones de usuarios no disponibles: {str(e)}")
             return Response({
                 "error": "Base de datos no disponible temporalmente",
                 "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
                 "cargos": [],
                 "unidades": []
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
-        usuarios = list(collection.find({}, {"Cargo": 1}))
-        cargos = set()
-        for u in usuarios:
-            if u.get("Cargo"):
-                cargos.add(str(u["Cargo"]).strip())
-        # Unidades desde maquinaria
-        maquinaria_collection = get_collection(Maquinaria)
-        if maquinaria_collection is None:
-            return Response({
-                "error": "Base de datos no disponible temporalmente",
-                "message": "El servicio de base de datos está experimentando problemas de conectividad. Por favor, intente nuevamente en unos momentos.",
-                "cargos": list(cargos),
-                "unidades": []
-            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
-        
-        maquinarias = list(maquinaria_collection.find({}, {"unidad": 1}))
-        unidades = set()
-        for m in maquinarias:
-            unidad = m.get("unidad", "").strip().upper()
-            if not unidad:
-                continue
-            if "OF." in unidad:
-                unidades.add("OFICINA CENTRAL")
-            else:
-                unidades.add(unidad)
-        unidades = sorted(unidades)
-        return Response({
-            "cargos": sorted(cargos),
-            "unidades": unidades
-        }, status=status.HTTP_200_OK)
+        return respuesta_con_etag(request, opciones, etag)
 
 @api_view(['GET'])
 def test_api(request):
@@ -5397,17 +5862,24 @@ def test_api(request):
     return Response({"message": "API funcionando correctamente", "status": "ok"})
 
 @api_view(['POST'])
+@permission_classes([UsuarioRegistrado])
 def validar_password_usuario(request):
-    email = request.data.get('email')
+    """Valida la contraseña del usuario que hace el request (no la de otro email)."""
+    email = request.data.get('email') or request.user.email
     password = request.data.get('password')
-    if not email or not password:
+    if not password:
         return Response({'valid': False, 'error': 'Email y contraseña requeridos'}, status=400)
-    collection = get_collection(Usuario)
-    user = collection.find_one({"Email": email})
+    if email != request.user.email:
+        return Response({'valid': False, 'error': 'Solo se puede validar la contraseña propia'}, status=403)
+    # request.user no trae el hash: se lee solo la contraseña
+    user = get_collection(Usuario).find_one({'_id': request.user['_id']}, {'Password': 1})
     if not user:
         return Response({'valid': False, 'error': 'Usuario no encontrado'}, status=404)
-    import bcrypt
-    if bcrypt.checkpw(password.encode('utf-8'), user["Password"].encode('utf-8')):
+    try:
+        valido = verificar(password, user["Password"])
+    except ContrasenasSaturadas:
+        return respuesta_contrasenas_saturadas()
+    if valido:
         return Response({'valid': True})
     else:
         return Response({'valid': False, 'error': 'Contraseña incorrecta'}, status=401)
@@ -5428,13 +5900,14 @@ def reset_password_usuario(request):
     
     try:
         # Hashear la nueva contraseña
-        hashed_password = bcrypt.hashpw(nueva_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        hashed_password = hashear(nueva_password)
         
         # Actualizar la contraseña en la base de datos
         get_collection(Usuario).update_one(
             {"Email": email},
             {"$set": {"Password": hashed_password}}
         )
+        revocar_sesiones_tras_cambio(user['_id'], cerrar=True)
         
         # Registrar la actividad
         registrar_actividad(
@@ -5447,6 +5920,8 @@ def reset_password_usuario(request):
         
         return Response({"message": "Contraseña actualizada exitosamente"}, status=status.HTTP_200_OK)
         
+    except ContrasenasSaturadas:
+        return respuesta_contrasenas_saturadas()
     except Exception as e:
         return Response({"error": f"Error al actualizar contraseña: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -5459,7 +5934,7 @@ def limpiar_usuarios_duplicados(request):
         if not actor_email:
             return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
         
-        user = get_collection(Usuario).find_one({"Email": actor_email})
+        user = usuario_de_request(request, actor_email)
         if not user or user.get('Cargo', '').lower() != 'admin':
             return Response({"error": "Solo los administradores pueden limpiar usuarios duplicados"}, status=status.HTTP_403_FORBIDDEN)
         
@@ -5493,6 +5968,7 @@ def limpiar_usuarios_duplicados(request):
                 result = collection.delete_one({'_id': user_id})
                 if result.deleted_count > 0:
                     usuarios_eliminados += 1
+                    usuario_modificado()
                     print(f"Usuario duplicado eliminado: {email} - ID: {user_id}")
         
         return Response({
@@ -5579,11 +6055,11 @@ class VerificarCodigoResetPasswordView(APIView):
                 verificaciones.update_one({"Email": email}, {"$inc": {"intentos": 1}})
                 return Response({"error": "Código incorrecto"}, status=status.HTTP_400_BAD_REQUEST)
             usuarios = get_collection(Usuario)
-            salt = bcrypt.gensalt()
-            hashed = bcrypt.hashpw(nueva_password.encode("utf-8"), salt).decode("utf-8")
-            upd = usuarios.update_one({"Email": email}, {"$set": {"Password": hashed}})
-            if upd.matched_count == 0:
+            hashed = hashear(nueva_password)
+            actualizado = usuarios.find_one_and_update({"Email": email}, {"$set": {"Password": hashed}}, projection={"_id": 1})
+            if not actualizado:
                 return Response({"error": "Usuario no encontrado"}, status=status.HTTP_404_NOT_FOUND)
+            revocar_sesiones_tras_cambio(actualizado['_id'], cerrar=True)
 
             verificaciones.delete_one({"Email": email})
 
@@ -5593,6 +6069,8 @@ class VerificarCodigoResetPasswordView(APIView):
                 pass
 
             return Response({"message": "Contraseña actualizada exitosamente"}, status=status.HTTP_200_OK)
+        except ContrasenasSaturadas:
+            return respuesta_contrasenas_saturadas()
         except Exception as e:
             return Response({"error": f"Error interno: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -5641,9 +6119,10 @@ class VerificarPasswordActualView(APIView):
         if not user:
             return Response({"error": "Usuario no encontrado"}, status=status.HTTP_404_NOT_FOUND)
 
-        stored_hash = (user.get("Password") or "").encode("utf-8")
         try:
-            ok = bcrypt.checkpw(password_actual.encode("utf-8"), stored_hash)
+            ok = verificar(password_actual, user.get("Password"))
+        except ContrasenasSaturadas:
+            return respuesta_contrasenas_saturadas()
         except Exception:
             return Response({"error": "Formato de contraseña inválido"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -5695,15 +6174,7 @@ class ControlOdometroListView(BaseSectionAPIView):
         try:
             collection = get_collection('control_odometro')
             # Solo mostrar registros activos
-            records = list(collection.find({
-                'maquinaria': ObjectId(maquinaria_id),
-                "$or": [
-                    {"activo": True},
-                    {"activo": {"$exists": False}}
-                ]
-            }))
-            logger.info(f"Encontrados {len(records)} registros de control de odómetro")
-            return Response(serialize_list(records))
+            return self.listar(request, collection, maquinaria_id)
         except Exception as e:
             logger.error(f"Error en GET ControlOdometroListView: {str(e)}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -5735,7 +6206,7 @@ class ControlOdometroListView(BaseSectionAPIView):
             
             # Agregar los campos de auditoría con el nombre del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             user_name = user['Nombre'] if user and 'Nombre' in user else actor_email
             
             validated_data['registrado_por'] = user_name
@@ -5746,6 +6217,9 @@ class ControlOdometroListView(BaseSectionAPIView):
             validated_data = self.convert_date_to_datetime(validated_data)
             logger.info(f"Datos convertidos: {validated_data}")
 
+            # Las fotos se guardan en GridFS; el documento solo conserva las referencias
+            validated_data = guardar_adjuntos_registro(validated_data)
+
             # Validar tamaño del documento antes de insertar
             import sys
             doc_size = sys.getsizeof(str(validated_data))
@@ -5762,7 +6236,7 @@ class ControlOdometroListView(BaseSectionAPIView):
             validated_data = convert_dates_to_str(validated_data)
             result = collection.insert_one(validated_data)
             new_record = collection.find_one({"_id": result.inserted_id})
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -5784,8 +6258,10 @@ class ControlOdometroListView(BaseSectionAPIView):
                 logger.error(f"Error al registrar actividad de creación de control de odómetro: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
             
-            return Response(serialize_doc(new_record), status=status.HTTP_201_CREATED)
+            return Response(hidratar_adjuntos(serialize_doc(new_record), request), status=status.HTTP_201_CREATED)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al crear control de odómetro: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -5816,7 +6292,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
         record = collection.find_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
         if not record:
             return Response({"error": "Control de odómetro no encontrado"}, status=status.HTTP_404_NOT_FOUND)
-        return Response(serialize_doc(record))
+        return Response(hidratar_adjuntos(serialize_doc(record), request, incluir_archivo(request)))
 
     def put(self, request, maquinaria_id, record_id):
         if not ObjectId.is_valid(maquinaria_id) or not ObjectId.is_valid(record_id):
@@ -5849,7 +6325,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             
             # Manejar campos de auditoría según el cargo del usuario
             actor_email = request.headers.get('X-User-Email')
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             user_cargo = user.get('Cargo', '').lower() if user else ''
             
             if current_record:
@@ -5875,6 +6351,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             # Actualizar en MongoDB
             collection = get_collection('control_odometro')
             validated_data = convert_dates_to_str(validated_data)
+            validated_data = guardar_adjuntos_registro(validated_data, current_record)
             result = collection.update_one(
                 {'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)},
                 {'$set': validated_data}
@@ -5884,7 +6361,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
                 return Response({"error": "Control de odómetro no encontrado"}, status=status.HTTP_404_NOT_FOUND)
             
             updated_record = collection.find_one({'_id': ObjectId(record_id)})
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -5906,8 +6383,10 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
                 logger.error(f"Error al registrar actividad de actualización de control de odómetro: {str(e)}")
             # --- FIN REGISTRO DE ACTIVIDAD ---
             
-            return Response(serialize_doc(updated_record), status=status.HTTP_200_OK)
+            return Response(hidratar_adjuntos(serialize_doc(updated_record), request), status=status.HTTP_200_OK)
 
+        except AdjuntoInvalido as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Error al actualizar control de odómetro: {str(e)}\n{traceback.format_exc()}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -5922,7 +6401,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             if not actor_email:
                 return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
             
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             is_permanent = request.GET.get('permanent', 'false').lower() == 'true'
             
             if is_permanent and (not user or user.get('Cargo', '').lower() != 'admin'):
@@ -5936,6 +6415,8 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             if is_permanent:
                 # Eliminación permanente
                 result = collection.delete_one({'_id': ObjectId(record_id), 'maquinaria': ObjectId(maquinaria_id)})
+                if result.deleted_count:
+                    liberar_adjuntos_registro(record)
                 mensaje = f"Eliminó permanentemente control de odómetro para maquinaria"
             else:
                 # Soft delete - marcar como inactivo
@@ -5948,7 +6429,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             if (is_permanent and result.deleted_count == 0) or (not is_permanent and result.matched_count == 0):
                 return Response({"error": "Control de odómetro no encontrado"}, status=status.HTTP_404_NOT_FOUND)
             
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             # --- REGISTRO DE ACTIVIDAD ---
             try:
@@ -5986,7 +6467,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             if not actor_email:
                 return Response({"error": "No autenticado"}, status=status.HTTP_401_UNAUTHORIZED)
             
-            user = get_collection(Usuario).find_one({"Email": actor_email})
+            user = usuario_de_request(request, actor_email)
             if not user or user.get('Cargo', '').lower() != 'admin':
                 return Response({"error": "Solo los administradores pueden reactivar registros"}, status=status.HTTP_403_FORBIDDEN)
             
@@ -6004,7 +6485,7 @@ class ControlOdometroDetailView(BaseSectionDetailAPIView):
             if result.matched_count == 0:
                 return Response({"error": "Control de odómetro no encontrado"}, status=status.HTTP_404_NOT_FOUND)
             
-            maquinaria_doc = get_collection(Maquinaria).find_one({"_id": ObjectId(maquinaria_id)})
+            maquinaria_doc = obtener_maquinaria(maquinaria_id)
             
             # --- REGISTRO DE ACTIVIDAD ---
             try:
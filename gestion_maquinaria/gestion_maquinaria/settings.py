@@ -14,7 +14,9 @@ from pathlib import Path
 import pymongo
 from corsheaders.defaults import default_headers
 import os
+import sys
 from dotenv import load_dotenv
+from django.core.exceptions import ImproperlyConfigured
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -45,12 +47,19 @@ except UnicodeDecodeError:
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
-# SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = os.environ.get('SECRET_KEY', 'django-insecure-7k)417d#((!8+nx4&(@w+9!+gv9cztauv@b6(($ziw4&0h!)+@')
-
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DEBUG', 'False').lower() == 'true'
 
+# SECURITY WARNING: keep the secret key used in production secret!
+# Con ella se firman los tokens de sesión (core/sesiones.py): es obligatoria salvo con DEBUG
+# o al correr `manage.py test`
+EJECUTANDO_TESTS = len(sys.argv) > 1 and sys.argv[1] == 'test'
+SECRET_KEY = os.environ.get('SECRET_KEY')
+if not SECRET_KEY:
+    if not (DEBUG or EJECUTANDO_TESTS):
+        raise ImproperlyConfigured('SECRET_KEY no configurada: defínala en el entorno (o en .env) para producción')
+    SECRET_KEY = 'django-insecure-7k)417d#((!8+nx4&(@w+9!+gv9cztauv@b6(($ziw4&0h!)+@'
+
 ALLOWED_HOSTS = [
     'localhost', 
     '127.0.0.1', 
@@ -80,6 +89,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'core.instrumentacion.InstrumentacionMongoMiddleware',
+    'core.sesiones.SesionTokenMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -117,6 +128,58 @@ APPEND_SLASH = False
 MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
 MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'activos')
 
+# Caché en memoria (por proceso) de maquinarias: _id <-> placa <-> resumen
+MAQUINARIA_CACHE_TTL = int(os.environ.get('MAQUINARIA_CACHE_TTL', 300))  # segundos
+MAQUINARIA_CACHE_SIZE = int(os.environ.get('MAQUINARIA_CACHE_SIZE', 2048))
+# Segundos que se sirve la foto del dashboard antes de recalcularla en segundo plano
+DASHBOARD_SNAPSHOT_TTL = int(os.environ.get('DASHBOARD_SNAPSHOT_TTL', 60))
+# Segundos que se sirven las opciones de los desplegables antes de volver a armarlas desde MongoDB
+OPCIONES_CACHE_TTL = int(os.environ.get('OPCIONES_CACHE_TTL', 600))
+# Usuario de X-User-Email (core/autenticacion.py): se vacía al editar usuarios, el TTL acota
+# cuánto tarda un worker que no recibió la edición en ver el cambio de cargo o permisos
+USUARIOS_CACHE_TTL = int(os.environ.get('USUARIOS_CACHE_TTL', 30))
+USUARIOS_CACHE_SIZE = int(os.environ.get('USUARIOS_CACHE_SIZE', 1024))
+
+# Paginación por cursor (?cursor=) de los listados. Sin cursor se devuelve la lista completa
+# (las secciones de maquinaria, de a PAGINACION_DEFECTO por página como siempre)
+PAGINACION_DEFECTO = 50
+PAGINACION_MAX = int(os.environ.get('PAGINACION_MAX', 200))
+
+# Modelo de pronóstico (submódulo pronostico-v1): se recarga si cambian sus archivos
+PRONOSTICO_MODELO_DIR = os.environ.get('PRONOSTICO_MODELO_DIR', str(BASE_DIR / 'pronostico-v1'))
+PRONOSTICO_RECARGA_SEGUNDOS = int(os.environ.get('PRONOSTICO_RECARGA_SEGUNDOS', 30))
+# Excel con más filas se procesan en segundo plano (core/trabajos_pronostico.py). El worker
+# corre en un hilo del servidor; con False se usa `manage.py procesar_trabajos_pronostico --continuo`
+PRONOSTICO_EXCEL_MAX_SINCRONO = int(os.environ.get('PRONOSTICO_EXCEL_MAX_SINCRONO', 200))
+PRONOSTICO_WORKER_EN_PROCESO = os.environ.get('PRONOSTICO_WORKER_EN_PROCESO', 'True').lower() == 'true'
+
+# Cliente de MongoDB (uno por proceso, ver core/mongo_connection.py). MONGO_POOL_MAX es por
+# proceso: con varios workers de gunicorn el total de conexiones es workers x MONGO_POOL_MAX
+MONGO_POOL_MAX = int(os.environ.get('MONGO_POOL_MAX', 10))
+MONGO_POOL_MIN = int(os.environ.get('MONGO_POOL_MIN', 0))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000))
+MONGO_MAX_IDLE_MS = int(os.environ.get('MONGO_MAX_IDLE_MS', 30000))
+# Compresión del protocolo, en orden de preferencia (p. ej. "zstd,snappy,zlib"); zstd necesita
+# el paquete zstandard y snappy python-snappy, si faltan se omiten
+MONGO_COMPRESORES = [c.strip() for c in os.environ.get('MONGO_COMPRESORES', '').split(',') if c.strip()]
+# primary, primaryPreferred, secondary, secondaryPreferred o nearest
+MONGO_READ_PREFERENCE = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+
+# Instrumentación de consultas (core/instrumentacion.py): header Server-Timing y log JSON por
+# request. Con MONGO_CONSULTA_LENTA_MS > 0 se registran los comandos más lentos que ese umbral
+MONGO_INSTRUMENTACION = os.environ.get('MONGO_INSTRUMENTACION', 'True').lower() == 'true'
+MONGO_CONSULTA_LENTA_MS = float(os.environ.get('MONGO_CONSULTA_LENTA_MS', 0))
+
+# Monitor de salud de MongoDB (core/mongo_connection.py): tras UMBRAL pings fallidos seguidos
+# el circuito se abre y las vistas responden 503 sin esperar timeouts; reintenta pasada la espera
+MONGO_HEALTH_INTERVALO_SEGUNDOS = float(os.environ.get('MONGO_HEALTH_INTERVALO_SEGUNDOS', 5))
+MONGO_BREAKER_UMBRAL_FALLOS = int(os.environ.get('MONGO_BREAKER_UMBRAL_FALLOS', 2))
+MONGO_BREAKER_ESPERA_SEGUNDOS = float(os.environ.get('MONGO_BREAKER_ESPERA_SEGUNDOS', 10))
+MONGO_BREAKER_ESPERA_MAX_SEGUNDOS = float(os.environ.get('MONGO_BREAKER_ESPERA_MAX_SEGUNDOS', 120))
+
 # These will be initialized lazily when needed
 MONGO_CLIENT = None
 MONGO_DB = None
@@ -149,6 +212,35 @@ DATABASES = {
     }
 }
 
+# Tokens de sesión (core/sesiones.py). Solo se confía en el email firmado en el token;
+# SESION_ACEPTAR_HEADER_EMAIL=True vuelve a aceptar X-User-Email sin token (solo para
+# migrar clientes viejos: cualquiera puede mandar ese header)
+SESION_TOKEN_HORAS = int(os.environ.get('SESION_TOKEN_HORAS', 12))
+SESION_REVOCACIONES_SEGUNDOS = int(os.environ.get('SESION_REVOCACIONES_SEGUNDOS', 15))
+SESION_ACEPTAR_HEADER_EMAIL = os.environ.get('SESION_ACEPTAR_HEADER_EMAIL', 'False').lower() == 'true'
+
+# Contraseñas (core/contrasenas.py): costo de bcrypt (al cambiarlo, los hashes anteriores se
+# rehacen en el siguiente login), hilos que calculan hashes y cuántas operaciones pueden
+# esperar turno como máximo antes de responder 503
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+BCRYPT_HILOS = int(os.environ.get('BCRYPT_HILOS', 2))
+BCRYPT_COLA_MAX = int(os.environ.get('BCRYPT_COLA_MAX', 16))
+BCRYPT_ESPERA_SEGUNDOS = float(os.environ.get('BCRYPT_ESPERA_SEGUNDOS', 5))
+
+# Registro de actividad (core/auditoria.py): los eventos se guardan en lotes de AUDITORIA_LOTE
+# o cada AUDITORIA_INTERVALO_MS; los textos del detalle más largos que AUDITORIA_TEXTO_MAX se
+# recortan (o se reemplazan por su sha256 si son base64). Con False se guardan uno a uno
+AUDITORIA_ASINCRONA = os.environ.get('AUDITORIA_ASINCRONA', 'True').lower() == 'true'
+AUDITORIA_LOTE = int(os.environ.get('AUDITORIA_LOTE', 100))
+AUDITORIA_INTERVALO_MS = int(os.environ.get('AUDITORIA_INTERVALO_MS', 1000))
+AUDITORIA_BUFFER_MAX = int(os.environ.get('AUDITORIA_BUFFER_MAX', 10000))
+AUDITORIA_TEXTO_MAX = int(os.environ.get('AUDITORIA_TEXTO_MAX', 2048))
+
+REST_FRAMEWORK = {
+    # El usuario del header X-User-Email se resuelve una vez por request en request.user
+    'DEFAULT_AUTHENTICATION_CLASSES': ['core.autenticacion.EmailHeaderAuthentication'],
+}
+
 # settings.py
 
 MONGODB_SETTINGS = {
@@ -197,6 +289,8 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 # Configuración para archivos
+# Los PDF y fotos de las secciones van directo a GridFS mientras llegan: esas vistas agregan
+# GridFSUploadHandler después de autenticar (core/adjuntos.py, SubidaGridFSMixin)
 FILE_UPLOAD_HANDLERS = [
     'django.core.files.uploadhandler.MemoryFileUploadHandler',
     'django.core.files.uploadhandler.TemporaryFileUploadHandler',
@@ -206,6 +300,18 @@ FILE_UPLOAD_HANDLERS = [
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760
 
+# Tamaño máximo de un adjunto (PDF o foto) subido a GridFS
+ADJUNTO_MAX_BYTES = int(os.environ.get('ADJUNTO_MAX_BYTES', 20 * 1024 * 1024))
+# Cada cuántas horas se borran los adjuntos subidos que nunca se asociaron a un registro (y
+# las subidas por partes vencidas). Con False solo con `manage.py limpiar_adjuntos`
+ADJUNTOS_LIMPIEZA_HORAS = float(os.environ.get('ADJUNTOS_LIMPIEZA_HORAS', 1))
+ADJUNTOS_LIMPIEZA_EN_PROCESO = os.environ.get('ADJUNTOS_LIMPIEZA_EN_PROCESO', 'True').lower() == 'true'
+# Fotos: lado máximo de la versión recomprimida y de las miniaturas (px). El worker de la
+# cola corre en un hilo del servidor; con False se usa `manage.py procesar_imagenes --continuo`
+IMAGEN_LADO_MAXIMO = int(os.environ.get('IMAGEN_LADO_MAXIMO', 1920))
+IMAGEN_LADO_MINIATURA = int(os.environ.get('IMAGEN_LADO_MINIATURA', 320))
+IMAGENES_WORKER_EN_PROCESO = os.environ.get('IMAGENES_WORKER_EN_PROCESO', 'True').lower() == 'true'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -246,4 +352,23 @@ EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
 EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True').lower() == 'true'
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', 'activosfijos39@gmail.com')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', 'tdvf wsbt dudz clmc')
-DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'Sistema de Mantenimiento <activosfijos39@gmail.com>')
\ No newline at end of file
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'Sistema de Mantenimiento <activosfijos39@gmail.com>')
+# Los correos se encolan (core/correos.py) y los envía un hilo del servidor por una sola
+# conexión SMTP; con False se usa `manage.py enviar_correos --continuo`
+CORREOS_WORKER_EN_PROCESO = os.environ.get('CORREOS_WORKER_EN_PROCESO', 'True').lower() == 'true'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # Una línea JSON por request con consultas a MongoDB y las consultas lentas
+        'core.instrumentacion': {
+            'handlers': ['console'],
+            'level': os.environ.get('MONGO_INSTRUMENTACION_LOG_NIVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
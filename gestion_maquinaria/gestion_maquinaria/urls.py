@@ -23,7 +23,7 @@ from core.views import (
     ControlOdometroDetailView, ControlOdometroListView,
     activos_list, PronosticoAPIView, DashboardStatsView, PronosticoSummaryView,
     DepreciacionesDetailView,DepreciacionesGeneralView,DepreciacionesListView,
-    TodosRegistrosDesactivadosView, test_api, PronosticoExcelUploadView
+    TodosRegistrosDesactivadosView, test_api, PronosticoExcelUploadView, PronosticoJobView
 )
 
 router = DefaultRouter()
@@ -52,8 +52,9 @@ urlpatterns = [
     path('api/', include('core.urls')),  # <--- Cambiado aquí
     # Rutas para Maquinaria Principal (JSON puro)
     path('api/maquinaria/', MaquinariaListView.as_view(), name='maquinaria-list'),
-    path('api/maquinaria/<str:id>/', MaquinariaDetailView.as_view(), name='maquinaria-detail'),
+    # Antes del detalle: si no, 'options' se toma como id
     path('api/maquinaria/options/', MaquinariaOptionsView.as_view(), name='maquinaria-options'),
+    path('api/maquinaria/<str:id>/', MaquinariaDetailView.as_view(), name='maquinaria-detail'),
 
     # Rutas para Sub-secciones (CRUD completo)
     path('api/maquinaria/<str:maquinaria_id>/control/', HistorialControlListView.as_view(), name='control-list'),
@@ -92,6 +93,7 @@ urlpatterns = [
     path('api/dashboard/', DashboardStatsView.as_view(), name='dashboard'),
     path('api/pronostico/summary/', PronosticoSummaryView.as_view(), name='pronostico-summary'),
     path('api/pronostico/excel-upload/', PronosticoExcelUploadView.as_view(), name='pronostico-excel-upload'),
+    path('api/pronostico/jobs/<str:job_id>/', PronosticoJobView.as_view(), name='pronostico-job'),
     # URLs para registros desactivados
     path('api/registros-desactivados/', TodosRegistrosDesactivadosView.as_view(), name='todos-registros-desactivados'),
     path('api/test/', test_api, name='test-api'),
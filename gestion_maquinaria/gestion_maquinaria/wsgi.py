@@ -14,3 +14,19 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gestion_maquinaria.settings')
 
 application = get_wsgi_application()
+
+# Modelo de pronóstico: se carga (y se calienta) una vez por worker, antes de la primera petición
+from core.pronostico import registro_modelo  # noqa: E402
+
+registro_modelo.precargar()
+
+# Retoma las cargas de Excel y los correos que quedaron pendientes si el servidor se reinició
+from core import adjuntos, correos, trabajos_pronostico  # noqa: E402
+
+trabajos_pronostico.despertar_worker()
+correos.despertar_worker()
+adjuntos.programar_limpieza()
+
+from core.views import asegurar_admin_por_defecto  # noqa: E402
+
+asegurar_admin_por_defecto()